@@ -9,7 +9,7 @@ import mcts as mc
 from game import input_representation, output_representation
 from util import logger as lg
 import config
-from tensorflow.python.keras.backend import set_session
+import util.nn_interface as nni
 
 
 class Agent():
@@ -41,6 +41,8 @@ class Agent():
         self.model_extra = model_extra
 
         self.interface = interface
+        # the model is compiled for the sparse targets of the memory before the first replay
+        self.compiled_for_replay = False
 
         # to plot value_head and policy_head loss later
         self.train_overall_loss = []
@@ -55,14 +57,17 @@ class Agent():
     ##########
     def simulate(self):
 
-        lg.logger_mcts.info('ROOT NODE...%s', self.mcts.root.state.id)
-        self.mcts.root.state.render(lg.logger_mcts)  # log game state
-        lg.logger_mcts.info('CURRENT PLAYER...%d', self.mcts.root.state.playerTurn)
+        # rendering the boards is expensive, only do it if the mcts logger is on
+        if not lg.logger_mcts.disabled:
+            lg.logger_mcts.info('ROOT NODE...%s', self.mcts.root.state.id)
+            self.mcts.root.state.render(lg.logger_mcts)  # log game state
+            lg.logger_mcts.info('CURRENT PLAYER...%d', self.mcts.root.state.playerTurn)
 
         # MOVE TO THE LEAF NODE
         leaf, result, done, breadcrumbs = self.mcts.move_to_leaf()
         # start logger.
-        leaf.state.render(lg.logger_mcts)
+        if not lg.logger_mcts.disabled:
+            leaf.state.render(lg.logger_mcts)
 
         # EVALUATE THE LEAF NODE
         leaf_evaluation = self.expand_and_evaluate_leaf(leaf, result, done)
@@ -156,9 +161,7 @@ class Agent():
 
         inputs = {"input_1": x1, "input_2": x2}
 
-        with self.model_extra[0].as_default():
-            set_session(self.model_extra[1])
-            predictions = self.model.predict(inputs)
+        predictions = nni.predict(self.model, self.model_extra, inputs)
 
         # value head should be one value to say how good my state is
         value_head = predictions[0]
@@ -286,12 +289,12 @@ class Agent():
 
     def replay(self, ltmemory):
         lg.logger_mcts.info('******RETRAINING MODEL******')
+        if not self.compiled_for_replay:
+            nni.compile_sparse(self.model)
+            self.compiled_for_replay = True
 
         for i in range(config.TRAINING_LOOPS):
-            minibatch = random.sample(ltmemory, min(config.BATCH_SIZE, len(ltmemory)))
-
-            training_states = np.array([self.model.convertToModelInput(row['state']) for row in minibatch])
-            training_targets = {'value_head': np.array([row['value'] for row in minibatch]), 'policy_head': np.array([row['AV'] for row in minibatch])}
+            _, training_states, training_targets = ltmemory.sample(min(config.BATCH_SIZE, len(ltmemory)))
 
             fit = self.model.fit(training_states, training_targets, epochs=config.EPOCHS, verbose=1, validation_split=0,
                                  batch_size=32)
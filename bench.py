@@ -0,0 +1,144 @@
+"""
+Reproducible benchmark of the search.
+
+Runs new_agent.Agent.suggest_move with BENCH_SIMULATIONS simulations on a fixed set of bughouse positions
+(openings, middlegames with full pockets, mating nets) and reports per position and in total:
+nodes/sec (readouts), evals/sec (positions evaluated by the network), the size of the tree, the peak memory of
+the process and a checksum of the chosen moves. The search and the stub network are seeded with BENCH_SEED,
+so with the stub the checksum only changes when the search itself changes.
+
+    python bench.py                          stub network, no TensorFlow needed
+    python bench.py <path_to_nn>             real network from the model registry
+    python bench.py ... --json bench.json    also writes the results, for regression tracking
+"""
+import json
+import random
+import resource
+import sys
+import time
+import zlib
+
+import chess
+import numpy as np
+from chess.variant import BughouseBoards
+
+import config
+from game.game import Game, GameState
+from new_agent import Agent
+from util.stub_model import StubModel
+
+##########
+# name, board of the agent (0: A, 1: B), moves from the start position as <board>/<uci>
+# the agent searches for the side to move on its board
+##########
+POSITIONS = [
+    ("opening_start", 0, ""),
+    ("opening_sicilian", 0, "A/e2e4 A/c7c5 A/g1f3 A/d7d6 B/d2d4 B/d7d5"),
+    ("opening_black_b", 1, "B/e2e4 B/e7e5 B/g1f3"),
+    ("drops_fried_liver", 0, "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1c4 A/g8f6 A/f3g5 A/d7d5 A/e4d5 A/f6d5 A/g5f7 A/e8f7 "
+                             "B/e2e4 B/e7e5 B/g1f3 B/b8c6 B/d2d4 B/e5d4 B/f3d4 B/c6d4 B/d1d4 B/g8f6"),
+    ("drops_partner_board", 1, "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1c4 A/g8f6 A/f3g5 A/d7d5 A/e4d5 A/f6d5 A/g5f7 A/e8f7 "
+                               "B/e2e4 B/e7e5 B/g1f3 B/b8c6 B/d2d4 B/e5d4 B/f3d4 B/c6d4 B/d1d4 B/g8f6"),
+    ("drops_queens_in_pocket", 0, "B/d2d4 B/d7d5 B/c2c4 B/d5c4 B/e2e4 B/e7e5 B/d4e5 B/d8d1 B/e1d1 B/b8c6 "
+                                  "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1b5"),
+    ("mate_queen_drop_h7", 0, "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1c4 A/f8c5 A/e1g1 A/g8e7 A/d2d3 A/e8g8 A/f3g5 A/h7h6 "
+                              "B/e2e4 B/e7e5 B/d1h5 B/b8c6 B/h5f7 B/e8f7"),
+    ("net_attack_king_e6", 0, "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1c4 A/g8f6 A/f3g5 A/d7d5 A/e4d5 A/f6d5 A/g5f7 A/e8f7 "
+                              "B/e2e4 B/e7e5 B/g1f3 B/b8c6 B/d2d4 B/e5d4 B/f3d4 B/c6d4 B/d1d4 B/g8f6 A/d1f3 A/f7e6"),
+    ("net_defend_king_f7", 0, "A/e2e4 A/e7e5 A/g1f3 A/b8c6 A/f1c4 A/g8f6 A/f3g5 A/d7d5 A/e4d5 A/f6d5 A/g5f7 A/e8f7 "
+                              "B/e2e4 B/e7e5 B/g1f3 B/b8c6 B/d2d4 B/e5d4 B/f3d4 B/c6d4 B/d1d4 B/g8f6 A/d1f3"),
+]
+
+
+def load_position(moves, board_number):
+    """
+    :param moves: moves from the start position as <board>/<uci>, e.g. "A/e2e4 B/d7d5 A/N@f3"
+    :return: GameState of the player to move on board_number
+    """
+    boards = BughouseBoards()
+    for token in moves.split():
+        board, uci = token.split("/")
+        move = chess.Move.from_uci(uci)
+        move.board_id = "AB".index(board)
+        boards.push(move)
+    player_turn = 1 if boards.boards[board_number].turn == chess.WHITE else -1
+    return GameState(boards, board_number, player_turn)
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_bench(path_to_nn=None, simulations=config.BENCH_SIMULATIONS, seed=config.BENCH_SEED):
+    """
+    Searches every position of POSITIONS once with a new agent
+    :param path_to_nn: network to use, the stub network if None
+    :return: results per position and the totals
+    """
+    if path_to_nn is None:
+        model, model_extra = StubModel(seed), None
+    else:
+        from util import model_registry
+        model, model_extra = model_registry.get_model(path_to_nn, config.USE_INFERENCE_GRAPH)
+
+    env = Game(0)
+    # warm up the network, the first predict of a session is much slower
+    warmup = Agent("bench", env.state_size, env.action_size, 1, config.CPUCT, model, None, model_extra)
+    warmup.get_preds([env.gameState])
+
+    results = []
+    checksum = 0
+    for name, board_number, moves in POSITIONS:
+        random.seed(seed)
+        np.random.seed(seed)
+        state = load_position(moves, board_number)
+        if path_to_nn is None:
+            # a new stub per position, so the result of a position does not depend on the positions before it
+            model = StubModel(seed)
+        agent = Agent(f"bench_{name}", env.state_size, env.action_size, simulations, config.CPUCT, model, None, model_extra)
+        agent.build_mcts(state)
+        move = agent.suggest_move(higher_noise=False)
+
+        stats = agent.game_stats.totals
+        checksum = zlib.crc32(f"{name}:{move.uci()};".encode(), checksum)
+        results.append({"position": name, "move": move.uci(), "readouts": stats["readouts"],
+                        "evals": stats["nn_positions"], "tree_nodes": stats["tree_nodes"], "time": stats["time_total"],
+                        "nodes_per_sec": stats["readouts"] / stats["time_total"],
+                        "evals_per_sec": stats["nn_positions"] / stats["time_total"]})
+
+    total_time = sum(result["time"] for result in results)
+    totals = {"positions": len(results), "simulations": simulations, "seed": seed, "network": path_to_nn or "stub",
+              "time": total_time,
+              "nodes_per_sec": sum(result["readouts"] for result in results) / total_time,
+              "evals_per_sec": sum(result["evals"] for result in results) / total_time,
+              "peak_memory_mb": peak_memory_mb(),
+              "checksum": "%08x" % checksum}
+    return results, totals
+
+
+def print_results(results, totals):
+    print("%-24s %-7s %8s %8s %8s %8s %10s %10s" % ("position", "move", "readouts", "evals", "nodes", "sec", "nodes/s", "evals/s"))
+    for result in results:
+        print("%-24s %-7s %8i %8i %8i %8.3f %10.1f %10.1f" % (
+            result["position"], result["move"], result["readouts"], result["evals"], result["tree_nodes"],
+            result["time"], result["nodes_per_sec"], result["evals_per_sec"]))
+    print()
+    print("network %(network)s, %(simulations)i simulations, seed %(seed)i" % totals)
+    print("total %(time).3fs  nodes/s %(nodes_per_sec).1f  evals/s %(evals_per_sec).1f  "
+          "peak memory %(peak_memory_mb).1f MB  checksum %(checksum)s" % totals)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    json_path = None
+    if "--json" in args:
+        json_path = args.pop(args.index("--json") + 1)
+        args.remove("--json")
+    st_time = time.time()
+    results, totals = run_bench(args[0] if args else None)
+    print_results(results, totals)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"totals": totals, "positions": results}, f, indent=1)
+    print(f"bench finished in {time.time() - st_time:.1f}s")
@@ -4,14 +4,17 @@
 # Initialise
 INITIAL_RUN_NUMBER = None
 INITIAL_MODEL_VERSION = None
-INITIAL_MEMORY_VERSION = None
+INITIAL_MEMORY_FOLDER = None  # replay store to continue with, e.g. "./run/archive/bughouse/run0001/memory/replay/"
 INITIAL_MODEL_PATH = "/run/models/15M"
+PRETRAINED_MODEL_PATH = "/run/models/15M"  # start of the self play if INITIAL_MODEL_VERSION is None
+USE_INFERENCE_GRAPH = True  # play with the frozen inference graph of the model (see util/nn_interface.py)
 
 
 # Main / Gamemode Options
 GAME_AGENT_THREADS = 4  # 0 for selfplay, 4 for playing against itself, 2 for sjeng, 1 for single-player
 SERVER_AUTOSTART = 0
 SERVER_ADDRESS = "ws://localhost:8080/websocketclient"
+ASYNC_CLIENT = False  # serve the connections of all agents in one asyncio event loop (util/async_client.py)
 GAMEID = "gameid"
 TOURNAMENTID = "tournamentid"
 
@@ -22,6 +25,21 @@ RUN_ON_NN_ONLY = False
 LOGGER_DISABLED = {
     'main': False, 'memory': False, 'tourney': False, 'mcts': False, 'model': False}
 
+# structured MCTS trace in run_folder/traces/, summarize with `python -m util.trace <file>`
+MCTS_TRACE = False
+MCTS_TRACE_FORMAT = "jsonl"  # "jsonl" or "binary" (the leaf records as fixed size binary records)
+
+# write the search statistics of every game to run_folder/metrics/: None, "json" or "prometheus"
+SEARCH_STATS_DUMP = None
+
+# sampling profiler of `python main.py ... --profile`, writes to run_folder/profiles/
+PROFILE_INTERVAL = 0.005  # seconds between two samples
+PROFILE_FLUSH_INTERVAL = 60  # seconds between two writes of the profile
+
+# benchmark of the search, `python bench.py [path_to_nn]`
+BENCH_SIMULATIONS = 400  # fixed number of simulations per position
+BENCH_SEED = 0
+
 # Random Agent Sleep in seconds
 DELAY_FOR_RANDOM = 3
 
@@ -38,6 +56,10 @@ CPUCT_BASE = 19652  # Exploration constants balancing priors vs. value net outpu
 DIRICHLET_ALPHA = 0.03
 DIRICHLET_WEIGHT = 0.25  # 'How much to weight the priors vs. dirichlet noise when mixing'
 TEMPERATURE = 0.2
+SELF_PLAY_PARALLEL_GAMES = 16  # games played at the same time by the headless self play engine
+SELF_PLAY_MAX_TURNS = 300  # a self play game is scored as draw after this many turns
+SELF_PLAY_WORKERS = 0  # number of self play processes sharing one inference process, 0 to play in the main process
+SELF_PLAY_INFERENCE_WAIT = 0.002  # seconds the inference process waits for more workers before predicting a batch
 
 # RETRAINING
 BATCH_SIZE = 256
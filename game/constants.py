@@ -2340,6 +2340,10 @@ LABELS = [
 # legal moves total:
 NB_LABELS = 2272
 
+# number of (move index, probability) pairs of a sparse policy target
+# hard labels use a single pair, self play visit counts keep the NB_SPARSE_POLICY most visited moves
+NB_SPARSE_POLICY = 16
+
 
 def mirror_move(move: chess.Move):
     """
@@ -2353,6 +2357,16 @@ def mirror_move(move: chess.Move):
     return chess.Move(from_square, to_square, move.promotion, move.drop)
 
 
+def mirror_move_files(move: chess.Move):
+    """
+    Mirrors a move at the vertical axis (a-file <-> h-file)
+
+    :param move: Move object
+    :return: Mirrored move
+    """
+    return chess.Move(move.from_square ^ 7, move.to_square ^ 7, move.promotion, move.drop)
+
+
 # flip the labels for BLACK
 LABELS_MIRRORED = [None] * NB_LABELS
 
@@ -152,7 +152,9 @@ class GameState:
         new_boards = BughouseBoards(self.boards.fen())
         new_boards.push(action)
 
-        newState = GameState(new_boards, self.board_number, -self.playerTurn)
+        # a move on the partner board does not change who is to move on this board
+        player_turn = 1 if new_boards.boards[self.board_number].turn == chess.WHITE else -1
+        newState = GameState(new_boards, self.board_number, player_turn)
 
         value = 0
         done = 0
@@ -13,6 +13,8 @@ from game.constants import (
     MV_LOOKUP,
     MV_LOOKUP_MIRRORED,
     NB_LABELS,
+    NB_SPARSE_POLICY,
+    mirror_move_files,
 )
 import numpy as np
 import chess.variant
@@ -23,6 +25,10 @@ PACKAGE_PARENT = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
+# policy index of every move after mirroring the board at the vertical axis.
+# Mirroring the files commutes with the colour mirroring of MV_LOOKUP_MIRRORED, so it is the same for both colours.
+FILE_MIRROR_PERMUTATION = np.array([MV_LOOKUP[mirror_move_files(chess.Move.from_uci(label)).uci()] for label in LABELS], dtype=np.int32)
+
 
 def move_to_policy(move, is_white_to_move=True):
     """
@@ -58,6 +64,57 @@ def move_to_policy_idx(move, is_white_to_move=True):
     return mv_idx
 
 
+def move_to_sparse_policy(move, is_white_to_move=True):
+    """
+    Returns the sparse policy target of a single move, see policy_to_sparse
+
+    :param move Python chess obj. defining a move
+    :param is_white_to_move: Define the current player turn
+    :return: Sparse policy vector (2 * NB_SPARSE_POLICY,) float32
+    """
+    sparse_policy = np.zeros(2 * NB_SPARSE_POLICY, dtype=np.float32)
+    sparse_policy[:NB_SPARSE_POLICY] = -1
+    sparse_policy[0] = move_to_policy_idx(move, is_white_to_move)
+    sparse_policy[NB_SPARSE_POLICY] = 1
+    return sparse_policy
+
+
+def policy_to_sparse(policy_vec, k=NB_SPARSE_POLICY):
+    """
+    Keeps the k most likely moves of a dense policy, e.g. the visit count distribution of the MCTS.
+    The first k entries are the move indices (-1 for unused entries), the last k entries their
+    renormalized probabilities.
+
+    :param policy_vec: Policy vector (NB_LABELS,)
+    :param k: Number of moves to keep
+    :return: Sparse policy vector (2 * k,) float32
+    """
+    indices = np.argsort(policy_vec)[::-1][:k]
+    probs = policy_vec[indices].astype(np.float32)
+    indices = np.where(probs > 0, indices, -1)
+    probs = np.where(probs > 0, probs, 0)
+    if probs.sum() > 0:
+        probs /= probs.sum()
+    return np.concatenate([indices, probs]).astype(np.float32)
+
+
+def sparse_to_dense_policy(sparse_policies):
+    """
+    Expands a batch of sparse policies to dense policy vectors
+
+    :param sparse_policies: Sparse policies (batch, 2 * k)
+    :return: Dense policies (batch, NB_LABELS) float32
+    """
+    k = sparse_policies.shape[1] // 2
+    indices = sparse_policies[:, :k].astype(np.int64)
+    probs = sparse_policies[:, k:]
+    dense = np.zeros((len(sparse_policies), NB_LABELS + 1), dtype=np.float32)
+    # unused entries (-1) are accumulated in the extra last column, which is cut off
+    rows = np.repeat(np.arange(len(sparse_policies)), k)
+    np.add.at(dense, (rows, indices.ravel()), probs.ravel())
+    return dense[:, :NB_LABELS]
+
+
 def policy_to_move(policy_vec_clean, is_white_to_move=True):
     """
     Returns a python-chess move object based on the given move index
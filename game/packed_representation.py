@@ -0,0 +1,162 @@
+"""
+Compact serialization of a single Bughouse board and a vectorized decoder to the planes of board_to_planes.
+
+A packed board has PACKED_BOARD_BYTES (136) bytes:
+  120 bytes: 15 bitboards of 8 bytes each (12 pieces, 2 promoted masks, en-passant square),
+             little endian like the python-chess bitboards, so square a1 is the lowest bit of the first byte
+  16 bytes: 10 pocket counts, repetitions, colour, castling bits (K, Q, k, q), no progress count,
+            total move count (2 bytes, little endian)
+The board is seen from the player to move (mirrored for black) exactly as in board_to_planes.
+
+A packed board is 64 times smaller than the float32 planes, the planes are only created when a batch is fed to the network.
+"""
+import numpy as np
+
+from game.constants import (
+    BOARD_HEIGHT,
+    BOARD_WIDTH,
+    CHANNEL_MAPPING_CONST,
+    CHANNEL_MAPPING_POS,
+    MAX_NB_MOVES,
+    MAX_NB_NO_PROGRESS,
+    MAX_NB_PRISONERS,
+    NB_CHANNELS_FULL,
+    NB_CHANNELS_POS,
+    chess,
+)
+
+# channels of board_to_planes which only contain 0 and 1 and are stored as bitboards
+BINARY_CHANNELS = list(range(12)) + [CHANNEL_MAPPING_POS["promo"], CHANNEL_MAPPING_POS["promo"] + 1, CHANNEL_MAPPING_POS["ep_square"]]
+NB_PACKED_BITS_BYTES = len(BINARY_CHANNELS) * 8
+NB_PACKED_INT_BYTES = 16
+PACKED_BOARD_BYTES = NB_PACKED_BITS_BYTES + NB_PACKED_INT_BYTES
+
+# offsets in the integer part of a packed board
+POCKETS_OFFSET = 0
+REPETITIONS_OFFSET = 10
+COLOR_OFFSET = 11
+CASTLING_OFFSET = 12
+NO_PROGRESS_OFFSET = 13
+TOTAL_MV_CNT_OFFSET = 14
+
+# bits of every byte value, lowest bit first: (256, 8)
+BYTE_TO_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1)[:, ::-1].copy()
+
+# scale of every channel, same as MATRIX_NORMALIZER
+CHANNEL_NORMALIZER = np.ones(NB_CHANNELS_FULL, dtype=np.float32)
+CHANNEL_NORMALIZER[CHANNEL_MAPPING_POS["prisoners"]:CHANNEL_MAPPING_POS["prisoners"] + 10] = 1 / MAX_NB_PRISONERS
+CHANNEL_NORMALIZER[NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["total_mv_cnt"]] = 1 / MAX_NB_MOVES
+CHANNEL_NORMALIZER[NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["no_progress_cnt"]] = 1 / MAX_NB_NO_PROGRESS
+
+# channels which are filled with one value of the integer part, in the order of the integer part
+CONSTANT_CHANNELS = (list(range(CHANNEL_MAPPING_POS["prisoners"], CHANNEL_MAPPING_POS["prisoners"] + 10))
+                     + [NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["color"],
+                        NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["no_progress_cnt"],
+                        NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["total_mv_cnt"]])
+
+# rook squares of the castling rights from the view of white and black: K, Q, k, q
+CASTLING_SQUARES = {
+    chess.WHITE: [chess.BB_H1, chess.BB_A1, chess.BB_H8, chess.BB_A8],
+    chess.BLACK: [chess.BB_H8, chess.BB_A8, chess.BB_H1, chess.BB_A1],
+}
+
+
+def bitboard_to_bytes(mask, mirror):
+    # reversing the bytes of a bitboard mirrors it vertically
+    return mask.to_bytes(8, "big" if mirror else "little")
+
+
+def board_to_packed(board, board_occ=0, out=None):
+    """
+    Packs a board directly from its bitboards, gives the same planes as board_to_planes after unpacking
+    :param board: Board handle (Python-chess object)
+    :param board_occ: Sets how often the board state has occurred before (by default 0)
+    :param out: optional uint8 array (PACKED_BOARD_BYTES,) which is filled
+    :return: packed board (PACKED_BOARD_BYTES,) uint8
+    """
+    if out is None:
+        out = np.zeros(PACKED_BOARD_BYTES, dtype=np.uint8)
+    us = board.turn
+    mirror = us == chess.BLACK
+
+    bitboards = []
+    for color in (us, not us):
+        for piece_type in chess.PIECE_TYPES:
+            bitboards.append(bitboard_to_bytes(board.pieces_mask(piece_type, color), mirror))
+    for color in (us, not us):
+        bitboards.append(bitboard_to_bytes(board.promoted & board.occupied_co[color], mirror))
+    ep_mask = chess.BB_SQUARES[board.ep_square] if board.ep_square is not None else 0
+    bitboards.append(bitboard_to_bytes(ep_mask, mirror))
+    out[:NB_PACKED_BITS_BYTES] = np.frombuffer(b"".join(bitboards), dtype=np.uint8)
+
+    ints = out[NB_PACKED_BITS_BYTES:]
+    for i, color in enumerate((us, not us)):
+        for p_type in chess.PIECE_TYPES[:-1]:
+            ints[POCKETS_OFFSET + 5 * i + p_type - 1] = board.pockets[color].count(p_type)
+    ints[REPETITIONS_OFFSET] = min(board_occ, 2)
+    ints[COLOR_OFFSET] = 1 if us == chess.WHITE else 0
+    ints[CASTLING_OFFSET] = sum(1 << i for i, square in enumerate(CASTLING_SQUARES[us]) if board.castling_rights & square)
+    ints[NO_PROGRESS_OFFSET] = min(board.halfmove_clock, 255)
+    ints[TOTAL_MV_CNT_OFFSET] = board.fullmove_number & 0xFF
+    ints[TOTAL_MV_CNT_OFFSET + 1] = (board.fullmove_number >> 8) & 0xFF
+    return out
+
+
+def planes_to_packed(planes):
+    """
+    Packs the not normalized, channels first planes of board_to_planes
+    :param planes: (34, 8, 8)
+    :return: packed board (PACKED_BOARD_BYTES,) uint8
+    """
+    packed = np.zeros(PACKED_BOARD_BYTES, dtype=np.uint8)
+    bits = planes[BINARY_CHANNELS].reshape(len(BINARY_CHANNELS), 8, 8).astype(np.uint8)
+    packed[:NB_PACKED_BITS_BYTES] = (bits << np.arange(8, dtype=np.uint8)).sum(axis=2, dtype=np.uint8).ravel()
+
+    ints = packed[NB_PACKED_BITS_BYTES:]
+    prisoners = CHANNEL_MAPPING_POS["prisoners"]
+    ints[POCKETS_OFFSET:POCKETS_OFFSET + 10] = planes[prisoners:prisoners + 10, 0, 0]
+    repetitions = CHANNEL_MAPPING_POS["repetitions"]
+    ints[REPETITIONS_OFFSET] = planes[repetitions, 0, 0] + planes[repetitions + 1, 0, 0]
+    ints[COLOR_OFFSET] = planes[NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["color"], 0, 0]
+    castling = NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["castling"]
+    ints[CASTLING_OFFSET] = sum(int(planes[castling + i, 0, 0]) << i for i in range(4))
+    ints[NO_PROGRESS_OFFSET] = min(int(planes[NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["no_progress_cnt"], 0, 0]), 255)
+    total_mv_cnt = int(planes[NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["total_mv_cnt"], 0, 0])
+    ints[TOTAL_MV_CNT_OFFSET] = total_mv_cnt & 0xFF
+    ints[TOTAL_MV_CNT_OFFSET + 1] = (total_mv_cnt >> 8) & 0xFF
+    return packed
+
+
+def packed_to_planes(packed, normalize=True, channels_last=True):
+    """
+    Expands a batch of packed boards to planes, without a python loop over the boards
+    :param packed: uint8 array (batch, PACKED_BOARD_BYTES)
+    :param normalize: True if the inputs shall be normalized to the range [0.-1.]
+    :return: float32 planes (batch, 8, 8, 34) or (batch, 34, 8, 8)
+    """
+    packed = np.asarray(packed, dtype=np.uint8).reshape(-1, PACKED_BOARD_BYTES)
+    n = len(packed)
+    planes = np.zeros((n, BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL), dtype=np.float32)
+
+    # one byte is one row of a bitboard: (batch, 15, 8 rows, 8 cols) -> (batch, 8, 8, 15)
+    bits = BYTE_TO_BITS[packed[:, :NB_PACKED_BITS_BYTES]].reshape(n, len(BINARY_CHANNELS), BOARD_HEIGHT, BOARD_WIDTH)
+    planes[..., BINARY_CHANNELS] = bits.transpose(0, 2, 3, 1)
+
+    ints = packed[:, NB_PACKED_BITS_BYTES:].astype(np.float32)
+    values = np.concatenate([ints[:, POCKETS_OFFSET:POCKETS_OFFSET + 10],
+                             ints[:, [COLOR_OFFSET, NO_PROGRESS_OFFSET]],
+                             ints[:, [TOTAL_MV_CNT_OFFSET]] + 256 * ints[:, [TOTAL_MV_CNT_OFFSET + 1]]], axis=1)
+    planes[..., CONSTANT_CHANNELS] = values[:, np.newaxis, np.newaxis, :]
+
+    repetitions = CHANNEL_MAPPING_POS["repetitions"]
+    planes[..., repetitions] = (ints[:, REPETITIONS_OFFSET] >= 1)[:, np.newaxis, np.newaxis]
+    planes[..., repetitions + 1] = (ints[:, REPETITIONS_OFFSET] >= 2)[:, np.newaxis, np.newaxis]
+    castling = NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["castling"]
+    castling_bits = BYTE_TO_BITS[packed[:, NB_PACKED_BITS_BYTES + CASTLING_OFFSET], :4]
+    planes[..., castling:castling + 4] = castling_bits[:, np.newaxis, np.newaxis, :]
+
+    if normalize:
+        planes *= CHANNEL_NORMALIZER
+    if not channels_last:
+        planes = planes.transpose(0, 3, 1, 2)
+    return planes
@@ -0,0 +1,59 @@
+"""
+Checks that the packed boards decode to the planes of board_to_planes, run with
+`python -m pytest --import-mode=importlib game/test_packed_representation.py` or `python -m game.test_packed_representation`
+"""
+import random
+
+import numpy as np
+from chess.variant import BughouseBoards
+
+from game.input_representation import board_to_planes
+from game.packed_representation import PACKED_BOARD_BYTES, board_to_packed, packed_to_planes, planes_to_packed
+
+NB_POSITIONS = 2000
+
+
+def random_positions(n, seed=0, max_plies=120):
+    """
+    :return: n boards of random bughouse games, with drops, promotions, en passant and lost castling rights
+    """
+    rng = random.Random(seed)
+    boards = BughouseBoards()
+    positions = []
+    while len(positions) < n:
+        board_number = rng.randrange(2)
+        board = boards.boards[board_number]
+        moves = list(board.legal_moves)
+        if not moves or board.fullmove_number * 2 > max_plies or boards.is_game_over():
+            boards = BughouseBoards()
+            continue
+        move = rng.choice(moves)
+        move.board_id = board_number
+        boards.push(move)
+        positions.append((boards.boards[board_number].copy(), rng.randrange(3)))
+    return positions
+
+
+def test_packed_to_planes_matches_board_to_planes():
+    positions = random_positions(NB_POSITIONS)
+    packed = np.stack([board_to_packed(board, board_occ) for board, board_occ in positions])
+    assert packed.shape == (NB_POSITIONS, PACKED_BOARD_BYTES)
+
+    expected = np.stack([board_to_planes(board, board_occ, normalize=False, channels_last=False) for board, board_occ in positions])
+    np.testing.assert_array_equal(packed_to_planes(packed, normalize=False, channels_last=False), expected)
+
+    # the normalization multiplies by the inverse, board_to_planes divides
+    expected = np.stack([board_to_planes(board, board_occ) for board, board_occ in positions])
+    np.testing.assert_allclose(packed_to_planes(packed), expected, rtol=1e-6)
+
+
+def test_planes_to_packed_matches_board_to_packed():
+    for board, board_occ in random_positions(200, seed=1):
+        planes = board_to_planes(board, board_occ, normalize=False, channels_last=False)
+        np.testing.assert_array_equal(planes_to_packed(planes), board_to_packed(board, board_occ))
+
+
+if __name__ == "__main__":
+    test_packed_to_planes_matches_board_to_planes()
+    test_planes_to_packed_matches_board_to_packed()
+    print("packed representation matches board_to_planes on", NB_POSITIONS, "positions")
@@ -7,6 +7,7 @@ from game.game import Game, GameState
 import random
 import subprocess
 import config
+from util import metrics
 
 from util.xboardInterface import XBoardInterface
 from main import create_and_run_agent
@@ -36,8 +37,11 @@ def playMatches(best_model, new_model, EPISODES, turns_until_high_noise, memory=
 
 
 def play_websocket_game(player, logger, interface, turns_with_high_noise, is_random=False):
-    while interface.color is None:
-        sleep(0.01)
+    with interface.stateChanged:
+        interface.stateChanged.wait_for(lambda: interface.color is not None)
+        # the moves are only sent while the server plays this game
+        game_number = interface.gameNumber
+    first_move_latency = None
 
     env = Game(0)
     state = env.reset()
@@ -46,26 +50,23 @@ def play_websocket_game(player, logger, interface, turns_with_high_noise, is_ran
     done = False
     used_time = 0
     while not done:
-        # wait till game started
-        while not interface.isMyTurn and not interface.done:
-            sleep(0.01)
-        if interface.done:
+        # wait for our turn, the moves played meanwhile come with it
+        xboard_turn = interface.wait_for_turn(game_number)
+        if xboard_turn.done:
             break
         turn_start_time = time.time()
         # perform move of other player
-        if (turn > 0 and interface.color == 'white') or interface.color == 'black':
-            interface.logViaInterfaceType(f"[{player.name}] performing action of opponent {interface.lastMove}")
-            mv = chess.Move.from_uci(interface.lastMove)
+        if xboard_turn.opponent_move is not None:
+            interface.logViaInterfaceType(f"[{player.name}] performing action of opponent {xboard_turn.opponent_move}")
+            mv = chess.Move.from_uci(xboard_turn.opponent_move)
             mv.board_id = 0
             state, value, done, _ = env.step(mv)
             player.play_move(mv, on_partner_board=False)
-            interface.lastMove = ''
-            for move in interface.otherMoves:
-                mv = chess.Move.from_uci(move)
-                mv.board_id = 1
-                state, value, done, _ = env.step(mv)
-                player.play_move(mv, on_partner_board=True)
-            interface.otherMoves = []
+        for move in xboard_turn.partner_moves:
+            mv = chess.Move.from_uci(move)
+            mv.board_id = 1
+            state, value, done, _ = env.step(mv)
+            player.play_move(mv, on_partner_board=True)
         used_time += time.time() - turn_start_time
         turn_start_time = time.time()
         if interface.done or done:
@@ -86,12 +87,19 @@ def play_websocket_game(player, logger, interface, turns_with_high_noise, is_ran
                 action = player.act_nn(state, higher_noise)
             else:
                 action = player.suggest_move(higher_noise)
+                # partner moves which arrived during the search are already in the tree
+                for mv in player.take_streamed_partner_moves():
+                    mv.board_id = 1
+                    state, value, done, _ = env.step(mv)
                 player.play_move(action, on_partner_board=False)
 
         # send message
         lg.logger_model.info(f"move {action} was played by {player.name}")
-        interface.sendAction(action)
-        interface.isMyTurn = False
+        if not interface.sendAction(action, game_number):
+            # the server ended or restarted the game during the search, the env is stale
+            break
+        if turn == 1:
+            first_move_latency = time.time() - interface.turnStartTime
         used_time += time.time() - turn_start_time
 
         # Do the action
@@ -103,6 +111,30 @@ def play_websocket_game(player, logger, interface, turns_with_high_noise, is_ran
         # i.e. -1 if the previous player played a winning move
 
     print(f"[{player.name}] Game finished!")
-    import os
-    import sys
-    os.execl(sys.executable, sys.executable, *sys.argv)
+    if not is_random:
+        logger.info(f"search statistics of the game: {player.game_stats.summary()}")
+        metrics.record_game(player.game_stats, config.run_folder, config.SEARCH_STATS_DUMP)
+    return first_move_latency
+
+
+def play_consecutive_games(player, logger, interface, turns_with_high_noise, is_random=False):
+    """
+    Plays all games the server starts on this connection with the same agent and model.
+    The interface and the agent are reset for every game instead of restarting the process.
+    Logs the time from getting the first turn to sending the first move of every game.
+    """
+    games_played = 0
+    latencies = []
+    while True:
+        games_played = interface.wait_for_game(games_played)
+
+        first_move_latency = play_websocket_game(player, logger, interface, turns_with_high_noise, is_random)
+        if first_move_latency is None:
+            continue
+        if games_played > 1:
+            latencies.append(first_move_latency)
+        message = f"[{player.name}] game {games_played}: time to first move {first_move_latency:.3f}s"
+        if latencies:
+            message += f" (mean of the games after the first: {sum(latencies) / len(latencies):.3f}s)"
+        print(message)
+        logger.info(message)
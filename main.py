@@ -1,11 +1,12 @@
+import time
+START_TIME = time.time()
+
 import subprocess
 import os
 import sys
 import signal
 import _thread
 import numpy as np
-import tensorflow as tf
-from tensorflow.python.keras.backend import set_session
 
 from time import sleep
 
@@ -14,8 +15,9 @@ from new_agent import Agent as new_agent
 import config
 import game_play
 from game.game import Game
-from self_play_training import self_play
 import util.nn_interface as nni
+from util import model_registry
+from util import trace
 from util import logger as lg
 from util.xboardInterface import XBoardInterface
 
@@ -39,36 +41,52 @@ ASCII-Art: Joan Stark
 """
 
 
-def load_model():
-    sess = tf.Session()
-    graph = tf.get_default_graph()
-    set_session(sess)
+def log_startup(name, phase, phase_start):
+    """
+    Prints how long a phase of the startup took and the time since the process started
+    """
+    now = time.time()
+    message = f"[startup][{name}] {phase}: {now - phase_start:.3f}s (since start {now - START_TIME:.3f}s)"
+    print(message)
+    lg.logger_main.info(message)
+    return now
+
+
+def load_model(name="main"):
+    # TensorFlow is imported here and not at the top, so the engine can answer the xboard handshake before it is loaded
+    phase_start = time.time()
+    import tensorflow as tf
+    phase_start = log_startup(name, "import tensorflow", phase_start)
 
-    model = nni.load_nn(config.INITIAL_MODEL_PATH,
-                        save_weights_bool=True, load_weights=True)
-    return model, [graph, sess]
+    # all agents of the process share one model, only the first agent loads it
+    model, model_extra = model_registry.get_model(config.INITIAL_MODEL_PATH, config.USE_INFERENCE_GRAPH)
+    log_startup(name, "load model", phase_start)
+    return model, model_extra
 
 
 def create_and_run_random(name, env, interfaceType="websocket", server_address=""):
     interface = XBoardInterface(name, interfaceType, server_address)
-    agent1 = Agent(name, env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, None, interface, None)
+    agent1 = new_agent(name, env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, None, interface, None)
 
-    while not interface.gameStarted:
-        sleep(0.1)
-
-    game_play.play_websocket_game(agent1, lg.logger_main, interface,
-                                  config.TURNS_WITH_HIGH_NOISE, is_random=True)
+    game_play.play_consecutive_games(agent1, lg.logger_main, interface,
+                                     config.TURNS_WITH_HIGH_NOISE, is_random=True)
 
 
 def create_and_run_agent(name, env, interfaceType="websocket", server_address=""):
-    model, model_extra = load_model()
+    # connect first, the interface answers the handshake and collects the game start while the model loads
+    phase_start = time.time()
     interface = XBoardInterface(name, interfaceType, server_address)
+    log_startup(name, "connect interface", phase_start)
+    run_agent(name, env, interface)
+
+
+def run_agent(name, env, interface):
+    model, model_extra = load_model(name)
     #agent1 = Agent(name, env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, model, interface, model_extra)
     agent1 = new_agent(name, env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, model, interface, model_extra)
-    while not interface.gameStarted:
-        sleep(0.1)
 
-    game_play.play_websocket_game(agent1, lg.logger_main, interface, config.TURNS_WITH_HIGH_NOISE)
+    # the model and the connection are kept for all games, play_consecutive_games resets the game state
+    game_play.play_consecutive_games(agent1, lg.logger_main, interface, config.TURNS_WITH_HIGH_NOISE)
 
 
 def main(agent_threads, start_server, server_address):
@@ -80,8 +98,10 @@ def main(agent_threads, start_server, server_address):
 
     #### If we want to learn instead of playing (NOT FINISHED) ####
     if agent_threads == 0:
+        from self_play_training import model_version_path, self_play
         new_best_model, version = self_play(env)
-        nni.save_nn(f"run/models/{version}", new_best_model)
+        # the path of the promoted models, read by the model registry
+        nni.save_nn(model_version_path(version), new_best_model)
 
     #### If the server is running, create clients as threads and connect them to the websocket interface ####
     elif agent_threads != -1:
@@ -93,6 +113,12 @@ def main(agent_threads, start_server, server_address):
 
             server = subprocess.Popen(["node", "index.js"], cwd="../tinyChessServer", stdout=subprocess.PIPE)
 
+        elif config.ASYNC_CLIENT:
+            # all seats share one event loop for the connections, the games run in its executor
+            from util import async_client
+            names = ["TandemTurtle"] if agent_threads == 1 else ["Agent " + str(i) for i in range(agent_threads)]
+            async_client.run(names, server_address, lambda name, interface: run_agent(name, env, interface))
+
         else:
             for i in range(0, agent_threads):
                 name = "TandemTurtle"
@@ -119,9 +145,8 @@ def main(agent_threads, start_server, server_address):
 
 
 if __name__ == "__main__":
-
-    c = tf.ConfigProto()
-    c.gpu_options.per_process_gpu_memory_fraction = 0.45
+    log_startup("main", "imports", START_TIME)
+    trace.open_from_config()
 
     agent_threads = config.GAME_AGENT_THREADS
     start_server = config.SERVER_AUTOSTART
@@ -129,6 +154,12 @@ if __name__ == "__main__":
     game_id = config.GAMEID
     tournament_id = config.TOURNAMENTID
 
+    # --profile runs the whole session under the sampling profiler (util/profiler.py)
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        from util import profiler
+        profiler.start(config.run_folder + "profiles", config.PROFILE_INTERVAL, config.PROFILE_FLUSH_INTERVAL)
+
     mode = 'auto-4'
     if len(sys.argv) == 4:
         mode = str(sys.argv[1])
@@ -10,6 +10,17 @@ from game import constants as game_constants, output_representation
 import config as cf
 
 
+def legal_move_mask(state):
+    """
+    :return: 1 for the policy index of every legal move of the state, 0 otherwise (NB_LABELS,)
+    """
+    allowedActions_idxs = [output_representation.move_to_policy_idx(move, is_white_to_move=state.board.turn)
+                           for move in state.allowedActions]
+    legal_moves = np.zeros(game_constants.NB_LABELS)
+    legal_moves[allowedActions_idxs] = 1
+    return legal_moves
+
+
 class DummyNode(object):
     """A fake node of a MCTS search tree.
 
@@ -46,13 +57,14 @@ class MCTSNode(object):
         self.state = state
         self.is_expanded = False
         self.losses_applied = 0  # number of virtual losses on this node
+        # counts the partner moves applied to the state (see update_state), a child with another count than its parent
+        # is refreshed when it is selected
+        self.partner_generation = parent.partner_generation if isinstance(parent, MCTSNode) else 0
+        # set for an expanded node which got new legal moves, the next evaluation only replaces its prior
+        self.needs_prior = False
+        self.subtree_nodes = 1  # nodes in the subtree of this node, including it, counted by select_leaf
 
-        allowedActions_idxs = [output_representation.move_to_policy_idx(move, is_white_to_move=self.state.board.turn)
-                               for move in self.state.allowedActions]
-        legal_moves = np.zeros(n)
-        legal_moves[allowedActions_idxs] = 1
-
-        self.illegal_moves = 1 - legal_moves
+        self.illegal_moves = 1 - legal_move_mask(self.state)
 
         # using child_() allows vectorized computation of action score.
         self.child_N = np.zeros(n, dtype=np.float32)
@@ -109,14 +121,20 @@ class MCTSNode(object):
 
     def select_leaf(self):
         current = self
+        path = [self]
 
         while True:
             # if a node has never been evaluated, we have no basis to select a child.
-            if not current.is_expanded:
+            if not current.is_expanded or current.needs_prior:
                 break
 
             best_move = np.argmax(current.child_action_score)
+            if best_move not in current.children:
+                # the new node is counted on its path, so the size of the tree needs no walk
+                for node in path:
+                    node.subtree_nodes += 1
             current = current.maybe_add_child(best_move)
+            path.append(current)
         return current
 
     def maybe_add_child(self, fcoord):
@@ -126,7 +144,45 @@ class MCTSNode(object):
             new_position, value, done = self.state.take_action(move)
 
             self.children[fcoord] = MCTSNode(new_position, fmove=fcoord, parent=self)
-        return self.children[fcoord]
+        child = self.children[fcoord]
+        if child.partner_generation != self.partner_generation:
+            child.refresh_state()
+        return child
+
+    def refresh_state(self):
+        """
+        Takes over the partner moves which were applied to the parent after this node was created
+        """
+        move = output_representation.policy_idx_to_move(self.fmove, self.parent.state.board.turn, self.parent.state.board.board_id)
+        new_moves = self.update_state(self.parent.state.take_action(move)[0])
+        self.partner_generation = self.parent.partner_generation
+        if self.is_expanded and new_moves.any():
+            self.needs_prior = True
+
+    def update_state(self, state):
+        """
+        Replaces the state by the same position after moves on the partner board, which can add pieces to
+        the pockets of this board. The statistics and the children are kept. The children take over the new
+        state when they are selected the next time (refresh_state), an expanded child with new legal moves,
+        e.g. drops of the transferred pieces, is then evaluated again for its prior.
+        :return: mask of the moves which became legal
+        """
+        illegal_moves = 1 - legal_move_mask(state)
+        new_moves = (self.illegal_moves == 1) & (illegal_moves == 0)
+        self.state = state
+        self.illegal_moves = illegal_moves
+        self.partner_generation += 1
+        return new_moves
+
+    def update_prior(self, move_probabilities):
+        """
+        Replaces the prior of an expanded node by a new evaluation, visit counts and values are kept
+        """
+        move_probs = move_probabilities * (1 - self.illegal_moves)
+        scale = np.sum(move_probs)
+        if scale > 0:
+            move_probs = move_probs / scale
+        self.original_prior = self.child_prior = move_probs
 
     def add_virtual_loss(self, up_to):
         """Propagate a virtual loss up to the root node.
@@ -158,6 +214,13 @@ class MCTSNode(object):
         # directly call backup_value() on the result of the game.
         assert not self.state.isEndGame
 
+        # a refreshed node keeps its statistics, only the prior covers the new moves
+        if self.needs_prior:
+            self.needs_prior = False
+            self.update_prior(move_probabilities)
+            self.backup_value(value, up_to=up_to)
+            return
+
         # If a node was picked multiple times (despite vlosses), we shouldn't
         # expand it more than once.
         if self.is_expanded:
@@ -371,12 +434,13 @@ class MCTS:
                         np.sqrt((parent_visits) / (1 + edge.stats['node_visits']))
                     Q = edge.stats['node_average_evaluation']
 
-                    lg.logger_mcts.info(
-                        'action: %s ... node_visits = %d, action_probability = %f, node_total_evaluation = %f, node_average_evaluation = %f, U = %f, Q+U = %f',
-                        action,
-                        edge.stats['node_visits'], np.round(edge.stats['action_probability'], 6),
-                        np.round(edge.stats['node_total_evaluation'], 6), np.round(Q, 6), np.round(U, 6),
-                        np.round(Q + U, 6))
+                    if not lg.logger_mcts.disabled:
+                        lg.logger_mcts.info(
+                            'action: %s ... node_visits = %d, action_probability = %f, node_total_evaluation = %f, node_average_evaluation = %f, U = %f, Q+U = %f',
+                            action,
+                            edge.stats['node_visits'], np.round(edge.stats['action_probability'], 6),
+                            np.round(edge.stats['node_total_evaluation'], 6), np.round(Q, 6), np.round(U, 6),
+                            np.round(Q + U, 6))
 
                     if Q + U > maxQU:
                         maxQU = Q + U
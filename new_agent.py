@@ -5,13 +5,17 @@ trained model. The evaluation is done by a hard-coded evaluation function as def
 """
 import time
 
+import chess
 import numpy as np
 import random
 import mcts
 from game import input_representation, output_representation
+from game.constants import BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL
 from util import logger as lg
+from util.metrics import GameStats, SearchStats
+from util.trace import tracer
+import util.nn_interface as nni
 import config
-from tensorflow.python.keras.backend import set_session
 
 
 class Agent():
@@ -46,6 +50,13 @@ class Agent():
         self.model_extra = model_extra
 
         self.interface = interface
+        # partner moves which were played on the tree during the search, the game loop still has to play them
+        self.streamed_partner_moves = []
+        # id of the running search in the trace
+        self.trace_search = 0
+        # counters of the running search and of the moves of the game
+        self.search_stats = None
+        self.game_stats = GameStats(name)
 
         # to plot value_head and policy_head loss later
         self.train_overall_loss = []
@@ -62,6 +73,12 @@ class Agent():
         incorporate_results, and pick_move
         """
         start = time.time()
+        stats = self.search_stats = SearchStats()
+        stats.reused_visits = int(self.root.N)
+        # the nodes kept from the last search are evaluated already
+        stats.cache_hits = self.root.subtree_nodes if self.root.is_expanded else 0
+        if tracer.enabled:
+            self.trace_search = tracer.search_start(self.name, self.root)
         # expand root if not expanded yet
         if not self.root.is_expanded:
             prob, val = self.get_preds([self.root.state])
@@ -69,13 +86,25 @@ class Agent():
 
         if self.timed_match:
             while time.time() - start < self.seconds_per_move:
+                self.poll_partner_moves()
                 self.tree_search()
         else:
             current_readouts = self.root.N
             while self.root.N < current_readouts + self.MCTSsimulations:
+                self.poll_partner_moves()
                 self.tree_search()
 
-        return self.pick_move(higher_noise)  # TODO reimplement setting of high noise
+        move = self.pick_move(higher_noise)  # TODO reimplement setting of high noise
+        if tracer.enabled:
+            tracer.search_end(self.trace_search, self.root, move)
+
+        stats.readouts = int(self.root.N) - stats.reused_visits
+        stats.tree_nodes = self.root.subtree_nodes
+        stats.time_total = time.time() - start
+        self.search_stats = None
+        self.game_stats.add(stats)
+        lg.logger_main.info(f"[{self.name}] search for {move}: {stats.summary()}")
+        return move
 
     def play_move(self, move, on_partner_board):
         """Notable side effects:
@@ -86,17 +115,51 @@ class Agent():
         if not on_partner_board:
             move.board_id = self.root.state.board.board_id
             fmove = output_representation.move_to_policy_idx(move, is_white_to_move=self.root.state.board.turn)
+            searched_child = fmove in self.root.children
+            new_state = self.root.state.take_action(move)[0] if searched_child else None
             self.root = self.root.maybe_add_child(fmove)
             del self.root.parent.children
+            # the child may have been created before the last partner moves
+            if searched_child and self.root.state.boards.fen() != new_state.boards.fen():
+                self.update_root_state(new_state)
         else:
             move.board_id = self.root.state.partner_board.board_id
             new_state, _, _ = self.root.state.take_action(move)
-            self.build_mcts(new_state)
+            self.update_root_state(new_state)
 
         self.state = self.root.state
 
         return True  # GTP requires positive result.
 
+    def update_root_state(self, state):
+        """
+        Moves the root to the state after partner moves without rebuilding the tree.
+        If pieces arrived in our pockets, the new drops become legal and the root prior is evaluated again.
+        The nodes below the root take over the new pockets when the search selects them (MCTSNode.refresh_state).
+        """
+        new_moves = self.root.update_state(state)
+        if self.root.is_expanded and new_moves.any() and self.model is not None:
+            prob, _ = self.get_preds([state])
+            self.root.update_prior(prob[0])
+
+    def poll_partner_moves(self):
+        """
+        Plays the partner moves which arrived at the interface on the tree, also while searching
+        """
+        if self.interface is None:
+            return
+        for uci in self.interface.take_partner_moves():
+            mv = chess.Move.from_uci(uci)
+            self.play_move(mv, on_partner_board=True)
+            self.streamed_partner_moves.append(mv)
+
+    def take_streamed_partner_moves(self):
+        """
+        :return: the partner moves played by poll_partner_moves since the last call
+        """
+        moves, self.streamed_partner_moves = self.streamed_partner_moves, []
+        return moves
+
     def pick_move(self, higher_noise):
         """Picks a move to play, based on MCTS readout statistics.
 
@@ -113,6 +176,25 @@ class Agent():
         return move
 
     def tree_search(self, parallel_readouts=None):
+        stats = self.search_stats
+        select_start = time.perf_counter()
+        leaves = self.select_leaves(parallel_readouts)
+        if stats is not None:
+            stats.time_select += time.perf_counter() - select_start
+        if leaves:
+            move_probs, values = self.get_preds([leaf.state for leaf in leaves])
+            backup_start = time.perf_counter()
+            self.incorporate_leaves(leaves, move_probs, values)
+            if stats is not None:
+                stats.time_backup += time.perf_counter() - backup_start
+        return leaves
+
+    def select_leaves(self, parallel_readouts=None):
+        """
+        Selection half of tree_search: walks the tree until parallel_readouts leaves with virtual loss are collected.
+        Terminal leaves are backed up directly and not returned.
+        The caller evaluates the returned leaves and passes the results to incorporate_leaves.
+        """
         if parallel_readouts is None:
             parallel_readouts = min(config.PARALLEL_READOUTS, self.MCTSsimulations)
         leaves = []
@@ -125,35 +207,35 @@ class Agent():
             if leaf.is_done():
                 value = 1 if leaf.state.value[0] > 0 else -1
                 leaf.backup_value(value, up_to=self.root)
+                if self.search_stats is not None:
+                    self.search_stats.terminal_leaves += 1
+                if tracer.enabled:
+                    tracer.leaf(self.trace_search, leaf, self.root, value, terminal=True)
                 continue
             leaf.add_virtual_loss(up_to=self.root)
             leaves.append(leaf)
-        if leaves:
-            move_probs, values = self.get_preds([leaf.state for leaf in leaves])
-            for leaf, move_prob, value in zip(leaves, move_probs, values):
-                leaf.revert_virtual_loss(up_to=self.root)
-                leaf.incorporate_results(move_prob, value, up_to=self.root)
         return leaves
 
+    def incorporate_leaves(self, leaves, move_probs, values):
+        for leaf, move_prob, value in zip(leaves, move_probs, values):
+            leaf.revert_virtual_loss(up_to=self.root)
+            leaf.incorporate_results(move_prob, value, up_to=self.root)
+        if tracer.enabled:
+            for leaf, value in zip(leaves, values):
+                tracer.leaf(self.trace_search, leaf, self.root, value)
+
     def get_preds(self, states):
         # predict the leaf
-        inputs1 = []
-        inputs2 = []
-        for state in states:
-            board = state.board
-            partner_board = state.partner_board
-
-            x1 = input_representation.board_to_planes(board)
-            x1 = np.expand_dims(x1, axis=0)
-            x2 = input_representation.board_to_planes(partner_board)
-            x2 = np.expand_dims(x2, axis=0)
-            inputs1.append(x1)
-            inputs2.append(x2)
-
-        inputs = {"input_1": np.concatenate(inputs1), "input_2": np.concatenate(inputs2)}
-        with self.model_extra[0].as_default():
-            set_session(self.model_extra[1])
-            predictions = self.model.predict(inputs)
+        planes_start = time.perf_counter()
+        inputs = states_to_inputs(states)
+        predict_start = time.perf_counter()
+        predictions = nni.predict(self.model, self.model_extra, inputs)
+        stats = self.search_stats
+        if stats is not None:
+            stats.time_planes += predict_start - planes_start
+            stats.time_predict += time.perf_counter() - predict_start
+            stats.nn_batches += 1
+            stats.nn_positions += len(states)
 
         # value head should be one value to say how good my state is
         value_head = predictions[0]
@@ -213,6 +295,22 @@ class Agent():
 
         lg.logger_mcts.info('****** BUILDING NEW MCTS TREE FOR AGENT %s ******', self.name)
         self.root = mcts.MCTSNode(state)
+        self.streamed_partner_moves = []
+        self.game_stats = GameStats(self.name)
         self.result = 0
         self.result_string = None
         self.comments = []
+
+
+def states_to_inputs(states):
+    """
+    Converts a list of game states into the network input dict (own board and partner board planes)
+    :param states: list of GameStates
+    :return: {"input_1": (n, 8, 8, 34), "input_2": (n, 8, 8, 34)}
+    """
+    inputs1 = np.empty((len(states), BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL), dtype=np.float32)
+    inputs2 = np.empty((len(states), BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL), dtype=np.float32)
+    for i, state in enumerate(states):
+        inputs1[i] = input_representation.board_to_planes(state.board)
+        inputs2[i] = input_representation.board_to_planes(state.partner_board)
+    return {"input_1": inputs1, "input_2": inputs2}
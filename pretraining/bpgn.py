@@ -0,0 +1,208 @@
+"""
+Streaming parser for the bughouse pgn files (.bpgn) of the FICS database.
+
+chess.pgn.read_game builds a full game tree and checks every move while reading. This parser only tokenizes:
+it reads the file line by line and yields one BpgnGame per game with the headers and the move sequence.
+A move token looks like `12B. Nxf7{87.312}`: move number, board (A/B, uppercase for white, lowercase for black),
+the SAN of the move and the remaining clock time of the player.
+The moves are only converted to python-chess moves in replay(), if positions are needed.
+
+Run `python bpgn.py <file.bpgn>` to compare the throughput with chess.pgn.read_game.
+"""
+import codecs
+import collections
+import re
+import sys
+import time
+
+import chess
+import chess.pgn
+from chess.variant import BughouseBoards
+
+HEADER_RE = re.compile(r'\[(\w+)\s+"([^"]*)"\]')
+# a move with an optional clock comment, a comment, or a game result
+TOKEN_RE = re.compile(r'(\d+)([AaBb])\.\s*([^\s{}]+)\s*(?:\{([^}]*)\})?|\{([^}]*)\}|(1-0|0-1|1/2-1/2|\*)')
+
+##########
+# number - move number
+# board - 0 for board A, 1 for board B
+# color - chess.WHITE or chess.BLACK
+# san - move in standard algebraic notation, drops are written as N@f3
+# time - remaining time on the clock in seconds, None if missing
+##########
+BpgnMove = collections.namedtuple("BpgnMove", ["number", "board", "color", "san", "time"])
+
+
+class BpgnGame:
+    def __init__(self, headers, moves, comments, result):
+        self.headers = headers
+        self.moves = moves
+        self.comments = comments
+        self.result = result
+
+
+def parse_movetext(movetext):
+    """
+    :return: moves, comments and the result found in the movetext
+    """
+    moves = []
+    comments = []
+    result = None
+    for match in TOKEN_RE.finditer(movetext):
+        number, board, san, clock, comment, game_result = match.groups()
+        if san is not None:
+            try:
+                clock = float(clock) if clock is not None else None
+            except ValueError:
+                comments.append(clock)
+                clock = None
+            moves.append(BpgnMove(int(number), 0 if board in "Aa" else 1, chess.WHITE if board.isupper() else chess.BLACK, san, clock))
+        elif comment is not None:
+            comments.append(comment)
+        else:
+            result = game_result
+    return moves, comments, result
+
+
+def read_games(f):
+    """
+    Generator over all games of an open .bpgn file
+    """
+    headers = {}
+    movetext = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("["):
+            if movetext:
+                yield make_game(headers, movetext)
+                headers = {}
+                movetext = []
+            header = HEADER_RE.match(line)
+            if header:
+                headers[header.group(1)] = header.group(2)
+        else:
+            movetext.append(line)
+    if headers or movetext:
+        yield make_game(headers, movetext)
+
+
+def make_game(headers, movetext):
+    moves, comments, result = parse_movetext(" ".join(movetext))
+    if result is None:
+        result = headers.get("Result", "*")
+    return BpgnGame(headers, moves, comments, result)
+
+
+def read_file(path):
+    with codecs.open(path, encoding="utf-8-sig", errors='ignore') as f:
+        yield from read_games(f)
+
+
+def scan_headers(path):
+    """
+    Reads only the headers of the games in a file, the movetext is skipped without tokenizing it
+    :return: generator over (byte offset of the game, length in bytes, headers)
+    """
+    offset = 0
+    start = 0
+    headers = {}
+    in_movetext = False
+    with open(path, "rb") as f:
+        for line in f:
+            if offset == 0 and line.startswith(codecs.BOM_UTF8):
+                offset = len(codecs.BOM_UTF8)
+                line = line[offset:]
+            if line.startswith(b"["):
+                if in_movetext:
+                    yield start, offset - start, headers
+                    headers = {}
+                    in_movetext = False
+                if not headers:
+                    start = offset
+                header = HEADER_RE.match(line.decode("utf-8", errors="ignore").strip())
+                if header:
+                    headers[header.group(1)] = header.group(2)
+            elif line.strip():
+                in_movetext = True
+            offset += len(line)
+    if headers or in_movetext:
+        yield start, offset - start, headers
+
+
+def read_game_at(f, offset, length):
+    """
+    Reads the game at the byte offset of scan_headers
+    :param f: file opened in binary mode
+    """
+    f.seek(offset)
+    text = f.read(length).decode("utf-8-sig", errors="ignore")
+    return next(read_games(text.splitlines()))
+
+
+def replay(game):
+    """
+    Plays the moves of a game on BughouseBoards.
+    Like chess.pgn.read_game the game is cut at the first move that can not be parsed.
+    :return: generator over (boards before the move, move)
+    """
+    boards = BughouseBoards()
+    for bpgn_move in game.moves:
+        board = boards.boards[bpgn_move.board]
+        if board.turn != bpgn_move.color:
+            return
+        try:
+            move = board.parse_san(bpgn_move.san)
+        except ValueError:
+            return
+        move.board_id = bpgn_move.board
+        yield boards, move
+        boards.push(move)
+
+
+def benchmark(path, max_games=2000):
+    """
+    Compares the games per second of chess.pgn.read_game with this parser, with and without replaying the moves
+    """
+    def run_read_game():
+        n = 0
+        with codecs.open(path, encoding="utf-8-sig", errors='ignore') as f:
+            game = chess.pgn.read_game(f)
+            while game and n < max_games:
+                for _ in game.mainline_moves():
+                    pass
+                n += 1
+                game = chess.pgn.read_game(f)
+        return n
+
+    def run_tokenize():
+        n = 0
+        for _ in read_file(path):
+            n += 1
+            if n == max_games:
+                break
+        return n
+
+    def run_replay():
+        n = 0
+        for game in read_file(path):
+            for _ in replay(game):
+                pass
+            n += 1
+            if n == max_games:
+                break
+        return n
+
+    results = {}
+    for name, run in [("chess.pgn.read_game", run_read_game), ("bpgn tokenize", run_tokenize), ("bpgn tokenize + replay", run_replay)]:
+        start = time.time()
+        n = run()
+        seconds = time.time() - start
+        results[name] = n / max(seconds, 1e-9)
+        print("%-24s %6i games in %7.2fs: %9.1f games/s" % (name, n, seconds, results[name]))
+    return results
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1])
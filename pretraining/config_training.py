@@ -4,6 +4,10 @@ EPOCHS = 20
 # Number of samples to take from whole set (1_342_846_339)
 N_SAMPLES = 5_120
 SHUFFLE_BUFFER_SIZE = 5000
+SHARD_SIZE = 1_000_000  # samples per binary shard
+SHARD_FOLDER = "data/shards/"  # binary shards are used for training if this folder exists
+SHARD_READERS = 4  # shard files / generators read in parallel by the input pipeline
+AUGMENT = False  # random colour swap and file mirror of the training batches (load_datasets.augment)
 
 REG_CONST = 0.0001
 LEARNING_RATE = 0.1
@@ -1,14 +1,19 @@
 import codecs
 import csv
 import gzip
+import json
 import multiprocessing
 import os
 import re
+import sys
+import time
 import numpy as np
 from multiprocessing import Process, Queue
-import chess.pgn
 import progressbar
 
+import bpgn
+import game_index
+
 
 def find_files(in_dir="../database_extraction/data/"):
     files = []
@@ -86,51 +91,41 @@ def statistics(files):
     return averageElos, elos, times
 
 
-def parse_file(file, writerQueue, elolimit):
-    with codecs.open(file, encoding="utf-8-sig", errors='ignore') as f:
-        game = chess.pgn.read_game(f)
-        while game:
-            boards = game.board()
-            result = game.headers["Result"]
-            if not result == "*":
-                if result == '0-1':
-                    label = "-1"
-                elif result == '1-0':
-                    label = "1"
-                else:
-                    label = "0"
-                elos = []
-                try:
-                    elos.append(int(game.headers["WhiteA"].split('"')[-1]))
-                    elos.append(int(game.headers["BlackA"].split('"')[-1]))
-                    elos.append(int(game.headers["WhiteB"].split('"')[-1]))
-                    elos.append(int(game.headers["BlackB"].split('"')[-1]))
-                    mean_elo = np.mean(elos)
-                except:
-                    mean_elo = 0
-                if mean_elo >= elolimit:
-                    for move in game.mainline_moves():
-                        writerQueue.put([boards.fen, label, str(move)])
-                        boards.push(move)
-
-            game = chess.pgn.read_game(f)
-
-
-def feed_files(workerQueue, in_dir="../database_extraction/data/"):
-    for r, d, f in os.walk(in_dir):
-        for file in f:
-            if '.bpgn' in file and ".bz2" not in file:
-                path = os.path.join(r, file)
-                workerQueue.put(path)
+def file_samples(path, entries):
+    """
+    Generator over the samples [fen, label, move, game id] of the games of one file
+    :param entries: index entries of the games (see game_index.py)
+    """
+    for game, entry in zip(game_index.read_games(path, entries), entries):
+        if entry["result"] == 1:
+            label = "1"
+        elif entry["result"] == -1:
+            label = "-1"
+        else:
+            label = "0"
+        game_id = game_index.game_id(entry)
+        for boards, move in bpgn.replay(game):
+            yield [boards.fen(), label, str(move), game_id]
+
+
+def parse_file(job, writerQueue):
+    path, entries = job
+    for sample in file_samples(path, entries):
+        writerQueue.put(sample)
+
+
+def feed_files(workerQueue, jobs):
+    for job in jobs:
+        workerQueue.put(job)
 
 
-def worker(workerQueue, writerQueue, elolimit):
+def worker(workerQueue, writerQueue):
     while True:
         try:
-            file = workerQueue.get(block=False)
-            print("start parsing %s" % file)
-            parse_file(file, writerQueue, elolimit)
-            print("%s done" % file)
+            job = workerQueue.get(block=False)
+            print("start parsing %s" % job[0])
+            parse_file(job, writerQueue)
+            print("%s done" % job[0])
         except:
             break
 
@@ -151,10 +146,21 @@ def write(queue, fname):
                 break
 
 
+def select_games(in_dir, out_dir, percentile, max_workers=None):
+    """
+    Builds (or reuses) the header index of all files in in_dir and selects the games above the Elo percentile
+    :return: elolimit, list of (path, index entries) with the selected games of each file
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    index = game_index.build_index(find_files(in_dir), os.path.join(out_dir, "games.index.npz"), max_workers)
+    elolimit = index.elo_limit(percentile)
+    selected = index.select(elolimit)
+    print("elo limit %.1f: %i of %i games" % (elolimit, len(selected), len(index)))
+    return elolimit, list(selected.by_file().items())
+
+
 def create_dataset(in_dir="../database_extraction/data/", out_dir="data/", percentile=90, max_workers=None):
-    files = find_files(in_dir)
-    averageElos, elos, times = statistics(files)
-    elolimit = np.percentile(averageElos, percentile)
+    elolimit, jobs = select_games(in_dir, out_dir, percentile, max_workers)
 
     nworkers = multiprocessing.cpu_count()
     if max_workers:
@@ -164,8 +170,8 @@ def create_dataset(in_dir="../database_extraction/data/", out_dir="data/", perce
 
     workerQueue = Queue()
     writerQueue = Queue()
-    feedProc = Process(target=feed_files, args=(workerQueue, in_dir))
-    calcProc = [Process(target=worker, args=(workerQueue, writerQueue, elolimit)) for i in range(nworkers)]
+    feedProc = Process(target=feed_files, args=(workerQueue, jobs))
+    calcProc = [Process(target=worker, args=(workerQueue, writerQueue)) for i in range(nworkers)]
     writProc = Process(target=write, args=(writerQueue, fname))
 
     feedProc.start()
@@ -179,6 +185,112 @@ def create_dataset(in_dir="../database_extraction/data/", out_dir="data/", perce
     writProc.join()
 
 
-files = find_files("../database_extraction/data/")
-# statistics(files)
-create_dataset()
+def assign_jobs(jobs, nworkers):
+    """
+    Distributes the files over the workers, the files with the most selected data first to the worker with the least data.
+    The assignment only depends on the index, so the same input always gives the same shards.
+    :param jobs: list of (path, index entries)
+    :return: list of job lists, one per worker
+    """
+    assignment = [[] for _ in range(nworkers)]
+    loads = [0] * nworkers
+    for path, entries in sorted(jobs, key=lambda job: (-int(job[1]["length"].sum()), job[0])):
+        worker_id = loads.index(min(loads))
+        assignment[worker_id].append((path, entries))
+        loads[worker_id] += int(entries["length"].sum())
+    return assignment
+
+
+def shard_name(out_dir, prefix, worker_id, nworkers):
+    return os.path.join(out_dir, "%s-%03i-of-%03i.csv.gz" % (prefix, worker_id, nworkers))
+
+
+def binary_shard_name(worker_id):
+    return lambda out_dir, shard_number: os.path.join(out_dir, "shard-w%03i-%05i.bin" % (worker_id, shard_number))
+
+
+def shard_worker(worker_id, jobs, out_path, binary, resultQueue):
+    """
+    Parses its own files and writes all samples directly into its shard.
+    With binary, out_path is the shard folder and the worker writes pre-encoded binary shards (see shards.py) instead of a gzip csv.
+    """
+    start = time.time()
+    n_samples = 0
+    if binary:
+        import shards
+        writer = shards.ShardWriter(out_path, path_fn=binary_shard_name(worker_id))
+        write_sample = lambda sample: shards.row_to_record(sample, writer.next_record())
+    else:
+        f = gzip.open(out_path, 'wt')
+        csv_writer = csv.writer(f, delimiter=';')
+        write_sample = csv_writer.writerow
+
+    for i, (path, entries) in enumerate(jobs):
+        for sample in file_samples(path, entries):
+            write_sample(sample)
+            n_samples += 1
+        print("worker %i: %i/%i files, %i samples, %.0f samples/s" % (worker_id, i + 1, len(jobs), n_samples,
+                                                                       n_samples / max(time.time() - start, 1e-6)))
+
+    if binary:
+        writer.close()
+        paths = writer.paths
+    else:
+        f.close()
+        paths = [out_path]
+    resultQueue.put({"worker": worker_id, "paths": paths, "files": [path for path, _ in jobs], "games": sum(len(entries) for _, entries in jobs),
+                     "samples": n_samples, "seconds": time.time() - start})
+
+
+def create_dataset_sharded(in_dir="../database_extraction/data/", out_dir="data/", percentile=90, max_workers=None, binary=False):
+    """
+    Like create_dataset, but every worker parses a fixed subset of the files and writes its own shard,
+    so there is no single writer process. A manifest with the shards and their sample counts is written at the end.
+    :param binary: write binary shards (see shards.py) into out_dir + "shards/" instead of gzip csv files
+    :return: manifest dict
+    """
+    elolimit, jobs = select_games(in_dir, out_dir, percentile, max_workers)
+
+    nworkers = multiprocessing.cpu_count()
+    if max_workers:
+        nworkers = min(nworkers, max_workers)
+    nworkers = max(1, min(nworkers, len(jobs)))
+
+    prefix = "data_top_%i" % (100 - percentile)
+
+    start = time.time()
+    resultQueue = Queue()
+    procs = []
+    for worker_id, worker_jobs in enumerate(assign_jobs(jobs, nworkers)):
+        out_path = os.path.join(out_dir, "shards/") if binary else shard_name(out_dir, prefix, worker_id, nworkers)
+        procs.append(Process(target=shard_worker, args=(worker_id, worker_jobs, out_path, binary, resultQueue)))
+    for p in procs:
+        p.start()
+    # read the results before joining, a process does not exit before its queue is emptied
+    results = sorted((resultQueue.get() for _ in procs), key=lambda result: result["worker"])
+    for p in procs:
+        p.join()
+
+    manifest = {
+        "percentile": percentile,
+        "elolimit": float(elolimit),
+        "binary": binary,
+        "games": sum(result["games"] for result in results),
+        "samples": sum(result["samples"] for result in results),
+        "seconds": time.time() - start,
+        "shards": results,
+    }
+    with open(os.path.join(out_dir, prefix + ".manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print("Number samples: %i in %i shards, %.1fs" % (manifest["samples"], len(results), manifest["seconds"]))
+    return manifest
+
+
+if __name__ == "__main__":
+    # python create_dataset.py [--stats] [--sharded] [--binary]
+    if "--stats" in sys.argv:
+        game_index.build_index(find_files("../database_extraction/data/"), "data/games.index.npz").statistics()
+    elif "--sharded" in sys.argv or "--binary" in sys.argv:
+        create_dataset_sharded(binary="--binary" in sys.argv)
+    else:
+        create_dataset()
@@ -1,191 +1,179 @@
 """
 DEPRECATED!!! use create_dataset.py and load_dataset.py
 Generator functions for use with keras fit_generator
+
+PositionSequence is a keras Sequence over the text files of parse_data.py (positions, results and next moves).
+The line offsets of the files are read once, so every batch can be read directly and in any order. This allows
+fit_generator(sequence, workers=n, use_multiprocessing=True) to load batches in several processes.
 """
 # import input_representation, output_representation
 from chess.variant import BughouseBoards
 import chess
 from game import input_representation, output_representation
+from game.constants import BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL, NB_SPARSE_POLICY
 import numpy as np
 import sys
-import time
 import os
+from tensorflow.keras.utils import Sequence
 
 PACKAGE_PARENT = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
 
-def generate_value_sample(path_positions, path_results, path_nextMove, both_boards):
-    with open(path_positions) as positions, open(path_results) as labels, open(path_nextMove) as nm_labels:
-        for fen, result, move in zip(positions, labels, nm_labels):
-            if move == 'end':
-                continue
-            board_number = 0 if "B1" in move else 1
-            boards = BughouseBoards(fen)
-            board = boards.boards[board_number]
-            partner_board_number = 0 if board_number == 1 else 1
-            partner_board = boards.boards[partner_board_number]
+def line_offsets(path, chunk_size=1 << 24):
+    """
+    :return: byte offset of every line in the file
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            offsets.append(position + newlines + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    # no line starts at the end of the file
+    return offsets[offsets < size]
+
+
+class LineFile:
+    """
+    Random access to the lines of a text file. The file handle is opened per process.
+    """
 
-            # change the result to the perspective of the player which will move next
-            if board_number == 1:
-                result * -1
-            if not board.turn:
-                result * -1
-
-            y = np.expand_dims(np.array(int(result)), axis=0)
-            x1 = input_representation.board_to_planes(board)
-
-            x1 = np.expand_dims(x1, axis=0)
-
-            if both_boards:
-                x2 = input_representation.board_to_planes(partner_board)
-                x2 = np.expand_dims(x2, axis=0)
-                yield (x1, x2, y)
-            else:
-                yield (x1, y)
-
-
-def generate_value_batch(batch_size, path_positions, path_results, both_boards):
-    single_sample_generator = generate_value_sample(path_positions, path_results, both_boards)
-    while(True):
-        start_time = time.time()
-        sys.stdout.write(start_time)
-        if both_boards:
-            sample = next(single_sample_generator)
-            batch_x1 = sample[0]
-            batch_x2 = sample[1]
-            batch_y = sample[2]
-            while batch_x1.shape[0] < batch_size:
-                sample = next(single_sample_generator)
-                batch_x1 = np.concatenate([batch_x1, sample[0]])
-                batch_x2 = np.concatenate([batch_x2, sample[1]])
-                batch_y = np.concatenate([batch_y, sample[2]])
-            print("Time to load one value batch: ", str(time.time() - start_time))
-            yield ({'input_1': batch_x1, 'input_2': batch_x2}, {'value_head': batch_y})
-        else:
-            sample = next(single_sample_generator)
-            batch_x = sample[0]
-            batch_y = sample[1]
-            while batch_x.shape[0] < batch_size:
-                sample = next(single_sample_generator)
-                batch_x = np.concatenate([batch_x, sample[0]])
-                batch_y = np.concatenate([batch_y, sample[1]])
-            yield ({'input_1': batch_x}, {'value_head': batch_y})
-
-
-def generate_nextMove_sample(path_positions, path_nextMove, both_boards):
-    with open(path_positions) as positions, open(path_nextMove) as labels:
-        for fen, move in zip(positions, labels):
-            board_number = 0 if "B1" in move else 1
-            move = move.strip().split(' ')[-1]
-
-            # TODO: Hotfix to skip end string
-            if move == 'end':
-                continue
-
-            move = chess.Move.from_uci(move)
-            boards = BughouseBoards(fen)
-            board = boards.boards[board_number]
-            partner_board_number = 0 if board_number == 1 else 1
-            partner_board = boards.boards[partner_board_number]
-            y = output_representation.move_to_policy(move, is_white_to_move=board.turn)
-            y = np.expand_dims(y, axis=0)
-            x = input_representation.board_to_planes(board)
-            x = np.expand_dims(x, axis=0)
-            if both_boards:
-                x2 = input_representation.board_to_planes(partner_board)
-                x2 = np.expand_dims(x2, axis=0)
-                yield (x, x2, y)
-            else:
-                yield (x, y)
-
-
-def generate_nextMove_batch(batch_size, path_positions, path_nextMove):
-    single_sample_generator = generate_nextMove_sample(path_positions, path_nextMove)
-    while(True):
-        sample = next(single_sample_generator)
-        batch_x = sample[0]
-        batch_y = sample[1]
-        while batch_x.shape[0] < batch_size:
-            sample = next(single_sample_generator)
-            batch_x = np.concatenate([batch_x, sample[0]])
-            batch_y = np.concatenate([batch_y, sample[1]])
-        yield ({'input_1': batch_x}, {'policy_head': batch_y})
-
-
-def generate_value_policy_sample(path_positions, path_results, path_nextMove, both_boards):
-    with open(path_positions) as positions, open(path_results) as labels, open(path_nextMove) as nm_labels:
-        for fen, result, move in zip(positions, labels, nm_labels):
-            board_number = 0 if "B1" in move else 1
-            move = move.strip().split(' ')[-1]
-
-            # TODO: Hotfix to skip end string
-            if move == 'end':
-                continue
-
-            move = chess.Move.from_uci(move)
-
-            boards = BughouseBoards(fen)
-            board = boards.boards[board_number]
-            partner_board_number = 0 if board_number == 1 else 1
-            partner_board = boards.boards[partner_board_number]
+    def __init__(self, path):
+        self.path = path
+        self.offsets = line_offsets(path)
+        self.handle = None
+        self.pid = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        # file handles can not be sent to the worker processes
+        state = self.__dict__.copy()
+        state["handle"] = None
+        return state
 
+    def line(self, i):
+        if self.handle is None or self.pid != os.getpid():
+            self.handle = open(self.path, "rb")
+            self.pid = os.getpid()
+        self.handle.seek(self.offsets[i])
+        return self.handle.readline().decode().strip()
+
+
+class PositionSequence(Sequence):
+    """
+    Batches of the positions in path_positions with value and / or policy targets.
+    The length is the number of full batches, samples of the last incomplete batch are left out.
+    """
+
+    def __init__(self, batch_size, path_positions, path_results, path_nextMove, value=True, policy=True, both_boards=True,
+                 shuffle=False, seed=0):
+        self.batch_size = batch_size
+        self.positions = LineFile(path_positions)
+        self.results = LineFile(path_results) if path_results is not None else None
+        self.next_moves = LineFile(path_nextMove)
+        self.value = value
+        self.policy = policy
+        self.both_boards = both_boards
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+
+        # the last position of every game has the next move 'end' and is skipped
+        with open(path_nextMove) as f:
+            self.samples = np.array([i for i, move in enumerate(f) if move.strip() != 'end'], dtype=np.int64)
+        self.order = self.samples.copy()
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return len(self.samples) // self.batch_size
+
+    def __getitem__(self, idx):
+        batch = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        x1 = np.empty((len(batch), BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL), dtype=np.float32)
+        x2 = np.empty_like(x1) if self.both_boards else None
+        values = np.empty(len(batch), dtype=np.float32)
+        policies = np.empty((len(batch), 2 * NB_SPARSE_POLICY), dtype=np.float32)
+
+        for j, i in enumerate(batch):
+            self.fill_sample(i, j, x1, x2, values, policies)
+
+        inputs = {'input_1': x1}
+        if self.both_boards:
+            inputs['input_2'] = x2
+        targets = {}
+        if self.value:
+            targets['value_head'] = values
+        if self.policy:
+            targets['policy_head'] = policies
+        return inputs, targets
+
+    def fill_sample(self, i, j, x1, x2, values, policies):
+        nm = self.next_moves.line(i)
+        board_number = 0 if "B1" in nm else 1
+        boards = BughouseBoards(self.positions.line(i))
+        board = boards.boards[board_number]
+        partner_board = boards.boards[1 - board_number]
+
+        x1[j] = input_representation.board_to_planes(board)
+        if x2 is not None:
+            x2[j] = input_representation.board_to_planes(partner_board)
+        if self.value:
             # change the result to the perspective of the player which will move next
+            result = int(self.results.line(i))
             if board_number == 1:
-                result = int(result) * -1
+                result *= -1
             if not board.turn:
-                result = int(result) * -1
-            y = np.array(int(result))
-            # y = np.expand_dims(np.array(int(result)), axis=0)
-            y2 = output_representation.move_to_policy(move, is_white_to_move=board.turn)
-            # y2 = np.expand_dims(y2, axis=0)
-            x1 = input_representation.board_to_planes(board)
+                result *= -1
+            values[j] = result
+        if self.policy:
+            move = chess.Move.from_uci(nm.split(' ')[-1])
+            policies[j] = output_representation.move_to_sparse_policy(move, is_white_to_move=board.turn)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+def generate_batches(sequence):
+    """
+    Endless generator over the batches of a sequence, for code which calls next() on the data generator
+    """
+    while True:
+        for idx in range(len(sequence)):
+            yield sequence[idx]
+        sequence.on_epoch_end()
+
 
-            # x1 = np.expand_dims(x1, axis=0)
+def generate_value_batch(batch_size, path_positions, path_results, path_nextMove, both_boards=True):
+    return generate_batches(PositionSequence(batch_size, path_positions, path_results, path_nextMove, policy=False,
+                                             both_boards=both_boards))
 
-            if both_boards:
-                x2 = input_representation.board_to_planes(partner_board)
-                # x2 = np.expand_dims(x2, axis=0)
-                yield (x1, x2, y, y2)
-            else:
-                yield (x1, y, y2)
+
+def generate_nextMove_batch(batch_size, path_positions, path_nextMove, both_boards=False):
+    return generate_batches(PositionSequence(batch_size, path_positions, None, path_nextMove, value=False,
+                                             both_boards=both_boards))
 
 
 def generate_value_policy_batch(batch_size, path_positions, path_results, path_nextMove):
     """
-    yields a batch where input_1 is the board played on as array shape (batch_size,34,8,8),
-     policy_head is the next move on the board shape (batch_size, 2272), input_2 is the partner board
+    yields a batch where input_1 is the board played on as array shape (batch_size,8,8,34),
+     policy_head is the next move on the board as sparse policy shape (batch_size, 2 * NB_SPARSE_POLICY), input_2 is the partner board
     and value is 1 if the player to move will win, - 1 if the player will lose and 0  for draw
 
     pretraining.data_generator.generate_value_policy_batch(3,"data/position.train","data/result.train","data/nm.train")
 
     """
-
-    single_sample_generator = generate_value_policy_sample(path_positions, path_results, path_nextMove, both_boards=True)
-    while True:
-        # start_time = time.time()
-        """
-        Concatenation of single inputs to fit a whole batch
-        batch[0]: input_1 (own board)
-        batch[1]: input_2 (partner board)
-        batch[2]: value_head output with shape: (batch_size, )
-        batch[3]: policy_head output with shape: (batch_size, 2272 (num of actions)) 
-        """
-        batches = [[], [], [], []]
-
-        for _ in range(batch_size):
-            sample = next(single_sample_generator)
-            [batches[i].append(sample[i]) for i in range(4)]
-
-        batch_x1 = np.array(batches[0])
-        batch_x2 = np.array(batches[1])
-        batch_value = np.array(batches[2])
-        batch_nm = np.array(batches[3])
-        # print({'input_1': batch_x1.shape, 'input_2': batch_x2.shape}, {'value_head': batch_value.shape, 'policy_head': batch_nm.shape})
-        # print(f"\n\nTime to load one batch:{str(time.time() - start_time)} \n\n")
-        yield ({'input_1': batch_x1, 'input_2': batch_x2},
-               {'value_head': batch_value, 'policy_head': batch_nm})
+    return generate_batches(PositionSequence(batch_size, path_positions, path_results, path_nextMove))
 
 
 # counts number of samples in a file
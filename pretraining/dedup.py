@@ -0,0 +1,161 @@
+"""
+Deduplication of the positions in the binary shards (see shards.py).
+
+Positions are equal if both packed boards are equal. All samples of a position are merged into one record:
+the policy target becomes the frequency of the moves played in this position (the NB_SPARSE_POLICY most frequent),
+the value target the mean of the game results. counts.npy in the output folder holds the number of merged samples
+of every record.
+
+The corpus does not fit into memory, so the records are first distributed into buckets by a hash of the position
+and every bucket is deduplicated on its own.
+
+Run `python dedup.py data/shards/ data/shards_dedup/ [--keep-duplicates]`. With --keep-duplicates every sample is kept
+but gets the merged targets of its position.
+"""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+if __name__ == "pretraining.dedup":
+    import pretraining.shards as shards
+else:
+    import shards
+
+from game.constants import NB_LABELS, NB_SPARSE_POLICY
+
+POSITION_BYTES = 2 * shards.PACKED_BOARD_BYTES
+
+
+def position_keys(records):
+    """
+    :return: the bytes of both packed boards of every record (n, POSITION_BYTES)
+    """
+    raw = records.view(np.uint8).reshape(len(records), shards.RECORD_BYTES)
+    return np.ascontiguousarray(raw[:, shards.RECORD_DTYPE.fields["board"][1]:][:, :POSITION_BYTES])
+
+
+def position_hashes(keys):
+    """
+    FNV-1a like hash over the 8 byte words of the keys
+    """
+    words = keys.view(np.uint64)
+    h = np.full(len(keys), 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
+    for column in words.T:
+        h = (h ^ column) * prime
+    return h
+
+
+def merge_policies(groups, n_groups, policy_indices, policy_probs):
+    """
+    Sums the sparse policies of the records in every group and keeps the NB_SPARSE_POLICY most likely moves
+    :param groups: group of every record
+    :return: policy indices (n_groups, NB_SPARSE_POLICY), normalized probabilities (n_groups, NB_SPARSE_POLICY)
+    """
+    valid = policy_indices >= 0
+    group_moves = np.repeat(groups, NB_SPARSE_POLICY).reshape(policy_indices.shape)[valid].astype(np.int64) * NB_LABELS \
+        + policy_indices[valid]
+    keys, inverse = np.unique(group_moves, return_inverse=True)
+    mass = np.bincount(inverse, weights=policy_probs[valid].astype(np.float64))
+    key_groups = keys // NB_LABELS
+    key_moves = keys % NB_LABELS
+
+    # sort by group, most likely move first, and keep the first NB_SPARSE_POLICY of every group
+    order = np.lexsort((-mass, key_groups))
+    key_groups, key_moves, mass = key_groups[order], key_moves[order], mass[order]
+    first = np.searchsorted(key_groups, np.arange(n_groups))
+    rank = np.arange(len(key_groups)) - first[key_groups]
+    keep = rank < NB_SPARSE_POLICY
+
+    indices = np.full((n_groups, NB_SPARSE_POLICY), -1, dtype=np.int16)
+    probs = np.zeros((n_groups, NB_SPARSE_POLICY), dtype=np.float32)
+    indices[key_groups[keep], rank[keep]] = key_moves[keep]
+    probs[key_groups[keep], rank[keep]] = mass[keep]
+    probs /= np.maximum(probs.sum(axis=1, keepdims=True), 1e-12)
+    return indices, probs
+
+
+def dedup_records(records, keep_duplicates=False):
+    """
+    :return: merged records, the number of samples of the position of each record and the number of positions.
+        With keep_duplicates all records with the merged targets of their position.
+    """
+    _, first, groups, counts = np.unique(position_keys(records).view(np.dtype((np.void, POSITION_BYTES))).ravel(),
+                                         return_index=True, return_inverse=True, return_counts=True)
+    groups = groups.ravel()
+    values = np.bincount(groups, weights=records["value"].astype(np.float64)) / counts
+    indices, probs = merge_policies(groups, len(counts), records["policy_indices"], records["policy_probs"])
+    game_ids = np.full(len(counts), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(game_ids, groups, records["game_id"])
+
+    merged = records[first].copy()
+    merged["value"] = values
+    merged["policy_indices"] = indices
+    merged["policy_probs"] = probs
+    merged["game_id"] = game_ids
+    if keep_duplicates:
+        duplicates = merged[groups]
+        duplicates["game_id"] = records["game_id"]
+        return duplicates, counts[groups], len(counts)
+    return merged, counts, len(counts)
+
+
+def dedup_shards(in_dir, out_dir, keep_duplicates=False, n_buckets=64, chunk_size=1 << 20):
+    """
+    Deduplicates all shards in in_dir into new shards in out_dir
+    :return: report dict, also written to out_dir/dedup_report.json
+    """
+    reader = shards.ShardReader(in_dir)
+    bucket_dir = os.path.join(out_dir, "buckets")
+    os.makedirs(bucket_dir, exist_ok=True)
+
+    # pass 1: distribute the records into the buckets
+    bucket_files = [open(os.path.join(bucket_dir, "bucket-%03i.bin" % i), "wb") for i in range(n_buckets)]
+    for start in range(0, len(reader), chunk_size):
+        records = reader.read(np.arange(start, min(start + chunk_size, len(reader))))
+        buckets = position_hashes(position_keys(records)) % np.uint64(n_buckets)
+        for bucket in np.unique(buckets):
+            records[buckets == bucket].tofile(bucket_files[int(bucket)])
+        print("distributed %i / %i samples" % (min(start + chunk_size, len(reader)), len(reader)))
+    for f in bucket_files:
+        f.close()
+
+    # pass 2: deduplicate every bucket in memory
+    writer = shards.ShardWriter(out_dir)
+    counts = []
+    n_positions = 0
+    for i in range(n_buckets):
+        path = os.path.join(bucket_dir, "bucket-%03i.bin" % i)
+        records = np.fromfile(path, dtype=shards.RECORD_DTYPE)
+        if len(records):
+            merged, bucket_counts, bucket_positions = dedup_records(records, keep_duplicates)
+            writer.write(merged)
+            counts.append(bucket_counts)
+            n_positions += bucket_positions
+        os.remove(path)
+    writer.close()
+    shutil.rmtree(bucket_dir)
+
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(out_dir, "counts.npy"), counts.astype(np.uint32))
+    report = {
+        "samples": len(reader),
+        "unique_positions": n_positions,
+        "records_written": writer.n_written,
+        "compression_ratio": len(reader) / max(n_positions, 1),
+        "keep_duplicates": keep_duplicates,
+        "positions_seen_once": int((counts == 1).sum()) if not keep_duplicates else None,
+        "max_count": int(counts.max()) if len(counts) else 0,
+    }
+    with open(os.path.join(out_dir, "dedup_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print("%i samples, %i unique positions, %i records written, compression ratio %.2f" % (
+        report["samples"], report["unique_positions"], report["records_written"], report["compression_ratio"]))
+    return report
+
+
+if __name__ == "__main__":
+    dedup_shards(sys.argv[1], sys.argv[2], keep_duplicates="--keep-duplicates" in sys.argv)
@@ -0,0 +1,156 @@
+"""
+Header index of the .bpgn corpus.
+
+One pass over the headers of all files records for every game where it is stored (file, byte offset, length),
+the Elo of the four players, the result and the time control. The index is saved as a small .npz file,
+so the Elo statistics, the filtering and every later conversion work on the index and read only the qualifying
+games with a seek instead of re-reading the corpus.
+"""
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+import bpgn
+
+ELO_HEADERS = ["WhiteAElo", "BlackAElo", "WhiteBElo", "BlackBElo"]
+RESULTS = {"1-0": 1, "0-1": -1, "1/2-1/2": 0}
+RESULT_UNKNOWN = 2
+NO_ELO = -1
+
+INDEX_DTYPE = np.dtype([
+    ("file", np.int32),
+    ("offset", np.int64),
+    ("length", np.int32),
+    ("elos", np.int16, (len(ELO_HEADERS),)),
+    ("result", np.int8),
+    ("time", np.int16),
+    ("increment", np.int16),
+])
+
+
+def parse_int(value, default):
+    digits = ''.join(x for x in value if x.isdigit())
+    return int(digits) if digits else default
+
+
+def index_file(args):
+    """
+    :param args: (file number, path)
+    :return: index entries of all games in the file
+    """
+    file_number, path = args
+    entries = []
+    for offset, length, headers in bpgn.scan_headers(path):
+        time_control = re.match(r"(\d+)\+(\d+)", headers.get("TimeControl", ""))
+        entries.append((file_number, offset, length,
+                        [parse_int(headers.get(name, ""), NO_ELO) for name in ELO_HEADERS],
+                        RESULTS.get(headers.get("Result", "*"), RESULT_UNKNOWN),
+                        int(time_control.group(1)) if time_control else -1,
+                        int(time_control.group(2)) if time_control else -1))
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+
+class GameIndex:
+    def __init__(self, files, games):
+        """
+        :param files: paths of the indexed files, games refer to them by position
+        :param games: array with INDEX_DTYPE
+        """
+        self.files = list(files)
+        self.games = games
+
+    def __len__(self):
+        return len(self.games)
+
+    def mean_elos(self):
+        """
+        :return: mean Elo of the players with an Elo for every game, 0 if nobody has one
+        """
+        elos = self.games["elos"].astype(np.float32)
+        rated = elos != NO_ELO
+        return np.where(rated, elos, 0).sum(axis=1) / np.maximum(rated.sum(axis=1), 1)
+
+    def elo_limit(self, percentile):
+        rated = self.mean_elos()[(self.games["elos"] != NO_ELO).any(axis=1)]
+        return np.percentile(rated, percentile)
+
+    def select(self, elolimit, finished_only=True):
+        """
+        :return: GameIndex with the games of at least elolimit mean Elo
+        """
+        mask = self.mean_elos() >= elolimit
+        if finished_only:
+            mask &= self.games["result"] != RESULT_UNKNOWN
+        return GameIndex(self.files, self.games[mask])
+
+    def by_file(self):
+        """
+        :return: dict path -> entries of this file, ordered by offset
+        """
+        return {self.files[file_number]: np.sort(self.games[self.games["file"] == file_number], order="offset")
+                for file_number in np.unique(self.games["file"])}
+
+    def statistics(self):
+        elos = self.games["elos"][self.games["elos"] != NO_ELO]
+        print("n games", len(self.games))
+        print("average elo:", np.mean(elos))
+        print("80 percentile", np.percentile(elos, 80))
+        print("90 percentile", np.percentile(elos, 90))
+        print("80 percentile of the game mean", self.elo_limit(80))
+        print("90 percentile of the game mean", self.elo_limit(90))
+        results = self.games["result"]
+        print("white wins: %i  black wins: %i  draws: %i  unfinished: %i" % (
+            (results == 1).sum(), (results == -1).sum(), (results == 0).sum(), (results == RESULT_UNKNOWN).sum()))
+
+    def save(self, path):
+        sizes = [os.path.getsize(f) for f in self.files]
+        np.savez(path, files=np.array(self.files), sizes=np.array(sizes, dtype=np.int64), games=self.games)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return GameIndex([str(f) for f in data["files"]], data["games"]), list(data["sizes"])
+
+
+def game_id(entry):
+    """
+    :return: id of an indexed game, unique in the corpus and stable as long as the files do not change
+    """
+    return (int(entry["file"]) << 40) + int(entry["offset"])
+
+
+def read_games(path, entries):
+    """
+    Generator over the games of one file at the offsets of the index entries
+    """
+    with open(path, "rb") as f:
+        for entry in entries:
+            yield bpgn.read_game_at(f, int(entry["offset"]), int(entry["length"]))
+
+
+def build_index(files, path=None, max_workers=None):
+    """
+    Indexes the headers of all files in parallel. If path is given, an existing index of the same files is
+    reused and a new one is saved there.
+    :return: GameIndex
+    """
+    files = sorted(files)
+    if path is not None and os.path.exists(path):
+        index, sizes = GameIndex.load(path)
+        if index.files == files and sizes == [os.path.getsize(f) for f in files]:
+            return index
+
+    nworkers = multiprocessing.cpu_count()
+    if max_workers:
+        nworkers = min(nworkers, max_workers)
+    with multiprocessing.Pool(nworkers) as pool:
+        entries = pool.map(index_file, list(enumerate(files)))
+    games = np.concatenate(entries) if entries else np.zeros(0, dtype=INDEX_DTYPE)
+    index = GameIndex(files, games)
+    print("indexed %i games in %i files" % (len(games), len(files)))
+
+    if path is not None:
+        index.save(path)
+    return index
@@ -2,36 +2,88 @@ import csv
 import gzip
 import os
 import sys
+import time
 import numpy as np
 import tensorflow as tf
 
 if __name__ == "pretraining.load_datasets":
     # ------- CALLED FROM main -------
     import pretraining.config_training as cf
+    import pretraining.shards as shards
     from game import input_representation, output_representation
+    from game import packed_representation as pr
+    from game.constants import (CHANNEL_MAPPING_CONST, MAX_NB_MOVES, MAX_NB_NO_PROGRESS, MAX_NB_PRISONERS, NB_CHANNELS_POS,
+                                NB_SPARSE_POLICY)
     import chess
     from chess.variant import BughouseBoards
 elif __name__ == "load_datasets":
     # ---- CALLED FROM training_from_database -----
     import config_training as cf
+    import shards
     PACKAGE_PARENT = '..'
     SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
     sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
     from game import input_representation, output_representation
+    from game import packed_representation as pr
+    from game.constants import (CHANNEL_MAPPING_CONST, MAX_NB_MOVES, MAX_NB_NO_PROGRESS, MAX_NB_PRISONERS, NB_CHANNELS_POS,
+                                NB_SPARSE_POLICY)
     import chess
     from chess.variant import BughouseBoards
 else:
     raise ImportError(f"Name: {__name__} not found")
 
 
+class InputStallMonitor(tf.keras.callbacks.Callback):
+    """
+    Measures how long every training step waits for its batch.
+    attach() adds a stamp to the end of the pipeline, which records when the step gets its batch. The difference to
+    the begin of the step is the stall time, it is added to the batch logs as "input_stall" (seconds) and the
+    mean per epoch is printed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ready = 0.
+        self.step_begin = 0.
+        self.stalls = []
+
+    def record(self):
+        self.ready = time.time()
+        return np.float64(self.ready)
+
+    def attach(self, dataset):
+        def stamp(inputs, targets):
+            ready = tf.py_func(self.record, [], tf.float64, stateful=True)
+            with tf.control_dependencies([ready]):
+                inputs = {name: tf.identity(x) for name, x in inputs.items()}
+            return inputs, targets
+        return dataset.map(stamp)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.stalls = []
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step_begin = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        stall = max(0., self.ready - self.step_begin)
+        self.stalls.append(stall)
+        if logs is not None:
+            logs["input_stall"] = stall
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.stalls:
+            print("\ninput stall: mean %.1fms, max %.1fms, %.1f%% of the steps over 10ms" % (
+                1000 * np.mean(self.stalls), 1000 * np.max(self.stalls), 100 * np.mean(np.array(self.stalls) > 0.01)))
+
+
 def tfdata(dataset, batch_size, is_training):
     # Construct a data generator using `tf.Dataset`.
     if is_training:
         dataset = dataset.shuffle(cf.SHUFFLE_BUFFER_SIZE)
     dataset = dataset.batch(batch_size, drop_remainder=True)
     dataset = dataset.repeat()
-    dataset.prefetch(buffer_size=2)
-    return dataset
+    return dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
 
 def load_data(batch_size, path="data/data_filtered.csv.gz"):
@@ -47,7 +99,7 @@ def load_data(batch_size, path="data/data_filtered.csv.gz"):
     full_dataset = tf.data.Dataset.from_generator(data_generator_processed,
                                                 output_types=({'input_1': tf.float32, 'input_2': tf.float32}, {'value_head': tf.float32, 'policy_head': tf.float32}),
                                                 output_shapes=({'input_1': tf.TensorShape(cf.INPUT_SHAPE_CHANNELS_LAST), 'input_2': tf.TensorShape(cf.INPUT_SHAPE_CHANNELS_LAST)},
-                                                            {'value_head': tf.TensorShape(()), 'policy_head': tf.TensorShape((2272,))}))
+                                                            {'value_head': tf.TensorShape(()), 'policy_head': tf.TensorShape((2 * NB_SPARSE_POLICY,))}))
 
     train_size = int(0.8 * n_samples)
     val_size = int(0.10 * n_samples)
@@ -66,6 +118,158 @@ def load_data(batch_size, path="data/data_filtered.csv.gz"):
     return train, val, test, train_size, val_size, test_size
 
 
+def decode_packed_boards(packed):
+    """
+    Expands a batch of packed boards (see game/packed_representation.py) to normalized planes with tensorflow ops
+    :param packed: uint8 tensor (batch, PACKED_BOARD_BYTES)
+    :return: float32 tensor (batch, 8, 8, 34)
+    """
+    packed = tf.cast(packed, tf.int32)
+    n = tf.shape(packed)[0]
+
+    # one byte is one row of a bitboard, the lowest bit is the a-file
+    bits = packed[:, :pr.NB_PACKED_BITS_BYTES]
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.expand_dims(bits, -1), tf.range(8)), 1)
+    bits = tf.reshape(tf.cast(bits, tf.float32), [n, len(pr.BINARY_CHANNELS), 8, 8])
+
+    ints = tf.cast(packed[:, pr.NB_PACKED_BITS_BYTES:], tf.float32)
+
+    def constant_planes(values):
+        # (batch, k) -> (batch, k, 8, 8)
+        return tf.tile(tf.reshape(values, [n, -1, 1, 1]), [1, 1, 8, 8])
+
+    pockets = ints[:, pr.POCKETS_OFFSET:pr.POCKETS_OFFSET + 10] / MAX_NB_PRISONERS
+    repetitions = ints[:, pr.REPETITIONS_OFFSET:pr.REPETITIONS_OFFSET + 1]
+    repetitions = tf.concat([tf.cast(repetitions >= 1, tf.float32), tf.cast(repetitions >= 2, tf.float32)], axis=1)
+    color = ints[:, pr.COLOR_OFFSET:pr.COLOR_OFFSET + 1]
+    total_mv_cnt = (ints[:, pr.TOTAL_MV_CNT_OFFSET:pr.TOTAL_MV_CNT_OFFSET + 1]
+                    + 256 * ints[:, pr.TOTAL_MV_CNT_OFFSET + 1:pr.TOTAL_MV_CNT_OFFSET + 2]) / MAX_NB_MOVES
+    castling = tf.cast(packed[:, pr.NB_PACKED_BITS_BYTES + pr.CASTLING_OFFSET:pr.NB_PACKED_BITS_BYTES + pr.CASTLING_OFFSET + 1], tf.int32)
+    castling = tf.cast(tf.bitwise.bitwise_and(tf.bitwise.right_shift(castling, tf.range(4)), 1), tf.float32)
+    no_progress_cnt = ints[:, pr.NO_PROGRESS_OFFSET:pr.NO_PROGRESS_OFFSET + 1] / MAX_NB_NO_PROGRESS
+
+    # same channel order as board_to_planes
+    planes = tf.concat([
+        bits[:, :12],
+        constant_planes(repetitions),
+        constant_planes(pockets),
+        bits[:, 12:15],
+        constant_planes(color),
+        constant_planes(total_mv_cnt),
+        constant_planes(castling),
+        constant_planes(no_progress_cnt),
+    ], axis=1)
+    return tf.transpose(planes, [0, 2, 3, 1])
+
+
+def augment(inputs, targets):
+    """
+    Random label preserving variants of a decoded batch, without touching the FEN or the records:
+      colour swap: the planes are already seen from the player to move, swapping the colours of all players (both
+        boards) only changes the colour plane, the move and the value stay the same.
+      file mirror: a board without castling rights can be mirrored at the vertical axis (a-file <-> h-file), the move
+        index is remapped with output_representation.FILE_MIRROR_PERMUTATION. Each board is mirrored on its own.
+    Swapping the main and the partner board is not used, the targets belong to the player of the main board.
+    """
+    x1, x2 = inputs['input_1'], inputs['input_2']
+    n = tf.shape(x1)[0]
+    color = NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["color"]
+    castling = NB_CHANNELS_POS + CHANNEL_MAPPING_CONST["castling"]
+
+    def swap_colour(x, swap):
+        toggled = tf.concat([x[..., :color], 1 - x[..., color:color + 1], x[..., color + 1:]], axis=-1)
+        return tf.where(swap, toggled, x)
+
+    def mirror_files(x):
+        # boards with castling rights are not symmetric
+        no_castling = tf.reduce_sum(x[:, 0, 0, castling:castling + 4], axis=1) == 0
+        mirror = tf.logical_and(no_castling, tf.random.uniform([n]) < 0.5)
+        return tf.where(mirror, tf.reverse(x, axis=[2]), x), mirror
+
+    swap = tf.random.uniform([n]) < 0.5
+    x1, mirror = mirror_files(swap_colour(x1, swap))
+    x2, _ = mirror_files(swap_colour(x2, swap))
+
+    policy = targets['policy_head']
+    indices = tf.cast(policy[:, :NB_SPARSE_POLICY], tf.int32)
+    mirrored = tf.gather(output_representation.FILE_MIRROR_PERMUTATION, tf.maximum(indices, 0))
+    mirrored = tf.where(indices >= 0, mirrored, indices)
+    indices = tf.where(tf.tile(mirror[:, None], [1, NB_SPARSE_POLICY]), mirrored, indices)
+    policy = tf.concat([tf.cast(indices, tf.float32), policy[:, NB_SPARSE_POLICY:]], axis=1)
+
+    return {'input_1': x1, 'input_2': x2}, {'value_head': targets['value_head'], 'policy_head': policy}
+
+
+def decode_record_bytes(raw):
+    """
+    Decodes a batch of shard records into network inputs and targets
+    :param raw: uint8 tensor (batch, RECORD_BYTES)
+    """
+    offsets = {name: shards.RECORD_DTYPE.fields[name][1] for name in shards.RECORD_DTYPE.names}
+
+    def field(name, dtype, count):
+        # (batch, count * size) bytes -> (batch, count) values
+        data = raw[:, offsets[name]:offsets[name] + count * dtype.size]
+        return tf.bitcast(tf.reshape(data, [-1, count, dtype.size]), dtype)
+
+    board = raw[:, offsets["board"]:offsets["board"] + pr.PACKED_BOARD_BYTES]
+    partner_board = raw[:, offsets["partner_board"]:offsets["partner_board"] + pr.PACKED_BOARD_BYTES]
+    policy_indices = tf.cast(field("policy_indices", tf.int16, NB_SPARSE_POLICY), tf.float32)
+    policy_probs = tf.cast(field("policy_probs", tf.float16, NB_SPARSE_POLICY), tf.float32)
+    value = field("value", tf.float32, 1)[:, 0]
+
+    return ({'input_1': decode_packed_boards(board), 'input_2': decode_packed_boards(partner_board)},
+            {'value_head': value, 'policy_head': tf.concat([policy_indices, policy_probs], axis=1)})
+
+
+def load_indexed_shards(batch_size, shard_dir=cf.GDRIVE_FOLDER + cf.SHARD_FOLDER, seed=42):
+    """
+    Reads the binary shards of shards.py by random access.
+    The data is split into train/val/test by game, so no game is in two sets, and every epoch of the training set
+    is a new permutation of all training positions, so a batch mixes positions of many games without a shuffle buffer.
+    The batches of an epoch are read by SHARD_READERS generators in parallel.
+    """
+    reader = shards.ShardReader(shard_dir)
+    splits = shards.split_by_game(reader.game_ids(), seed=seed)
+    if cf.N_SAMPLES is not None:
+        rng = np.random.RandomState(seed)
+        splits = [np.sort(rng.permutation(ids)[:int(fraction * cf.N_SAMPLES)]) for ids, fraction in zip(splits, (0.8, 0.1, 0.1))]
+    train_size, val_size, test_size = [len(ids) for ids in splits]
+
+    n_readers = max(1, cf.SHARD_READERS)
+
+    def batches(ids, is_training):
+        # epochs started by every reader, all readers use the same permutation in an epoch
+        epochs = [0] * n_readers
+
+        def generator(reader_id):
+            order = np.random.RandomState(seed + epochs[reader_id]).permutation(ids) if is_training else ids
+            epochs[reader_id] += 1
+            for start in range(reader_id * batch_size, len(order) - batch_size + 1, n_readers * batch_size):
+                yield reader.read(order[start:start + batch_size]).view(np.uint8).reshape(batch_size, shards.RECORD_BYTES)
+        return generator
+
+    def pipeline(ids, is_training, cache=False):
+        generator = batches(ids, is_training)
+        dataset = tf.data.Dataset.range(n_readers).interleave(
+            lambda reader_id: tf.data.Dataset.from_generator(generator, output_types=tf.uint8,
+                                                             output_shapes=tf.TensorShape((batch_size, shards.RECORD_BYTES)),
+                                                             args=(reader_id,)),
+            cycle_length=n_readers, block_length=1, num_parallel_calls=n_readers)
+        if cache:
+            dataset = dataset.cache()
+        dataset = dataset.map(decode_record_bytes, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if is_training and cf.AUGMENT:
+            dataset = dataset.map(augment, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.repeat()
+        return dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+    train = pipeline(splits[0], is_training=True)
+    val = pipeline(splits[1], is_training=False, cache=True)
+    test = pipeline(splits[2], is_training=False)
+    return train, val, test, train_size, val_size, test_size
+
+
 def data_generator_processed(path=cf.GDRIVE_FOLDER + "data/data_filtered.csv.gz", both_boards=True):
     with gzip.open(path, 'rt') as f:
         reader = csv.reader(f, delimiter=';')
@@ -86,7 +290,8 @@ def data_generator_processed(path=cf.GDRIVE_FOLDER + "data/data_filtered.csv.gz"
             if not board.turn:
                 result = int(result) * -1
             y = np.array(int(result))
-            y2 = output_representation.move_to_policy(move, is_white_to_move=board.turn)
+            # the policy target stays sparse, it is only expanded inside the loss (nn_tf.sparse_policy_loss)
+            y2 = output_representation.move_to_sparse_policy(move, is_white_to_move=board.turn)
             x1 = input_representation.board_to_planes(board)
             if both_boards:
                 x2 = input_representation.board_to_planes(partner_board)
@@ -2,7 +2,7 @@
 Neural Network architecture we use for training and playing
 on the magnificent Bughouse chess game
 """
-
+import os
 
 if True:
     import tensorflow as tf
@@ -37,6 +37,8 @@ elif __name__ == "nn_tf":
 else:
     raise ImportError(f"Name: {__name__} not found")
 
+from game.constants import NB_LABELS, NB_SPARSE_POLICY
+
 
 def sign_metric(y_true, y_pred):
     """
@@ -48,6 +50,35 @@ def sign_metric(y_true, y_pred):
     return K.mean(K.equal(K.sign(y_pred), y_true))
 
 
+def sparse_to_dense_policy(y_true):
+    """
+    Expands the sparse policy targets (batch, 2 * NB_SPARSE_POLICY) to (batch, NB_LABELS).
+    The first half holds the move indices (-1 if unused), the second half their probabilities.
+    """
+    indices = K.cast(y_true[:, :NB_SPARSE_POLICY], 'int32')
+    probs = y_true[:, NB_SPARSE_POLICY:]
+    # one_hot of -1 is all zeros, so unused entries drop out
+    return K.sum(tf.one_hot(indices, NB_LABELS) * K.expand_dims(probs, axis=-1), axis=1)
+
+
+def sparse_policy_loss(y_true, y_pred):
+    """
+    categorical crossentropy for sparse policy targets, the dense target only exists inside the training step
+    """
+    return K.categorical_crossentropy(sparse_to_dense_policy(y_true), y_pred)
+
+
+def sparse_policy_accuracy(y_true, y_pred):
+    """
+    self defined metric for policy head: predicted move is the most likely move of the target
+    """
+    best_move = K.cast(y_true[:, 0], 'int64')
+    return K.mean(K.cast(K.equal(K.argmax(y_pred, axis=-1), best_move), K.floatx()))
+
+
+CUSTOM_OBJECTS = {'sign_metric': sign_metric, 'sparse_policy_loss': sparse_policy_loss, 'sparse_policy_accuracy': sparse_policy_accuracy}
+
+
 class NeuralNetwork:
 
     def __init__(self):
@@ -55,9 +86,10 @@ class NeuralNetwork:
         self.train_data_generator = None
         self.validation_data_generator = None
         self.test_data_generator = None
+        self.input_stall_monitor = None
         self.in_dim = cf.INPUT_SHAPE_CHANNELS_LAST
         self.out_dim_value_head = 1
-        self.out_dim_policy_head = 2272     # TODO: maybe make it dynamic not hard coded
+        self.out_dim_policy_head = NB_LABELS
         self.n_train = None
         self.n_val = None
         self.n_test = None
@@ -67,8 +99,12 @@ class NeuralNetwork:
 
     def load_data(self):
 
-        train, val, test, train_size, val_size, test_size = load_datasets.load_data(cf.BATCH_SIZE, cf.GDRIVE_FOLDER + "data/data.csv.gz")
-        self.train_data_generator = train
+        if os.path.isdir(cf.GDRIVE_FOLDER + cf.SHARD_FOLDER):
+            train, val, test, train_size, val_size, test_size = load_datasets.load_indexed_shards(cf.BATCH_SIZE, cf.GDRIVE_FOLDER + cf.SHARD_FOLDER)
+        else:
+            train, val, test, train_size, val_size, test_size = load_datasets.load_data(cf.BATCH_SIZE, cf.GDRIVE_FOLDER + "data/data.csv.gz")
+        self.input_stall_monitor = load_datasets.InputStallMonitor()
+        self.train_data_generator = self.input_stall_monitor.attach(train)
         self.validation_data_generator = val
         self.test_data_generator = test
 
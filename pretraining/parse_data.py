@@ -46,12 +46,12 @@ def parse_all_positions(in_dir="../database_extraction/data/", out_dir="data/"):
                         label = "0"
 
                     for move in game.mainline_moves():
-                        all_boards.write(boards.fen + "\n")
+                        all_boards.write(boards.fen() + "\n")
                         labels.write(label + "\n")
                         next_moves.write(str(move) + "\n")
                         boards.push(move)
 
-                    all_boards.write(boards.fen + "\n")
+                    all_boards.write(boards.fen() + "\n")
                     labels.write(label + "\n")
                     next_moves.write("end\n")
 
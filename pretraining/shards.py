@@ -0,0 +1,246 @@
+"""
+Binary training shards with pre-encoded samples.
+
+Every sample is a fixed size record (RECORD_DTYPE), so a shard can be read without parsing:
+  board / partner_board: packed board of the player to move and of the partner board (PACKED_BOARD_BYTES each)
+  policy_indices / policy_probs: sparse policy target (see output_representation.policy_to_sparse)
+  value: game result from the perspective of the player to move
+  game_id: id of the game the position comes from, used to split the data by game (-1 if unknown)
+
+The layout of a packed board is described in game/packed_representation.py.
+
+Convert the csv of create_dataset.py with `python shards.py data/data_filtered.csv.gz data/shards/`
+"""
+import csv
+import gzip
+import os
+import sys
+
+import numpy as np
+
+if __name__ == "pretraining.shards":
+    import pretraining.config_training as cf
+else:
+    # ---- CALLED FROM the pretraining folder -----
+    PACKAGE_PARENT = '..'
+    SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+    sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+    import config_training as cf
+
+from game import output_representation
+from game.constants import NB_SPARSE_POLICY
+from game.packed_representation import PACKED_BOARD_BYTES, board_to_packed
+import chess
+from chess.variant import BughouseBoards
+
+RECORD_DTYPE = np.dtype([
+    ("board", np.uint8, (PACKED_BOARD_BYTES,)),
+    ("partner_board", np.uint8, (PACKED_BOARD_BYTES,)),
+    ("policy_indices", "<i2", (NB_SPARSE_POLICY,)),
+    ("policy_probs", "<f2", (NB_SPARSE_POLICY,)),
+    ("value", "<f4"),
+    ("game_id", "<i8"),
+])
+RECORD_BYTES = RECORD_DTYPE.itemsize
+SHARD_SUFFIX = ".bin"
+
+
+def row_to_record(row, record, game_id=-1):
+    """
+    Fills a record from a row of the csv written by create_dataset.py
+    :param row: [fen, result, next move] or [fen, result, next move, game id]
+    :param record: element of an array with RECORD_DTYPE
+    :param game_id: used if the row has no game id
+    """
+    position, result, nm = row[0], int(row[1]), str(row[2]).strip()
+    if len(row) > 3:
+        game_id = int(row[3])
+    board_number = 0 if "B1" in nm else 1
+    boards = BughouseBoards(position)
+    board = boards.boards[board_number]
+    partner_board = boards.boards[1 - board_number]
+    move = chess.Move.from_uci(nm.split(' ')[-1])
+
+    # change the result to the perspective of the player which will move next
+    if board_number == 1:
+        result *= -1
+    if not board.turn:
+        result *= -1
+
+    sparse_policy = output_representation.move_to_sparse_policy(move, is_white_to_move=board.turn)
+    board_to_packed(board, out=record["board"])
+    board_to_packed(partner_board, out=record["partner_board"])
+    record["policy_indices"] = sparse_policy[:NB_SPARSE_POLICY]
+    record["policy_probs"] = sparse_policy[NB_SPARSE_POLICY:]
+    record["value"] = result
+    record["game_id"] = game_id
+
+
+def is_start_position(fen):
+    boards = BughouseBoards(fen)
+    return all(board.board_fen() == chess.STARTING_BOARD_FEN for board in boards.boards)
+
+
+def shard_path(out_dir, shard_number):
+    return os.path.join(out_dir, "shard-%05i%s" % (shard_number, SHARD_SUFFIX))
+
+
+def find_shards(shard_dir):
+    return sorted(os.path.join(shard_dir, f) for f in os.listdir(shard_dir) if f.endswith(SHARD_SUFFIX))
+
+
+def num_records(path):
+    return os.path.getsize(path) // RECORD_BYTES
+
+
+class ShardWriter:
+    """
+    Writes records into shards of at most shard_size samples. Records are collected in a
+    preallocated buffer and appended to the shard file in chunks.
+    """
+
+    def __init__(self, out_dir, shard_size=cf.SHARD_SIZE, chunk_size=4096, path_fn=shard_path):
+        # every shard worker creates the folder
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.path_fn = path_fn
+        self.buffer = np.zeros(chunk_size, dtype=RECORD_DTYPE)
+        self.n_buffered = 0
+        self.shard_number = 0
+        self.n_in_shard = 0
+        self.n_written = 0
+        self.paths = []
+        self.file = None
+
+    def next_record(self):
+        """
+        :return: the next free record of the buffer, it is written after being filled
+        """
+        if self.n_buffered == len(self.buffer) or self.n_in_shard + self.n_buffered == self.shard_size:
+            self.flush()
+        record = self.buffer[self.n_buffered]
+        self.n_buffered += 1
+        return record
+
+    def flush(self):
+        if self.n_buffered == 0:
+            return
+        n_buffered = self.n_buffered
+        self.n_buffered = 0
+        self.write(self.buffer[:n_buffered])
+
+    def write(self, records):
+        """
+        Writes an array of records, after the buffered ones
+        """
+        self.flush()
+        while len(records) > 0:
+            if self.file is None:
+                path = self.path_fn(self.out_dir, self.shard_number)
+                self.paths.append(path)
+                self.file = open(path, "wb")
+            chunk = records[:self.shard_size - self.n_in_shard]
+            chunk.tofile(self.file)
+            records = records[len(chunk):]
+            self.n_in_shard += len(chunk)
+            self.n_written += len(chunk)
+            if self.n_in_shard == self.shard_size:
+                self.file.close()
+                self.file = None
+                self.shard_number += 1
+                self.n_in_shard = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ShardReader:
+    """
+    Random access to the records of all shards in a folder, as if they were one array.
+    The shards are memory mapped, only the requested records are read.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.paths = find_shards(shard_dir)
+        self.shards = [np.memmap(path, dtype=RECORD_DTYPE, mode='r') for path in self.paths]
+        # global number of the first record of every shard
+        self.starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def read(self, indices):
+        """
+        :param indices: global record numbers
+        :return: array with RECORD_DTYPE, in the order of indices
+        """
+        indices = np.asarray(indices)
+        shard_numbers = np.searchsorted(self.starts, indices, side='right') - 1
+        records = np.empty(len(indices), dtype=RECORD_DTYPE)
+        for shard_number in np.unique(shard_numbers):
+            mask = shard_numbers == shard_number
+            records[mask] = self.shards[shard_number][indices[mask] - self.starts[shard_number]]
+        return records
+
+    def game_ids(self):
+        """
+        :return: game id of every record, cached in index.npz of the shard folder.
+            Records without a game id get their own negative id.
+        """
+        index_path = os.path.join(self.shard_dir, "index.npz")
+        sizes = np.diff(self.starts)
+        if os.path.exists(index_path):
+            index = np.load(index_path)
+            if list(index["paths"]) == [os.path.basename(path) for path in self.paths] and (index["sizes"] == sizes).all():
+                return index["game_ids"]
+
+        game_ids = np.concatenate([shard["game_id"] for shard in self.shards]) if self.shards else np.zeros(0, dtype=np.int64)
+        game_ids = np.where(game_ids < 0, -1 - np.arange(len(game_ids)), game_ids)
+        np.savez(index_path, paths=np.array([os.path.basename(path) for path in self.paths]), sizes=sizes, game_ids=game_ids)
+        return game_ids
+
+
+def split_by_game(game_ids, fractions=(0.8, 0.1, 0.1), seed=42):
+    """
+    Splits the records into train, validation and test set, all positions of a game end up in the same set
+    :param game_ids: game id of every record
+    :return: sorted record numbers of every set
+    """
+    games, game_numbers = np.unique(game_ids, return_inverse=True)
+    order = np.random.RandomState(seed).permutation(len(games))
+    bounds = np.cumsum([0] + [int(round(f * len(games))) for f in fractions])
+    bounds[-1] = len(games)
+    split_of_game = np.empty(len(games), dtype=np.int64)
+    for split, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        split_of_game[order[start:end]] = split
+    split_of_record = split_of_game[game_numbers]
+    return [np.flatnonzero(split_of_record == split) for split in range(len(fractions))]
+
+
+def convert_csv(path, out_dir, shard_size=cf.SHARD_SIZE):
+    """
+    Converts the gzip csv of create_dataset.py into binary shards
+    :return: number of samples
+    """
+    writer = ShardWriter(out_dir, shard_size)
+    game_id = -1
+    with gzip.open(path, 'rt') as f:
+        for n, row in enumerate(csv.reader(f, delimiter=';')):
+            # old csv files have no game id, the games are consecutive and every game starts in the start position
+            if len(row) < 4 and is_start_position(row[0]):
+                game_id += 1
+            row_to_record(row, writer.next_record(), game_id)
+            if n % 100000 == 0:
+                print("converted %i samples" % n)
+    writer.close()
+    print("Number samples: %i in %i shards" % (writer.n_written, len(writer.paths)))
+    return writer.n_written
+
+
+if __name__ == "__main__":
+    convert_csv(sys.argv[1], sys.argv[2])
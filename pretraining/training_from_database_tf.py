@@ -7,7 +7,7 @@ TODO shuffle data after every epoch
 if True:
     import tensorflow as tf
     import numpy as np
-    from nn_tf import NeuralNetwork, sign_metric
+    from nn_tf import NeuralNetwork, sign_metric, sparse_policy_loss, sparse_policy_accuracy, CUSTOM_OBJECTS
     from tensorflow.keras.models import load_model
     import config_training as cf
     from tensorflow.keras.callbacks import TensorBoard, Callback
@@ -17,7 +17,7 @@ if True:
 else:
     import tensorflow as tf
     import numpy as np
-    from nn_tf import NeuralNetwork, sign_metric
+    from nn_tf import NeuralNetwork, sign_metric, sparse_policy_loss, sparse_policy_accuracy, CUSTOM_OBJECTS
     from keras.models import load_model
     import config_training as cf
     from keras.callbacks import TensorBoard
@@ -40,12 +40,12 @@ def train(model):
     print("Compiling model")
 
     losses = {
-        "policy_head": "categorical_crossentropy",
+        "policy_head": sparse_policy_loss,
         "value_head": "mean_squared_error",
     }
     loss_weights = {"policy_head": 10.0, "value_head": 1.0}
 
-    metrics = ["accuracy", sign_metric]
+    metrics = {"policy_head": [sparse_policy_accuracy], "value_head": [sign_metric]}
     optimizer = "adam"
     # optimizer = "sgd"
     # lr_callback = MyLearningRateScheduler()
@@ -67,7 +67,7 @@ def train(model):
                     verbose=1,
                     validation_data=model.validation_data_generator,
                     validation_steps=model.n_val,
-                    callbacks=[tensorboard])
+                    callbacks=[model.input_stall_monitor, tensorboard])
 
     # TODO  is this automatically on gpu? cluster
     # Save the model
@@ -93,12 +93,12 @@ def test(model):
     print("Compiling model")
 
     losses = {
-        "policy_head": "categorical_crossentropy",
+        "policy_head": sparse_policy_loss,
         "value_head": "mean_squared_error",
     }
     loss_weights = {"policy_head": 10.0, "value_head": 1.0}
 
-    metrics = ["accuracy", sign_metric]
+    metrics = {"policy_head": [sparse_policy_accuracy], "value_head": [sign_metric]}
     optimizer = "adam"
 
     model.model.compile(loss=losses, optimizer=optimizer, metrics=metrics, loss_weights=loss_weights)
@@ -117,7 +117,7 @@ def test(model):
 
 def load_pretrained(model_path):
     print("Load Model:")
-    model = load_model(model_path, custom_objects={'sign_metric': sign_metric})
+    model = load_model(model_path, custom_objects=CUSTOM_OBJECTS)
     return model
 
 
@@ -151,7 +151,7 @@ def evaluate_model(self):
         predictions = self.model.predict(inputs)
         for j in range(cf.BATCH_SIZE):
             pred = np.argmax(predictions[1][j])
-            tru = np.argmax(labels["policy_head"][j])
+            tru = int(labels["policy_head"][j][0])
             if pred == tru:
                 correct += 1
                 cor_idx.append(pred)
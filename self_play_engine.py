@@ -0,0 +1,303 @@
+"""
+Headless self play without the websocket server.
+
+The engine keeps several bughouse games running in one process. Every game has one search tree per board,
+which plays both colours of that board, so all four seats are covered. The searches of all games are stepped in
+lockstep and the leaves of every tree are evaluated in one batch by the neural network.
+The finished games are written directly into the memory as training samples.
+
+The MatchEngine plays the same games between two networks, one per team, to evaluate a newly trained network.
+"""
+import time
+
+import chess
+from chess.variant import BughouseBoards
+
+import config
+from game.game import GameState
+from new_agent import Agent, states_to_inputs
+from util import logger as lg
+import util.nn_interface as nni
+from util.trace import tracer
+
+
+class SelfPlayGame:
+    ##########
+    # param:
+    # team_models - None for self play, else [(model, model_extra) of team 0, (model, model_extra) of team 1]
+    #   team 0 plays white on board A and black on board B
+    ##########
+    def __init__(self, game_id, env, model, model_extra, mcts_simulations, team_models=None):
+        self.game_id = game_id
+        self.boards = BughouseBoards()
+        if team_models is None:
+            # one agent per board, it searches for whoever is to move on its board
+            self.agents = [Agent(f"selfplay_{game_id}_board_{board_number}", env.state_size, env.action_size, mcts_simulations, config.CPUCT,
+                                 model, None, model_extra) for board_number in range(2)]
+            self.team_agents = None
+        else:
+            # one agent per seat, team_agents[team][board_number]
+            self.team_agents = [[Agent(f"match_{game_id}_team_{team}_board_{board_number}", env.state_size, env.action_size, mcts_simulations,
+                                       config.CPUCT, team_model, None, team_model_extra) for board_number in range(2)]
+                                for team, (team_model, team_model_extra) in enumerate(team_models)]
+        # samples are kept until the game is finished, because the value is only known at the end
+        self.samples = []
+        self.turn = 0
+        self.done = False
+        self.result = None
+
+    def state(self, board_number):
+        """
+        :return: GameState of the given board with the player to move on this board
+        """
+        boards = BughouseBoards(self.boards.fen())
+        player_turn = 1 if boards.boards[board_number].turn == chess.WHITE else -1
+        return GameState(boards, board_number, player_turn)
+
+    def agent_to_move(self, board_number):
+        """
+        :return: the agent searching for the player to move on the given board
+        """
+        if self.team_agents is None:
+            return self.agents[board_number]
+        white = self.boards.boards[board_number].turn == chess.WHITE
+        team = board_number if white else 1 - board_number
+        return self.team_agents[team][board_number]
+
+    def check_for_end(self):
+        if self.boards.is_game_over():
+            self.done = True
+            self.result = self.boards.result()
+        elif self.turn >= config.SELF_PLAY_MAX_TURNS:
+            self.done = True
+            self.result = "1/2-1/2"
+        return self.done
+
+    def values(self):
+        """
+        Converts the result of the game into the value target of every sample
+        (same perspective as in the pretraining data: the player to move)
+        """
+        label = 0
+        if self.result == "1-0":
+            label = 1
+        elif self.result == "0-1":
+            label = -1
+
+        values = []
+        for state, _ in self.samples:
+            value = label
+            if state.board_number == 1:
+                value *= -1
+            if state.playerTurn == -1:
+                value *= -1
+            values.append(value)
+        return values
+
+
+class SelfPlayEngine:
+    ##########
+    # param:
+    # env - the game, used for state and action size
+    # model - the neural net, shared by all games
+    # model_extra - [graph, sess] for model.predict
+    # parallel_games - number of games which are played at the same time
+    # mcts_simulations - simulations per move
+    # evaluate - function mapping a list of GameStates to (policies, values). Defaults to model.predict
+    ##########
+    def __init__(self, env, model, model_extra, parallel_games=config.SELF_PLAY_PARALLEL_GAMES, mcts_simulations=config.MCTS_SIMS, evaluate=None):
+        self.env = env
+        self.model = model
+        self.model_extra = model_extra
+        self.parallel_games = parallel_games
+        self.mcts_simulations = mcts_simulations
+        self.evaluate = evaluate if evaluate is not None else self.predict
+        # moves are sampled from the visit counts in the first turns, afterwards the most visited move is played
+        self.turns_with_high_noise = config.TURNS_WITH_HIGH_NOISE
+
+        self.games_started = 0
+        self.games_finished = 0
+        self.positions = 0
+        self.nn_batches = 0
+
+    def predict(self, states):
+        inputs = states_to_inputs(states)
+        predictions = nni.predict(self.model, self.model_extra, inputs)
+        return predictions[1], predictions[0]
+
+    def evaluate_agents(self, agents, states):
+        """
+        Evaluates the states searched by the given agents (one agent per state)
+        :return: policies, values
+        """
+        return self.evaluate(states)
+
+    def new_game(self, game_id):
+        return SelfPlayGame(game_id, self.env, self.model, self.model_extra, self.mcts_simulations)
+
+    def play(self, episodes, memory):
+        """
+        Plays episodes games and commits their samples to memory
+        :param memory: None to keep no samples
+        :return: memory
+        """
+        start = time.time()
+        games = []
+        while self.games_finished < episodes:
+            while len(games) < self.parallel_games and self.games_started < episodes:
+                games.append(self.new_game(self.games_started))
+                self.games_started += 1
+
+            self.play_turn(games)
+
+            for game in [game for game in games if game.done]:
+                self.commit_game(game, memory)
+                games.remove(game)
+
+        lg.logger_main.info('SELF PLAY: %d games, %d positions, %d nn batches in %.1fs',
+                            self.games_finished, self.positions, self.nn_batches, time.time() - start)
+        return memory
+
+    def play_turn(self, games):
+        """
+        Searches one move on every board of every game and plays them
+        """
+        searches = []
+        for game in games:
+            for board_number in range(2):
+                agent = game.agent_to_move(board_number)
+                state = game.state(board_number)
+                # in bughouse a player without legal moves waits for pieces from his partner
+                if state.allowedActions:
+                    agent.build_mcts(state)
+                    searches.append((game, board_number, agent))
+
+        self.search(searches)
+
+        for game in games:
+            moves = [(board_number, agent) for g, board_number, agent in searches if g is game]
+            if not moves:
+                # both players are stuck
+                game.done = True
+                game.result = "1/2-1/2"
+                continue
+            game.turn += 1
+            higher_noise = game.turn < self.turns_with_high_noise
+            for board_number, agent in moves:
+                move = agent.pick_move(higher_noise)
+                if tracer.enabled:
+                    tracer.search_end(agent.trace_search, agent.root, move)
+                game.samples.append((agent.root.state, agent.root.children_as_pi()))
+                self.positions += 1
+
+                move.board_id = board_number
+                game.boards.push(move)
+                if game.check_for_end():
+                    break
+            if not game.done:
+                game.check_for_end()
+
+    def search(self, searches):
+        """
+        Runs the tree search of all agents in lockstep. All leaves of one round are evaluated in a single batch.
+        :param searches: list of (game, board_number, agent) with freshly built trees
+        """
+        if not searches:
+            return
+
+        # expand all roots first, otherwise the root would be selected parallel_readouts times
+        agents = [agent for _, _, agent in searches]
+        if tracer.enabled:
+            for agent in agents:
+                agent.trace_search = tracer.search_start(agent.name, agent.root)
+        move_probs, values = self.evaluate_agents(agents, [agent.root.state for agent in agents])
+        self.nn_batches += 1
+        for agent, move_prob, value in zip(agents, move_probs, values):
+            agent.root.incorporate_results(move_prob, value, agent.root)
+
+        targets = [agent.root.N + self.mcts_simulations for agent in agents]
+        while True:
+            batch = [(agent, agent.select_leaves()) for agent, target in zip(agents, targets) if agent.root.N < target]
+            if not batch:
+                break
+            self.evaluate_leaves(batch)
+
+    def evaluate_leaves(self, batch):
+        """
+        :param batch: list of (agent, leaves)
+        """
+        states = [leaf.state for _, leaves in batch for leaf in leaves]
+        if not states:
+            # only terminal positions were reached, they are already backed up
+            return
+        move_probs, values = self.evaluate_agents([agent for agent, leaves in batch for _ in leaves], states)
+        self.nn_batches += 1
+
+        i = 0
+        for agent, leaves in batch:
+            agent.incorporate_leaves(leaves, move_probs[i:i + len(leaves)], values[i:i + len(leaves)])
+            i += len(leaves)
+
+    def commit_game(self, game, memory):
+        if memory is not None:
+            for (state, pi), value in zip(game.samples, game.values()):
+                memory.commit_stmemory(state, pi, value)
+            memory.commit_ltmemory()
+        self.games_finished += 1
+        lg.logger_main.info('SELF PLAY GAME %d finished after %d turns: %s', game.game_id, game.turn, game.result)
+
+
+class MatchEngine(SelfPlayEngine):
+    ##########
+    # param:
+    # env - the game, used for state and action size
+    # model, model_extra - the first network, e.g. the best network
+    # opponent_model, opponent_model_extra - the second network, e.g. the newly trained network
+    # parallel_games - number of games which are played at the same time
+    # mcts_simulations - simulations per move
+    ##########
+    def __init__(self, env, model, model_extra, opponent_model, opponent_model_extra,
+                 parallel_games=config.SELF_PLAY_PARALLEL_GAMES, mcts_simulations=config.MCTS_SIMS):
+        super().__init__(env, model, model_extra, parallel_games, mcts_simulations)
+        self.networks = [(model, model_extra), (opponent_model, opponent_model_extra)]
+        self.turns_with_high_noise = 0
+        self.scores = [0., 0.]
+
+    def new_game(self, game_id):
+        # the networks change teams every game, so both play every seat equally often
+        team_networks = self.networks if game_id % 2 == 0 else self.networks[::-1]
+        return SelfPlayGame(game_id, self.env, None, None, self.mcts_simulations, team_models=team_networks)
+
+    def evaluate_agents(self, agents, states):
+        """
+        Evaluates the states of each network in a separate batch
+        """
+        policies = [None] * len(states)
+        values = [None] * len(states)
+        for model, model_extra in self.networks:
+            idx = [i for i, agent in enumerate(agents) if agent.model is model]
+            if not idx:
+                continue
+            predictions = nni.predict(model, model_extra, states_to_inputs([states[i] for i in idx]))
+            for j, i in enumerate(idx):
+                values[i] = predictions[0][j]
+                policies[i] = predictions[1][j]
+        return policies, values
+
+    def commit_game(self, game, memory):
+        # team 0 (white on board A) wins with "1-0"
+        first_network_team = game.game_id % 2
+        points = {"1-0": [1., 0.], "0-1": [0., 1.]}.get(game.result, [0.5, 0.5])
+        self.scores[0] += points[first_network_team]
+        self.scores[1] += points[1 - first_network_team]
+        super().commit_game(game, None)
+
+    def play_match(self, episodes):
+        """
+        Plays episodes games between the two networks
+        :return: points of the first and of the second network
+        """
+        self.scores = [0., 0.]
+        self.play(episodes, None)
+        lg.logger_tourney.info('MATCH: %.1f : %.1f after %d games', self.scores[0], self.scores[1], self.games_finished)
+        return self.scores
@@ -0,0 +1,282 @@
+"""
+Self play with several worker processes and one inference process.
+
+Every worker runs a SelfPlayEngine. Instead of calling the network itself, the engine writes the planes of its
+leaves into a shared memory buffer and sends a request to the inference process. The inference process collects the
+requests of all workers that arrive within SELF_PLAY_INFERENCE_WAIT seconds, predicts them as one batch and writes
+policy and value back into the shared output buffer of every worker. The processes are spawned, they take over
+the settings of config.py from the calling process.
+
+Run `python self_play_pool.py <model path>` to measure the throughput for 2 to 16 workers.
+"""
+import multiprocessing
+import queue
+import sys
+import time
+
+import numpy as np
+
+import config
+from game import input_representation
+from game.constants import BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL, NB_LABELS
+
+PLANES_SHAPE = (2, BOARD_HEIGHT, BOARD_WIDTH, NB_CHANNELS_FULL)
+PLANES_SIZE = int(np.prod(PLANES_SHAPE))
+# policy followed by the value
+OUTPUT_SIZE = NB_LABELS + 1
+# seconds between two checks whether the processes are still alive while waiting for their results
+RESULT_POLL_SECONDS = 5
+
+
+def max_leaves(parallel_games):
+    # every game searches on both boards
+    return parallel_games * 2 * config.PARALLEL_READOUTS
+
+
+def config_settings():
+    """
+    :return: the settings of config.py, a spawned process imports config.py again and would lose the changes made at runtime
+    """
+    return {name: value for name, value in vars(config).items() if name.isupper()}
+
+
+def apply_config(settings):
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+
+def load_registered_model(model_path):
+    from util import model_registry
+
+    return model_registry.get_model(model_path, inference_graph=False)
+
+
+class RemoteEvaluator:
+    """
+    Evaluation function for the SelfPlayEngine of a worker. Sends the leaves to the inference process.
+    """
+
+    def __init__(self, worker_id, input_buffer, output_buffer, request_queue, response_queue, max_leaves):
+        self.worker_id = worker_id
+        self.inputs = np.frombuffer(input_buffer, dtype=np.float32).reshape((max_leaves,) + PLANES_SHAPE)
+        self.outputs = np.frombuffer(output_buffer, dtype=np.float32).reshape((max_leaves, OUTPUT_SIZE))
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.max_leaves = max_leaves
+
+    def __call__(self, states):
+        policies = np.empty((len(states), NB_LABELS), dtype=np.float32)
+        # one value per state, the engine backs up scalars
+        values = np.empty(len(states), dtype=np.float32)
+        for start in range(0, len(states), self.max_leaves):
+            chunk = states[start:start + self.max_leaves]
+            for i, state in enumerate(chunk):
+                self.inputs[i, 0] = input_representation.board_to_planes(state.board)
+                self.inputs[i, 1] = input_representation.board_to_planes(state.partner_board)
+
+            self.request_queue.put((self.worker_id, len(chunk)))
+            self.response_queue.get()
+
+            policies[start:start + len(chunk)] = self.outputs[:len(chunk), :NB_LABELS]
+            values[start:start + len(chunk)] = self.outputs[:len(chunk), NB_LABELS]
+        return policies, values
+
+
+def inference_process(model_path, load_model, settings, input_buffers, output_buffers, request_queue, response_queues,
+                      result_queue, parallel_games):
+    import util.nn_interface as nni
+
+    apply_config(settings)
+    model, model_extra = load_model(model_path)
+    n_leaves = max_leaves(parallel_games)
+    inputs = [np.frombuffer(buffer, dtype=np.float32).reshape((n_leaves,) + PLANES_SHAPE) for buffer in input_buffers]
+    outputs = [np.frombuffer(buffer, dtype=np.float32).reshape((n_leaves, OUTPUT_SIZE)) for buffer in output_buffers]
+    max_batch = n_leaves * len(input_buffers)
+
+    n_batches = 0
+    n_positions = 0
+    n_requests = 0
+    stopped = False
+    while not stopped:
+        request = request_queue.get()
+        if request is None:
+            break
+        requests = [request]
+        batch_size = request[1]
+
+        # wait a moment for the other workers to fill up the batch
+        deadline = time.time() + config.SELF_PLAY_INFERENCE_WAIT
+        while batch_size < max_batch:
+            try:
+                request = request_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if request is None:
+                stopped = True
+                break
+            requests.append(request)
+            batch_size += request[1]
+
+        planes = np.concatenate([inputs[worker_id][:n] for worker_id, n in requests])
+        predictions = nni.predict(model, model_extra, {"input_1": planes[:, 0], "input_2": planes[:, 1]}, batch_size=len(planes))
+
+        i = 0
+        for worker_id, n in requests:
+            outputs[worker_id][:n, :NB_LABELS] = predictions[1][i:i + n]
+            outputs[worker_id][:n, NB_LABELS] = predictions[0][i:i + n, 0]
+            response_queues[worker_id].put(True)
+            i += n
+
+        n_batches += 1
+        n_positions += batch_size
+        n_requests += len(requests)
+
+    result_queue.put(("inference", n_batches, n_positions, n_requests))
+
+
+def worker_process(worker_id, episodes, parallel_games, settings, input_buffer, output_buffer, request_queue, response_queue,
+                   result_queue):
+    from game.game import Game
+    from self_play_engine import SelfPlayEngine
+    from util.memory import Memory
+
+    apply_config(settings)
+    np.random.seed(worker_id)
+    env = Game(0)
+    evaluator = RemoteEvaluator(worker_id, input_buffer, output_buffer, request_queue, response_queue, max_leaves(parallel_games))
+    engine = SelfPlayEngine(env, None, None, parallel_games=parallel_games, mcts_simulations=config.MCTS_SIMS, evaluate=evaluator)
+    # each game has at most two positions per turn
+    memory = engine.play(episodes, Memory(episodes * config.SELF_PLAY_MAX_TURNS * 2))
+
+    result_queue.put(("worker", worker_id, memory.ltmemory.valid_arrays(), engine.games_finished, engine.positions))
+
+
+def get_result(result_queue, processes):
+    """
+    Waits for the next result. If a process died without sending its result, all processes are stopped.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            dead = [process for process in processes if not process.is_alive() and process.exitcode != 0]
+            if dead:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                raise RuntimeError("self play process %s died with exit code %s" % (dead[0].name, dead[0].exitcode))
+
+
+class PoolMetrics:
+    def __init__(self, n_workers, seconds, games, positions, nn_batches, nn_positions, nn_requests):
+        self.n_workers = n_workers
+        self.seconds = seconds
+        self.games = games
+        self.positions = positions
+        self.nn_batches = nn_batches
+        self.nn_positions = nn_positions
+        # requests of the workers, a batch merges the requests which arrive together
+        self.nn_requests = nn_requests
+
+    @property
+    def games_per_hour(self):
+        return self.games / self.seconds * 3600
+
+    @property
+    def positions_per_second(self):
+        return self.positions / self.seconds
+
+    @property
+    def evaluations_per_second(self):
+        return self.nn_positions / self.seconds
+
+    @property
+    def average_batch_size(self):
+        return self.nn_positions / max(1, self.nn_batches)
+
+    @property
+    def requests_per_batch(self):
+        return self.nn_requests / max(1, self.nn_batches)
+
+    def __str__(self):
+        return (f"workers: {self.n_workers:3d}  games/hour: {self.games_per_hour:9.1f}  positions/sec: {self.positions_per_second:8.1f}  "
+                f"evaluations/sec: {self.evaluations_per_second:9.1f}  average batch size: {self.average_batch_size:7.1f}  "
+                f"requests/batch: {self.requests_per_batch:5.2f}")
+
+
+def play_pool(model_path, episodes, memory, n_workers=None, parallel_games=None, load_model=load_registered_model):
+    """
+    Plays episodes games distributed over n_workers processes and commits the samples to memory
+    :param n_workers: SELF_PLAY_WORKERS if None
+    :param parallel_games: SELF_PLAY_PARALLEL_GAMES if None
+    :param load_model: function of the model path returning model, model_extra, called in the inference process.
+    It has to be a module level function, the processes are spawned
+    :return: memory, PoolMetrics
+    """
+    if n_workers is None:
+        n_workers = config.SELF_PLAY_WORKERS
+    if parallel_games is None:
+        parallel_games = config.SELF_PLAY_PARALLEL_GAMES
+    settings = config_settings()
+    # tensorflow does not survive a fork
+    ctx = multiprocessing.get_context("spawn")
+    n_leaves = max_leaves(parallel_games)
+    input_buffers = [ctx.RawArray('f', n_leaves * PLANES_SIZE) for _ in range(n_workers)]
+    output_buffers = [ctx.RawArray('f', n_leaves * OUTPUT_SIZE) for _ in range(n_workers)]
+    request_queue = ctx.Queue()
+    response_queues = [ctx.Queue() for _ in range(n_workers)]
+    result_queue = ctx.Queue()
+
+    server = ctx.Process(name="inference", target=inference_process, args=(model_path, load_model, settings, input_buffers, output_buffers,
+                                                                           request_queue, response_queues, result_queue, parallel_games))
+    server.start()
+
+    start = time.time()
+    workers = []
+    for worker_id in range(n_workers):
+        worker_episodes = episodes // n_workers + (1 if worker_id < episodes % n_workers else 0)
+        worker = ctx.Process(name=f"worker-{worker_id}", target=worker_process,
+                             args=(worker_id, worker_episodes, parallel_games, settings, input_buffers[worker_id],
+                                   output_buffers[worker_id], request_queue, response_queues[worker_id], result_queue))
+        worker.start()
+        workers.append(worker)
+
+    games = 0
+    positions = 0
+    for _ in range(n_workers):
+        _, worker_id, samples, worker_games, worker_positions = get_result(result_queue, [server] + workers)
+        memory.ltmemory.extend(*samples)
+        games += worker_games
+        positions += worker_positions
+    seconds = time.time() - start
+
+    request_queue.put(None)
+    _, nn_batches, nn_positions, nn_requests = get_result(result_queue, [server])
+    for worker in workers:
+        worker.join()
+    server.join()
+
+    metrics = PoolMetrics(n_workers, seconds, games, positions, nn_batches, nn_positions, nn_requests)
+    print(metrics)
+    return memory, metrics
+
+
+def scaling_benchmark(model_path, worker_counts=(2, 4, 8, 16), episodes_per_worker=2):
+    from util.memory import Memory
+
+    results = []
+    for n_workers in worker_counts:
+        _, metrics = play_pool(model_path, n_workers * episodes_per_worker, Memory(config.MEMORY_SIZE), n_workers=n_workers)
+        results.append(metrics)
+
+    print("\nSCALING")
+    for metrics in results:
+        print(metrics)
+    return results
+
+
+if __name__ == "__main__":
+    model_path = config.INITIAL_MODEL_PATH
+    if len(sys.argv) > 1:
+        model_path = sys.argv[1]
+    scaling_benchmark(model_path)
@@ -12,17 +12,21 @@ The current_player then retrains its neural network on these memories and is the
 If it wins, the neural network inside the best_player is switched for the neural network inside the current_player, and the loop starts again.
 """
 
+import os
+
 import config
 import util.logger as lg
 from shutil import copyfile
 from agent import Agent
 from keras.utils import plot_model
-import pickle
 from config import run_folder, run_archive_folder
 from util.memory import Memory
 from importlib import reload
-import random
-from util.nn_interface import load_nn
+from util.nn_interface import load_nn, predict, save_nn
+from util import model_registry
+from self_play_engine import MatchEngine, SelfPlayEngine
+from self_play_pool import play_pool
+from game.output_representation import sparse_to_dense_policy
 
 
 def initialize_run(env):
@@ -32,42 +36,51 @@ def initialize_run(env):
 
 
 def intialize_memory(env):
-    if config.INITIAL_MEMORY_VERSION is None:
-        memory = Memory(config.MEMORY_SIZE)
+    # positions are appended to the memory mapped store as they are played, a restart continues with them
+    if config.INITIAL_MEMORY_FOLDER is None:
+        memory = Memory(config.MEMORY_SIZE, run_folder + "memory/replay/")
     else:
-        print('LOADING MEMORY VERSION ' + str(config.INITIAL_MEMORY_VERSION) + '...')
-        memory = pickle.load(open(run_archive_folder + env.name + '/run' + str(config.INITIAL_RUN_NUMBER).zfill(
-            4) + "/memory/memory" + str(config.INITIAL_MEMORY_VERSION).zfill(4) + ".p", "rb"))
+        print('LOADING MEMORY FROM ' + config.INITIAL_MEMORY_FOLDER + '...')
+        memory = Memory(config.MEMORY_SIZE, config.INITIAL_MEMORY_FOLDER)
     return memory
 
 
 def initialize_neural_network(plot=False):
+    # the best model is shared with the other players of the process and only used for predictions,
+    # the new model is trained and gets its own copy. A promoted new model is saved and registered as the best model.
     if config.INITIAL_MODEL_VERSION is not None:
-        best_model = load_nn(config.INITIAL_MODEL_PATH)
-        new_model = load_nn(config.INITIAL_MODEL_PATH)
+        best_model_path = config.INITIAL_MODEL_PATH
         best_player_version = config.INITIAL_MODEL_VERSION
     else:
-        best_model = load_nn(config.PRETRAINED_MODEL_PATH)
-        new_model = load_nn(config.PRETRAINED_MODEL_PATH)
+        best_model_path = config.PRETRAINED_MODEL_PATH
         best_player_version = 0
+    best_model, model_extra = model_registry.get_model(best_model_path, inference_graph=False)
+    new_model = load_nn(best_model_path)
 
     if plot:
         plot_model(best_model, to_file=run_folder + 'models/model.png', show_shapes=True)
 
-    return best_model, new_model, best_player_version
+    return best_model, model_extra, best_model_path, new_model, best_player_version
+
 
+def model_version_path(version):
+    """
+    :return: path of a promoted model, relative to the working directory like the paths in config.py
+    """
+    return "/" + os.path.normpath(run_folder) + "/models/version" + str(version).zfill(4)
 
-def initialize_player(env, best_model, new_model):
-    best_player = Agent("best_player", env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, best_model)
-    new_player = Agent("new_player", env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, new_model)
-    return best_player, new_player
+
+def initialize_player(env, new_model):
+    # the new player only trains its network, the games are played by the engines
+    new_player = Agent("new_player", env.state_size, env.action_size, config.MCTS_SIMS, config.CPUCT, new_model, None, None)
+    return new_player
 
 
 def self_play(env, max_iteration=2500):
     initialize_run(env)
     memory = intialize_memory(env)
-    best_model, new_model, best_player_version = initialize_neural_network()
-    best_player, new_player = initialize_player(env, best_model, new_model)
+    best_model, model_extra, best_model_path, new_model, best_player_version = initialize_neural_network()
+    new_player = initialize_player(env, new_model)
     iteration = 0
 
     while iteration is not max_iteration:
@@ -82,8 +95,11 @@ def self_play(env, max_iteration=2500):
         print('BEST PLAYER VERSION ' + str(best_player_version))
 
         print('SELF PLAYING ' + str(config.EPISODES) + ' EPISODES...')
-        _, memory = playMatches(best_model, best_model, config.EPISODES, lg.logger_main,
-                                      turns_until_high_noise=config.TURNS_WITH_HIGH_NOISE, memory=memory)
+        if config.SELF_PLAY_WORKERS > 0:
+            memory, _ = play_pool(best_model_path, config.EPISODES, memory)
+        else:
+            engine = SelfPlayEngine(env, best_model, model_extra)
+            memory = engine.play(config.EPISODES, memory)
         print('\n')
 
         memory.clear_stmemory()
@@ -94,41 +110,40 @@ def self_play(env, max_iteration=2500):
             new_player.replay(memory.ltmemory)
             print('')
 
-            if iteration % 5 == 0:
-                pickle.dump(memory, open(run_folder + "memory/memory" + str(iteration).zfill(4) + ".p", "wb"))
-
             lg.logger_memory.info('====================')
             lg.logger_memory.info('NEW MEMORIES')
             lg.logger_memory.info('====================')
 
-            memory_samp = random.sample(memory.ltmemory, min(1000, len(memory.ltmemory)))
-
-            for s in memory_samp:
-                current_value, current_probs, _ = new_player.get_preds(s['state'])
-                best_value, best_probs, _ = best_player.get_preds(s['state'])
-
-                lg.logger_memory.info('MCTS VALUE FOR %s: %f', s['playerTurn'], s['value'])
-                lg.logger_memory.info('CUR PRED VALUE FOR %s: %f', s['playerTurn'], current_value)
-                lg.logger_memory.info('BES PRED VALUE FOR %s: %f', s['playerTurn'], best_value)
-                lg.logger_memory.info('THE MCTS ACTION VALUES: %s', ['%.2f' % elem for elem in s['AV']])
-                lg.logger_memory.info('CUR PRED ACTION VALUES: %s', ['%.2f' % elem for elem in current_probs])
-                lg.logger_memory.info('BES PRED ACTION VALUES: %s', ['%.2f' % elem for elem in best_probs])
-                lg.logger_memory.info('ID: %s', s['state'].id)
-                lg.logger_memory.info('INPUT TO MODEL: %s', new_player.model.convertToModelInput(s['state']))
+            _, inputs, targets = memory.ltmemory.sample(min(1000, len(memory.ltmemory)))
+            mcts_probs = sparse_to_dense_policy(targets['policy_head'])
+            current_values, current_probs = new_model.predict(inputs)
+            best_values, best_probs = predict(best_model, model_extra, inputs)
 
-                s['state'].render(lg.logger_memory)
+            for i in range(len(targets['value_head'])):
+                lg.logger_memory.info('MCTS VALUE: %f', targets['value_head'][i])
+                lg.logger_memory.info('CUR PRED VALUE: %f', current_values[i])
+                lg.logger_memory.info('BES PRED VALUE: %f', best_values[i])
+                lg.logger_memory.info('THE MCTS ACTION VALUES: %s', ['%.2f' % elem for elem in mcts_probs[i]])
+                lg.logger_memory.info('CUR PRED ACTION VALUES: %s', ['%.2f' % elem for elem in current_probs[i]])
+                lg.logger_memory.info('BES PRED ACTION VALUES: %s', ['%.2f' % elem for elem in best_probs[i]])
 
             print('TOURNAMENT...')
-            scores, _ = playMatches(best_model, new_model, config.EVAL_EPISODES,
-                                                       lg.logger_tourney, turns_until_high_noise=0, memory=None)
+            best_score, new_score = MatchEngine(env, best_model, model_extra, new_model, None).play_match(config.EVAL_EPISODES)
             print('\nSCORES')
-            print(scores)
+            print('best_player', best_score, 'new_player', new_score)
 
             print('\n\n')
 
-            if scores['current_player'] > scores['best_player'] * config.SCORING_THRESHOLD:
+            if new_score > best_score * config.SCORING_THRESHOLD:
                 best_player_version += 1
-                best_model.model.set_weights(new_model.model.get_weights())
+                # the pool processes load the best model from its file
+                replaced_model_path = best_model_path
+                best_model_path = model_version_path(best_player_version)
+                save_nn(best_model_path, new_model)
+                # the shared best model is never changed, the promoted model is loaded as a new one
+                best_model, model_extra = model_registry.get_model(best_model_path, inference_graph=False)
+                # the replaced best model is not used any more, its graph and session are freed
+                model_registry.release(replaced_model_path)
 
         else:
             print('MEMORY SIZE: ' + str(len(memory.ltmemory)))
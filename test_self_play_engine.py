@@ -0,0 +1,63 @@
+"""
+Checks of the batched search of the self play engine with a stub network, run with `python -m pytest test_self_play_engine.py`
+"""
+import config
+from game.game import Game
+from new_agent import Agent
+from self_play_engine import MatchEngine, SelfPlayEngine
+from util.memory import Memory
+from util.stub_model import StubModel
+
+
+def test_select_and_incorporate_leaves():
+    env = Game(0)
+    agent = Agent("test", env.state_size, env.action_size, 64, config.CPUCT, StubModel(), None, None)
+    agent.build_mcts(env.gameState)
+    prob, val = agent.get_preds([agent.root.state])
+    agent.root.incorporate_results(prob[0], val[0], agent.root)
+
+    leaves = agent.select_leaves(8)
+    assert 0 < len(leaves) <= 8
+    # the virtual loss spreads the leaves of one batch over different moves
+    assert len(set(id(leaf) for leaf in leaves)) == len(leaves)
+    assert all(not leaf.is_expanded for leaf in leaves)
+
+    root_n = agent.root.N
+    move_probs, values = agent.get_preds([leaf.state for leaf in leaves])
+    agent.incorporate_leaves(leaves, move_probs, values)
+    assert agent.root.N == root_n + len(leaves)
+    assert all(leaf.is_expanded for leaf in leaves)
+    # the virtual losses are reverted again
+    assert agent.root.losses_applied == 0
+
+
+def test_engine_fills_memory(monkeypatch):
+    monkeypatch.setattr(config, "SELF_PLAY_MAX_TURNS", 4)
+    monkeypatch.setattr(config, "PARALLEL_READOUTS", 4)
+    simulations, parallel_games = 16, 2
+    model = StubModel()
+    engine = SelfPlayEngine(Game(0), model, None, parallel_games=parallel_games, mcts_simulations=simulations)
+    turns = []
+    play_turn = engine.play_turn
+    monkeypatch.setattr(engine, "play_turn", lambda games: turns.append(len(games)) or play_turn(games))
+
+    memory = engine.play(3, Memory(100))
+    assert engine.games_finished == 3
+    assert len(memory.ltmemory) == engine.positions
+    assert memory.ltmemory.games == 3
+
+    # every turn evaluates the roots of all searches in one batch and then their leaves in rounds of
+    # PARALLEL_READOUTS leaves per search, the rounds of all games and boards share one batch
+    assert engine.nn_batches == model.calls
+    min_batches = len(turns) * (1 + simulations // config.PARALLEL_READOUTS)
+    assert min_batches <= engine.nn_batches <= min_batches + len(turns)
+    assert max(model.batch_sizes) == parallel_games * 2 * config.PARALLEL_READOUTS
+
+
+def test_match_engine_scores(monkeypatch):
+    monkeypatch.setattr(config, "SELF_PLAY_MAX_TURNS", 4)
+    model, opponent_model = StubModel(1), StubModel(2)
+    engine = MatchEngine(Game(0), model, None, opponent_model, None, parallel_games=2, mcts_simulations=8)
+    scores = engine.play_match(4)
+    assert sum(scores) == 4
+    assert model.calls > 0 and opponent_model.calls > 0
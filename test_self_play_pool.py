@@ -0,0 +1,38 @@
+"""
+Checks of the self play pool with a stub network, run with `python -m pytest test_self_play_pool.py`
+"""
+import config
+from self_play_pool import max_leaves, play_pool
+from util.memory import Memory
+from util.stub_model import StubModel
+
+
+class ColumnValueStub(StubModel):
+    """
+    Stub network with the (n, 1) value head of the network, which the inference process expects
+    """
+
+    def predict(self, inputs, batch_size=None):
+        value, policy = super().predict(inputs, batch_size)
+        return [value[:, None], policy]
+
+
+def load_stub_model(model_path):
+    # called in the spawned inference process
+    return ColumnValueStub(), None
+
+
+def test_pool_plays_all_games(monkeypatch):
+    monkeypatch.setattr(config, "SELF_PLAY_MAX_TURNS", 4)
+    monkeypatch.setattr(config, "MCTS_SIMS", 8)
+    monkeypatch.setattr(config, "PARALLEL_READOUTS", 4)
+    # long enough for the requests of both workers to meet
+    monkeypatch.setattr(config, "SELF_PLAY_INFERENCE_WAIT", 0.05)
+
+    memory, metrics = play_pool("stub", 4, Memory(1000), n_workers=2, parallel_games=2, load_model=load_stub_model)
+    assert metrics.games == 4
+    assert len(memory.ltmemory) == metrics.positions > 0
+    # the requests of several workers are predicted in one batch
+    assert metrics.nn_requests > metrics.nn_batches
+    # a batch holds at most the leaves of every worker
+    assert metrics.nn_positions <= metrics.nn_batches * 2 * max_leaves(2)
@@ -0,0 +1,105 @@
+"""
+asyncio client for the tournament server, hosts any number of seats in one process.
+
+The websockets of all seats are served by coroutines of one event loop: they receive the server messages,
+update the AsyncXBoardInterface of the seat and send its outgoing messages. The game loops with the search block
+on the interface (wait_for_turn) and run in a thread pool executor, so a search never blocks the connections
+of the other seats. A lost connection is opened again with a growing delay, the game of that seat ends then.
+
+Needs the websockets package (see requirements.txt), it is only imported when this client is used.
+"""
+import asyncio
+import concurrent.futures
+
+import websockets
+
+from util.xboardInterface import XBoardInterface
+
+# seconds to wait before the next connection attempt, the last one is repeated
+RECONNECT_DELAYS = [0.5, 1, 2, 5, 10]
+
+
+class AsyncXBoardInterface(XBoardInterface):
+    """
+    XBoardInterface without an own connection and reader thread, the messages come from serve_seat.
+    The game loop uses the same blocking API as with XBoardInterface.
+    """
+
+    def __init__(self, name, loop):
+        self._initState(name, "websocket")
+        self.loop = loop
+        self.outbox = asyncio.Queue()
+        # number of the connection, messages are queued with it and only sent on the same connection
+        self.connection = 0
+
+    def sendViaInterfaceType(self, message):
+        # called by the game loop in the executor and by the message handler in the event loop,
+        # the put runs later in the event loop, so the connection is taken now
+        self.loop.call_soon_threadsafe(self.outbox.put_nowait, (self.connection, message))
+
+    def connectionLost(self):
+        """
+        Ends the running game, the moves of the old connection are not sent any more.
+        sendAction drops the moves of searches which finish later, because the game is done.
+        """
+        with self.stateChanged:
+            self.connection += 1
+            if self.gameStarted:
+                self.done = True
+            self.stateChanged.notify_all()
+        while not self.outbox.empty():
+            self.outbox.get_nowait()
+
+
+async def send_messages(ws, interface):
+    while True:
+        connection, message = await interface.outbox.get()
+        # queued for an earlier connection before it was lost
+        if connection == interface.connection:
+            await ws.send(message)
+
+
+async def serve_seat(interface, server_address):
+    """
+    Keeps the connection of one seat open and forwards its messages, reconnects after a failure
+    """
+    attempt = 0
+    while True:
+        try:
+            async with websockets.connect(server_address) as ws:
+                attempt = 0
+                interface.logViaInterfaceType(f"[connected] {server_address}")
+                sender = asyncio.ensure_future(send_messages(ws, interface))
+                try:
+                    async for message in ws:
+                        interface._handleServerMessage(str(message))
+                finally:
+                    sender.cancel()
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            interface.logViaInterfaceType(f"[connection error] {e}")
+
+        interface.connectionLost()
+        delay = RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)]
+        attempt += 1
+        interface.logViaInterfaceType(f"[reconnect] in {delay}s")
+        await asyncio.sleep(delay)
+
+
+async def run_seats(names, server_address, play_seat, max_workers=None):
+    """
+    Connects one seat per name and plays on all of them until the process is stopped
+    :param play_seat: function (name, interface) creating the agent of a seat and playing its games,
+        called in the executor
+    :param max_workers: threads for the game loops, one per seat by default
+    """
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(names))
+    interfaces = [AsyncXBoardInterface(name, loop) for name in names]
+    connections = [asyncio.ensure_future(serve_seat(interface, server_address)) for interface in interfaces]
+    games = [loop.run_in_executor(executor, play_seat, interface.name, interface) for interface in interfaces]
+    await asyncio.gather(*connections, *games)
+
+
+def run(names, server_address, play_seat, max_workers=None):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_seats(names, server_address, play_seat, max_workers))
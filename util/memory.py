@@ -1,27 +1,278 @@
 """
 An instance of the Memory class stores the memories of previous games, that the algorithm uses to retrain the neural network of the current_player.
+
+The long term memory is a ReplayBuffer: preallocated numpy ring arrays holding both boards as packed boards
+(see game/packed_representation.py), the sparse policy target (most visited moves of the search) and the value target
+of every position. The planes are only expanded for the sampled batches.
+The ReplayStore keeps the same arrays in memory mapped files, so self play and training can run in separate processes.
 """
 
+import json
+import os
+
 import numpy as np
-from collections import deque
 
 import config
+from game import output_representation
+from game.constants import NB_SPARSE_POLICY
+from game.packed_representation import PACKED_BOARD_BYTES, board_to_packed, packed_to_planes
+
+
+def encode_state(state):
+    """
+    :param state: GameState
+    :return: packed board and packed partner board
+    """
+    return board_to_packed(state.board), board_to_packed(state.partner_board)
+
+
+# name: (shape of one entry, dtype)
+FIELDS = {
+    "boards1": ((PACKED_BOARD_BYTES,), np.uint8),
+    "boards2": ((PACKED_BOARD_BYTES,), np.uint8),
+    # sparse policy targets, see output_representation.policy_to_sparse
+    "policies": ((2 * NB_SPARSE_POLICY,), np.float32),
+    "values": ((), np.float32),
+    "priorities": ((), np.float32),
+    "game_ids": ((), np.int64),
+}
+
+
+class ReplayBuffer:
+    def __init__(self, size):
+        self.size = size
+        for name, (shape, dtype) in FIELDS.items():
+            setattr(self, name, self.allocate(name, (size,) + shape, dtype))
+        self.max_priority = 1.
+
+        # index of the next slot to write, number of valid entries and number of games added so far
+        self.cursor = 0
+        self.count = 0
+        self.games = 0
+
+    def allocate(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, board1, board2, policy, value, game_id):
+        i = self.cursor
+        self.boards1[i] = board1
+        self.boards2[i] = board2
+        self.policies[i] = policy
+        self.values[i] = value
+        self.game_ids[i] = game_id
+        # new samples get the highest priority, so they are sampled at least once
+        self.priorities[i] = self.max_priority
+
+        self.cursor = (self.cursor + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def append_game(self, samples):
+        """
+        :param samples: list of (board1, board2, policy, value) of one game
+        """
+        for sample in samples:
+            self.append(*sample, self.games)
+        self.games += 1
+
+    def extend(self, boards1, boards2, policies, values, game_ids):
+        """
+        Appends the valid arrays of another buffer, its games get new ids in this buffer
+        """
+        _, game_numbers = np.unique(game_ids, return_inverse=True)
+        if len(game_numbers) == 0:
+            return
+        new_games = int(game_numbers.max()) + 1
+        columns = {"boards1": boards1, "boards2": boards2, "policies": policies, "values": values,
+                   "game_ids": self.games + game_numbers}
+        # only the newest size entries fit into the ring, they go where appending one by one would put them
+        total = len(game_numbers)
+        n = min(total, self.size)
+        start = (self.cursor + total - n) % self.size
+        columns = {name: np.asarray(column)[-n:] for name, column in columns.items()}
+        columns["priorities"] = np.full(n, self.max_priority, dtype=np.float32)
+
+        # at most two slices: up to the end of the ring and from its start
+        first = min(n, self.size - start)
+        for name, column in columns.items():
+            array = getattr(self, name)
+            array[start:start + first] = column[:first]
+            array[:n - first] = column[first:]
+
+        self.cursor = (self.cursor + total) % self.size
+        self.count = min(self.count + total, self.size)
+        self.games += new_games
+
+    def valid_arrays(self):
+        """
+        :return: boards1, boards2, policies, values, game_ids of all valid entries (oldest first)
+        """
+        order = self.indices()
+        return self.boards1[order], self.boards2[order], self.policies[order], self.values[order], self.game_ids[order]
+
+    def indices(self):
+        """
+        :return: indices of all valid entries, oldest first
+        """
+        if self.count < self.size:
+            return np.arange(self.count)
+        return (np.arange(self.size) + self.cursor) % self.size
+
+    def sample_indices(self, batch_size, prioritized=False, alpha=0.6):
+        if prioritized:
+            p = self.priorities[:self.count] ** alpha
+            return np.random.choice(self.count, batch_size, p=p / p.sum())
+        return np.random.randint(0, self.count, batch_size)
+
+    def window_indices(self, last_games):
+        """
+        :return: indices of all valid entries which belong to the last last_games games
+        """
+        return np.flatnonzero(self.game_ids[:self.count] >= self.games - last_games)
+
+    def batch(self, indices):
+        """
+        :return: network inputs and targets for the given indices
+        """
+        inputs = {"input_1": packed_to_planes(self.boards1[indices]), "input_2": packed_to_planes(self.boards2[indices])}
+        targets = {"value_head": self.values[indices], "policy_head": self.policies[indices]}
+        return inputs, targets
+
+    def sample(self, batch_size, prioritized=False, last_games=None):
+        """
+        :param last_games: if set, only positions of the last last_games games are sampled (uniformly),
+            the whole buffer is sampled if none of them is left
+        :return: indices, inputs, targets
+        """
+        if self.count == 0:
+            raise ValueError("cannot sample from an empty replay buffer")
+        window = self.window_indices(last_games) if last_games is not None else None
+        if window is not None and len(window):
+            indices = window[np.random.randint(0, len(window), batch_size)]
+        else:
+            indices = self.sample_indices(batch_size, prioritized)
+        inputs, targets = self.batch(indices)
+        return indices, inputs, targets
+
+    def update_priorities(self, indices, priorities):
+        self.priorities[indices] = np.abs(priorities) + 1e-6
+        self.max_priority = max(self.max_priority, float(self.priorities[indices].max()))
+
+    def save(self, path):
+        order = self.indices()
+        np.savez(path, size=self.size, games=self.games, **{name: getattr(self, name)[order] for name in FIELDS})
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        buffer = ReplayBuffer(int(data["size"]))
+        n = len(data["values"])
+        for name in FIELDS:
+            getattr(buffer, name)[:n] = data[name]
+        buffer.count = n
+        buffer.cursor = n % buffer.size
+        buffer.games = int(data["games"])
+        if n > 0:
+            buffer.max_priority = float(buffer.priorities[:n].max())
+        return buffer
+
+
+class ReplayStore(ReplayBuffer):
+    """
+    ReplayBuffer whose arrays are memory mapped .npy files in folder, so it survives restarts.
+    A training process can open the same folder with read_only=True while self play keeps appending,
+    refresh() picks up the positions written since.
+    """
+
+    def __init__(self, folder, size, read_only=False):
+        self.folder = folder
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(folder, exist_ok=True)
+        super().__init__(size)
+        self.refresh()
+
+    def allocate(self, name, shape, dtype):
+        path = os.path.join(self.folder, name + ".npy")
+        if self.read_only:
+            return np.load(path, mmap_mode='r')
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r+')
+            if array.shape == shape:
+                return array
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def meta_path(self):
+        return os.path.join(self.folder, "meta.json")
+
+    def refresh(self):
+        if os.path.exists(self.meta_path()):
+            with open(self.meta_path()) as f:
+                meta = json.load(f)
+            if meta["size"] == self.size:
+                self.cursor = meta["cursor"]
+                self.count = meta["count"]
+                self.games = meta["games"]
+                self.max_priority = meta["max_priority"]
+        return self
+
+    def flush(self):
+        for name in FIELDS:
+            getattr(self, name).flush()
+        # the meta file is replaced atomically, readers never see a half written one
+        tmp_path = self.meta_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self.size, "cursor": self.cursor, "count": self.count, "games": self.games,
+                       "max_priority": self.max_priority}, f)
+        os.replace(tmp_path, self.meta_path())
+
+    def append_game(self, samples):
+        super().append_game(samples)
+        self.flush()
+
+    def extend(self, boards1, boards2, policies, values, game_ids):
+        super().extend(boards1, boards2, policies, values, game_ids)
+        self.flush()
 
 
 class Memory:
-    def __init__(self, MEMORY_SIZE):
-        self.MEMORY_SIZE = config.MEMORY_SIZE
-        self.ltmemory = deque(maxlen=config.MEMORY_SIZE)
-        self.stmemory = deque(maxlen=config.MEMORY_SIZE)
+    def __init__(self, MEMORY_SIZE, folder=None):
+        """
+        :param folder: if set, the long term memory is a ReplayStore in this folder
+        """
+        self.MEMORY_SIZE = MEMORY_SIZE
+        if folder is None:
+            self.ltmemory = ReplayBuffer(MEMORY_SIZE)
+        else:
+            self.ltmemory = ReplayStore(folder, MEMORY_SIZE)
+        self.stmemory = []
 
-    def commit_stmemory(self, env, state):
-        # TODO commit the env with board and mcts to the memory
-        pass
+    def commit_stmemory(self, state, action_values, value):
+        """
+        :param state: GameState the move was searched in
+        :param action_values: visit count distribution of the search (NB_LABELS,)
+        :param value: game result from the perspective of the player to move in state
+        """
+        board1, board2 = encode_state(state)
+        self.stmemory.append((board1, board2, output_representation.policy_to_sparse(action_values), value))
 
     def commit_ltmemory(self):
-        for i in self.stmemory:
-            self.ltmemory.append(i)
+        """
+        Moves the short term memory into the long term memory, it has to contain exactly one game
+        """
+        self.ltmemory.append_game(self.stmemory)
         self.clear_stmemory()
 
     def clear_stmemory(self):
-        self.stmemory = deque(maxlen=config.MEMORY_SIZE)
+        self.stmemory = []
+
+    def save(self, path):
+        self.ltmemory.save(path)
+
+    @staticmethod
+    def load(path):
+        memory = Memory(config.MEMORY_SIZE)
+        memory.ltmemory = ReplayBuffer.load(path)
+        return memory
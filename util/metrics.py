@@ -0,0 +1,116 @@
+"""
+Search statistics and performance counters.
+
+new_agent.Agent.suggest_move fills one SearchStats per move: readouts, network batches and positions, the time
+spent in leaf selection, in board_to_planes, in model.predict and in the backup, the size of the tree, the
+visits reused from the previous search and the cache hits. The engine has no evaluation cache besides the tree,
+so a cache hit is a node kept from the previous search, whose network evaluation is used again.
+The moves of a game are aggregated in GameStats, which is logged at the end of the game. With SEARCH_STATS_DUMP in
+config.py the game statistics are also written under run_folder/metrics/: one JSON file per game
+(<agent>-<start of the process>-<pid>-game<number>.json, so a restarted run keeps the files of the earlier ones)
+or a Prometheus text file with counters of all games of the process ("prometheus").
+"""
+import json
+import os
+import threading
+import time
+
+SEARCH_FIELDS = ["readouts", "terminal_leaves", "nn_batches", "nn_positions", "reused_visits", "cache_hits", "tree_nodes",
+                 "time_total", "time_select", "time_planes", "time_predict", "time_backup"]
+TIME_FIELDS = [field for field in SEARCH_FIELDS if field.startswith("time_")]
+
+
+class SearchStats:
+    __slots__ = SEARCH_FIELDS
+
+    def __init__(self):
+        for field in SEARCH_FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        stats = {field: getattr(self, field) for field in SEARCH_FIELDS}
+        stats["nodes_per_sec"] = self.readouts / self.time_total if self.time_total > 0 else 0.0
+        stats["avg_batch_size"] = self.nn_positions / self.nn_batches if self.nn_batches else 0.0
+        return stats
+
+    def summary(self):
+        stats = self.as_dict()
+        return ("%(readouts)i readouts in %(time_total).3fs (%(nodes_per_sec).1f nodes/s), %(nn_batches)i batches "
+                "of %(avg_batch_size).1f, select %(time_select).3fs planes %(time_planes).3fs predict %(time_predict).3fs "
+                "backup %(time_backup).3fs, tree %(tree_nodes)i nodes, reused %(reused_visits)i visits, "
+                "%(cache_hits)i cache hits" % stats)
+
+
+class GameStats:
+    def __init__(self, name):
+        self.name = name
+        self.moves = []
+        self.totals = {field: 0 for field in SEARCH_FIELDS}
+
+    def add(self, search_stats):
+        self.moves.append(search_stats.as_dict())
+        for field in SEARCH_FIELDS:
+            self.totals[field] += getattr(search_stats, field)
+
+    def as_dict(self):
+        totals = dict(self.totals)
+        totals["searches"] = len(self.moves)
+        totals["nodes_per_sec"] = totals["readouts"] / totals["time_total"] if totals["time_total"] > 0 else 0.0
+        totals["avg_batch_size"] = totals["nn_positions"] / totals["nn_batches"] if totals["nn_batches"] else 0.0
+        return {"agent": self.name, "totals": totals, "moves": self.moves}
+
+    def summary(self):
+        totals = self.as_dict()["totals"]
+        time_shares = ", ".join("%s %.0f%%" % (field[5:], 100 * totals[field] / totals["time_total"])
+                                for field in TIME_FIELDS[1:] if totals["time_total"] > 0)
+        return "[%s] %i searches, %i readouts, %.1f nodes/s, avg batch %.1f, %s" % (
+            self.name, totals["searches"], totals["readouts"], totals["nodes_per_sec"], totals["avg_batch_size"], time_shares)
+
+
+# counters over all games of the process, by agent name
+_process_totals = {}
+_lock = threading.Lock()
+# part of the JSON file names, the game numbers start again in every process
+_run_id = "%s-%i" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+
+
+def record_game(game_stats, run_folder, dump=None):
+    """
+    Adds a finished game to the process counters and writes the statistics if dump is "json" or "prometheus"
+    """
+    with _lock:
+        totals = _process_totals.setdefault(game_stats.name, dict({field: 0 for field in SEARCH_FIELDS}, games=0))
+        for field in SEARCH_FIELDS:
+            totals[field] += game_stats.totals[field]
+        totals["games"] += 1
+
+        if dump is None:
+            return
+        folder = os.path.join(run_folder, "metrics")
+        os.makedirs(folder, exist_ok=True)
+        if dump == "json":
+            name = "%s-%s-game%03i.json" % (game_stats.name.replace(" ", "_"), _run_id, totals["games"])
+            with open(os.path.join(folder, name), "w") as f:
+                json.dump(game_stats.as_dict(), f, indent=1)
+        elif dump == "prometheus":
+            write_prometheus(os.path.join(folder, "search_stats.prom"))
+
+
+def write_prometheus(path):
+    """
+    Writes the process counters in the Prometheus text format, atomically for the textfile collector
+    """
+    lines = []
+    for field in ["games"] + [field for field in SEARCH_FIELDS if field not in TIME_FIELDS]:
+        metric = "tandemturtle_search_%s_total" % field
+        lines.append("# TYPE %s counter" % metric)
+        for agent, totals in sorted(_process_totals.items()):
+            lines.append('%s{agent="%s"} %s' % (metric, agent, totals[field]))
+    # the times as one metric with the phase as label, phase="total" is the whole search
+    lines.append("# TYPE tandemturtle_search_seconds_total counter")
+    for agent, totals in sorted(_process_totals.items()):
+        for field in TIME_FIELDS:
+            lines.append('tandemturtle_search_seconds_total{agent="%s",phase="%s"} %s' % (agent, field[5:], totals[field]))
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,71 @@
+"""
+Process wide registry of the loaded networks.
+
+All agents of a process (up to four seats in main.py, the players and engines of the self play) get their network
+from get_model. Every checkpoint is loaded once into its own graph and session and the same model and model_extra
+([graph, sess]) are returned to every caller. The agents only predict with the shared models, a model which is
+trained has to be loaded separately with nn_interface.load_nn. A model which is replaced, like the best model of the
+self play after a promotion, is released again.
+"""
+import threading
+import time
+
+import util.nn_interface as nni
+
+_models = {}
+_lock = threading.Lock()
+
+
+def _load(path_to_nn, inference_graph):
+    if inference_graph:
+        return nni.load_inference_model(path_to_nn)
+
+    import tensorflow as tf
+    from tensorflow.python.keras.backend import set_session
+
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(graph=graph)
+        set_session(sess)
+        model = nni.load_nn(path_to_nn, save_weights_bool=True, load_weights=True)
+    return model, [graph, sess]
+
+
+def get_model(path_to_nn, inference_graph=True):
+    """
+    Loads the checkpoint at the first call, later calls with the same arguments return the same objects.
+    Threads asking for a model while it is loaded wait for it.
+    :param path_to_nn: path of the model, relative to the working directory like in nn_interface
+    :param inference_graph: True for the frozen inference graph, False for the Keras model
+    :return: model, model_extra
+    """
+    key = (path_to_nn, inference_graph)
+    with _lock:
+        if key not in _models:
+            st_time = time.time()
+            _models[key] = _load(path_to_nn, inference_graph)
+            print(f"Registered model {path_to_nn} (inference graph {inference_graph}) in {time.time() - st_time:.3f}s")
+        return _models[key]
+
+
+def release(path_to_nn):
+    """
+    Forgets the models loaded from path_to_nn and closes their sessions. The callers must not predict with them any more.
+    :return: number of released models
+    """
+    with _lock:
+        keys = [key for key in _models if key[0] == path_to_nn]
+        for key in keys:
+            _, model_extra = _models.pop(key)
+            model_extra[1].close()
+    if keys:
+        print(f"Released model {path_to_nn}")
+    return len(keys)
+
+
+def loaded_models():
+    """
+    :return: the (path, inference graph) keys of the loaded models
+    """
+    with _lock:
+        return list(_models)
@@ -1,17 +1,42 @@
-from pretraining.nn_tf import NeuralNetwork, sign_metric
-from tensorflow.keras.models import load_model
+"""
+Loading of the networks. TensorFlow and the network code are only imported when a network is loaded,
+so modules using this interface start without them.
+
+For playing, load_inference_model loads a frozen inference graph (INFERENCE_GRAPH_SUFFIX next to the model) with the
+weights stored as constants. It is exported once from the model and then used at every start, which skips building
+and compiling the Keras model. The tensor names of the inputs and outputs are written next to it (INFERENCE_NAMES_SUFFIX),
+because TensorFlow renames placeholders whose name is taken (the input layer "input_1" may be the tensor "input_1_1:0").
+"""
+import json
 import os
 import time
 
+INFERENCE_GRAPH_SUFFIX = ".frozen.pb"
+INFERENCE_NAMES_SUFFIX = ".frozen.json"
+# identity ops added to the outputs before freezing, in the order of model.outputs
+OUTPUT_NAMES = ["value_output", "policy_output"]
+
 
 def save_weights(path_to_nn):
+    """
+    Writes the weights of the model at path_to_nn to <path_to_nn>.h5, unless they are already newer than the model
+    """
+    from pretraining.nn_tf import CUSTOM_OBJECTS
+    from tensorflow.keras.models import load_model
+
     path = os.getcwd()
+    model_path = path + path_to_nn
+    weights_path = model_path + ".h5"
 
-    # If file is already existent, skip this part
-    if not os.path.isfile(path + path_to_nn + ".h5"):
-        model = load_model(path + path_to_nn,
-                           custom_objects={'sign_metric': sign_metric})
-        model.save_weights(path + path_to_nn + ".h5")
+    # a model saved again, e.g. a promoted model under its old name, gets its weights written again
+    if not os.path.isfile(weights_path) or \
+            (os.path.exists(model_path) and os.path.getmtime(model_path) > os.path.getmtime(weights_path)):
+        model = load_model(model_path,
+                           custom_objects=CUSTOM_OBJECTS)
+        # Keras picks the format by the extension, the file is replaced atomically like the inference graph
+        tmp_path = "%s.%i.tmp.h5" % (model_path, os.getpid())
+        model.save_weights(tmp_path)
+        os.replace(tmp_path, weights_path)
 
 
 def load_nn(path_to_nn="", save_weights_bool=False, load_weights=False):
@@ -25,6 +50,9 @@ def load_nn(path_to_nn="", save_weights_bool=False, load_weights=False):
     is the same as the loaded model. Set to false if unsure of architecture
     :return:
     """
+    from pretraining.nn_tf import NeuralNetwork, CUSTOM_OBJECTS
+    from tensorflow.keras.models import load_model
+
     # Load pre trained model if path exists
     st_time = time.time()
     if path_to_nn == "":
@@ -44,12 +72,151 @@ def load_nn(path_to_nn="", save_weights_bool=False, load_weights=False):
             path = os.getcwd()
             print("Load nn from ", path + path_to_nn)
             model = load_model(path + path_to_nn,
-                               custom_objects={'sign_metric': sign_metric})
+                               custom_objects=CUSTOM_OBJECTS)
 
     print(f"Time for loading one model with load weigths {load_weights}: ", time.time() - st_time)
     return model
 
 
+def compile_sparse(model):
+    """
+    Compiles the model for the sparse policy targets of the replay memory, with the losses of
+    pretraining/training_from_database_tf.py. A loaded model is compiled for dense targets or not at all.
+    """
+    from pretraining.nn_tf import sign_metric, sparse_policy_loss, sparse_policy_accuracy
+
+    losses = {"policy_head": sparse_policy_loss, "value_head": "mean_squared_error"}
+    loss_weights = {"policy_head": 10.0, "value_head": 1.0}
+    metrics = {"policy_head": [sparse_policy_accuracy], "value_head": [sign_metric]}
+    model.compile(loss=losses, optimizer="adam", metrics=metrics, loss_weights=loss_weights)
+
+
+def predict(model, model_extra, inputs, batch_size=None):
+    """
+    Predicts with a model in its own graph and session
+    :param model_extra: [graph, sess] of the model, None for a model without session (the stub network of bench.py)
+    :return: [value head, policy head]
+    """
+    if model_extra is None:
+        return model.predict(inputs, batch_size=batch_size)
+
+    from tensorflow.python.keras.backend import set_session
+
+    with model_extra[0].as_default():
+        set_session(model_extra[1])
+        return model.predict(inputs, batch_size=batch_size)
+
+
+class FrozenModel:
+    """
+    Inference graph with the predict interface of a Keras model, predict returns [value head, policy head]
+    """
+
+    ##########
+    # param:
+    # names - {"inputs": {input layer name: tensor name}, "outputs": [tensor names]} written by export_inference_graph
+    ##########
+    def __init__(self, graph, sess, names):
+        self.graph = graph
+        self.sess = sess
+        self.inputs = {name: graph.get_tensor_by_name(tensor) for name, tensor in names["inputs"].items()}
+        self.outputs = [graph.get_tensor_by_name(tensor) for tensor in names["outputs"]]
+
+    def predict(self, inputs, batch_size=None):
+        """
+        :param inputs: {"input_1": planes, "input_2": planes} like for the Keras model
+        :param batch_size: not used, the whole input is one batch
+        """
+        feed_dict = {tensor: inputs[name] for name, tensor in self.inputs.items()}
+        return self.sess.run(self.outputs, feed_dict=feed_dict)
+
+
+def write_atomic(path, data):
+    """
+    Writes the bytes to a temporary file which then replaces path, so a reader never sees a partial file
+    """
+    tmp_path = "%s.%i.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def export_inference_graph(path_to_nn):
+    """
+    Freezes the model at path_to_nn into an inference graph with the weights as constants
+    :return: path of the inference graph
+    """
+    import tensorflow as tf
+    from tensorflow.python.keras.backend import set_learning_phase, set_session
+
+    st_time = time.time()
+    # the weights are written in a graph of their own, the full model loaded for it would clash with the export graph
+    with tf.Graph().as_default():
+        sess = tf.Session()
+        set_session(sess)
+        save_weights(path_to_nn)
+        sess.close()
+
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(graph=graph)
+        set_session(sess)
+        set_learning_phase(0)
+        model = load_nn(path_to_nn, load_weights=True)
+        outputs = [tf.identity(output, name=name) for output, name in zip(model.outputs, OUTPUT_NAMES)]
+        names = {"inputs": {name: tensor.name for name, tensor in zip(model.input_names, model.inputs)},
+                 "outputs": [output.name for output in outputs]}
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [output.op.name for output in outputs])
+        sess.close()
+
+    # several engine processes may export at the same time
+    path = os.getcwd() + path_to_nn + INFERENCE_GRAPH_SUFFIX
+    write_atomic(os.getcwd() + path_to_nn + INFERENCE_NAMES_SUFFIX, json.dumps(names).encode())
+    write_atomic(path, graph_def.SerializeToString())
+    print("Exported inference graph to ", path, " in ", time.time() - st_time)
+    return path
+
+
+def load_inference_model(path_to_nn):
+    """
+    Loads the inference graph of the model at path_to_nn, it is exported first if it does not exist
+    or is older than the model
+    :return: FrozenModel, [graph, sess]
+    """
+    import tensorflow as tf
+
+    st_time = time.time()
+    path = os.getcwd() + path_to_nn + INFERENCE_GRAPH_SUFFIX
+    names_path = os.getcwd() + path_to_nn + INFERENCE_NAMES_SUFFIX
+    model_path = os.getcwd() + path_to_nn
+    if not os.path.isfile(path) or not os.path.isfile(names_path) or \
+            (os.path.exists(model_path) and os.path.getmtime(model_path) > os.path.getmtime(path)):
+        export_inference_graph(path_to_nn)
+
+    graph_def = tf.GraphDef()
+    with open(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    with open(names_path) as f:
+        names = json.load(f)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    sess = tf.Session(graph=graph)
+    model = FrozenModel(graph, sess, names)
+
+    print("Time for loading the inference graph: ", time.time() - st_time)
+    return model, [graph, sess]
+
+
 def save_nn(path_to_nn, model):
-    # TODO
-    pass
+    """
+    Saves the model at path_to_nn, relative to the working directory like in load_nn.
+    The file is written next to it first and then replaced, so a process loading it never reads a partial model.
+    """
+    path = os.getcwd() + path_to_nn
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the extension keeps the HDF5 format of the models without extension
+    tmp_path = "%s.%i.tmp.h5" % (path, os.getpid())
+    model.save(tmp_path)
+    os.replace(tmp_path, path)
+    print("Saved nn to ", path)
@@ -0,0 +1,137 @@
+"""
+Sampling profiler for a whole engine session, started with `python main.py ... --profile`.
+
+A background thread takes the Python stack of every other thread every PROFILE_INTERVAL seconds, so the agent
+threads run unchanged. The samples are written in the folded stack format
+(`thread;outer function;...;inner function count` per line), which flamegraph.pl, speedscope and inferno read,
+to run_folder/profiles/profile-<pid>.folded. The file is rewritten every PROFILE_FLUSH_INTERVAL seconds and
+at exit, together with a report of the samples in the hot functions of the search (HOT_FUNCTIONS).
+
+Waiting threads are sampled too, the flame graph shows them under their thread name. The report only counts
+the samples of threads inside a search (SEARCH_FUNCTIONS), so waiting for the server or sleeping does not dilute it.
+"""
+import atexit
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+# get_preds evaluates the leaves of an agent, evaluate_agents those of the self play engine
+HOT_FUNCTIONS = ["select_leaf", "maybe_add_child", "take_action", "board_to_planes", "get_preds", "evaluate_agents"]
+# entry points of the search, the agents of a game and the self play engine, as the start of their frame names
+SEARCH_FUNCTIONS = ("suggest_move (new_agent.py", "search (self_play_engine.py")
+
+# names of the code objects already seen, every sample names the frames of all threads
+frame_names = {}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    name = frame_names.get(code)
+    if name is None:
+        name = frame_names[code] = "%s (%s:%i)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+    return name
+
+
+class SamplingProfiler:
+    def __init__(self, folder, interval=0.005, flush_interval=60):
+        self.folder = folder
+        self.path = os.path.join(folder, "profile-%i.folded" % os.getpid())
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.samples = collections.Counter()
+        self.n_samples = 0
+        self.start_time = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        self.start_time = time.time()
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.write()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        last_flush = time.time()
+        while self.running:
+            self.sample(own_id)
+            if time.time() - last_flush > self.flush_interval:
+                self.write()
+                last_flush = time.time()
+            time.sleep(self.interval)
+
+    def sample(self, own_id):
+        # threads of _thread.start_new_thread are not known to threading, they are named by their id
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, "thread-%i" % thread_id))
+            stacks.append(";".join(reversed(stack)))
+        with self.lock:
+            self.samples.update(stacks)
+            self.n_samples += 1
+
+    def hot_function_report(self):
+        """
+        :return: lines with the share of the search samples in which a hot function is on the stack (total) or
+        the innermost frame (self)
+        """
+        with self.lock:
+            samples = list(self.samples.items())
+        all_samples = sum(count for _, count in samples)
+        threads = len(set(stack.split(";")[0] for stack, _ in samples))
+        search_markers = [";" + function for function in SEARCH_FUNCTIONS]
+        samples = [(stack, count) for stack, count in samples if any(marker in stack for marker in search_markers)]
+        total = sum(count for _, count in samples)
+        lines = ["%i samples of %i threads in %.1fs" % (self.n_samples, threads, time.time() - self.start_time),
+                 "%i of %i thread samples in a search, the others are idle" % (total, all_samples)]
+        for function in HOT_FUNCTIONS:
+            marker = function + " ("
+            inclusive = sum(count for stack, count in samples if marker in stack)
+            exclusive = sum(count for stack, count in samples if stack.rsplit(";", 1)[-1].startswith(marker))
+            lines.append("%-16s total %6.2f%%  self %6.2f%%" % (function, 100 * inclusive / max(total, 1),
+                                                                100 * exclusive / max(total, 1)))
+        return lines
+
+    def write(self):
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock:
+            lines = ["%s %i" % (stack, count) for stack, count in self.samples.most_common()]
+        with open(self.path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        report = self.hot_function_report()
+        with open(os.path.splitext(self.path)[0] + ".txt", "w") as f:
+            f.write("\n".join(report) + "\n")
+        return report
+
+
+def start(folder, interval=0.005, flush_interval=60):
+    """
+    Profiles the process until it exits, also on SIGTERM
+    :return: the SamplingProfiler
+    """
+    profiler = SamplingProfiler(folder, interval, flush_interval)
+    profiler.start()
+
+    def stop():
+        if profiler.running:
+            profiler.stop()
+            print("\n".join(["[profiler] written to " + profiler.path] + profiler.hot_function_report()))
+
+    atexit.register(stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("[profiler] sampling every %.3fs into %s" % (interval, profiler.path))
+    return profiler
@@ -0,0 +1,27 @@
+"""
+Stand-in for the network, used by the tests and by bench.py to measure only the search. No TensorFlow needed.
+"""
+import numpy as np
+
+from game.constants import NB_LABELS
+
+
+class StubModel:
+    """
+    Network with the predict interface of nn_interface.FrozenModel, returns seeded pseudo random heads.
+    The value head is flat, the search takes it like the (n, 1) head of the network.
+    """
+
+    def __init__(self, seed=0):
+        self.rng = np.random.RandomState(seed)
+        # number of predict calls and sizes of their batches
+        self.calls = 0
+        self.batch_sizes = []
+
+    def predict(self, inputs, batch_size=None):
+        n = len(inputs["input_1"])
+        self.calls += 1
+        self.batch_sizes.append(n)
+        value = self.rng.uniform(-1, 1, n).astype(np.float32)
+        policy = self.rng.random_sample((n, NB_LABELS)).astype(np.float32)
+        return [value, policy]
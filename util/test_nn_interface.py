@@ -0,0 +1,57 @@
+"""
+Checks that the inference graph follows the saved model, run with
+`python -m pytest --import-mode=importlib util/test_nn_interface.py`
+"""
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+import pretraining.config_training as cf
+from util import nn_interface as nni
+
+rng = np.random.RandomState(0)
+INPUTS = {"input_1": rng.rand(4, *cf.INPUT_SHAPE_CHANNELS_LAST).astype(np.float32),
+          "input_2": rng.rand(4, *cf.INPUT_SHAPE_CHANNELS_LAST).astype(np.float32)}
+
+
+def save_new_model(path_to_nn):
+    """
+    Saves a new randomly initialized network at path_to_nn
+    :return: the outputs of the Keras model for INPUTS
+    """
+    from pretraining.nn_tf import NeuralNetwork
+    from tensorflow.python.keras.backend import set_session
+
+    with tf.Graph().as_default():
+        sess = tf.Session()
+        set_session(sess)
+        model = NeuralNetwork().model
+        nni.save_nn(path_to_nn, model)
+        outputs = model.predict(INPUTS)
+        sess.close()
+    return outputs
+
+
+def test_inference_graph_follows_saved_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # a small network, the test only needs different weights
+    monkeypatch.setattr(cf, "NR_RESIDUAL_LAYERS", 1)
+    monkeypatch.setattr(cf, "NR_CONV_FILTERS", 16)
+
+    expected = save_new_model("/model")
+    model, model_extra = nni.load_inference_model("/model")
+    first = nni.predict(model, model_extra, INPUTS)
+    np.testing.assert_allclose(first[1], expected[1], atol=1e-5)
+
+    # the file system may store the times in seconds, the files of the first model are made older
+    for name in os.listdir(str(tmp_path)):
+        old_time = os.path.getmtime(str(tmp_path / name)) - 10
+        os.utime(str(tmp_path / name), (old_time, old_time))
+    expected = save_new_model("/model")
+    model, model_extra = nni.load_inference_model("/model")
+    second = nni.predict(model, model_extra, INPUTS)
+    np.testing.assert_allclose(second[1], expected[1], atol=1e-5)
+    assert not np.allclose(first[1], second[1])
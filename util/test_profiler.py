@@ -0,0 +1,49 @@
+"""
+Checks that the profiler reports the search of the agents and of the self play engine, run with
+`python -m pytest --import-mode=importlib util/test_profiler.py`
+"""
+import threading
+
+import config
+from game.game import Game
+from new_agent import Agent
+from self_play_engine import SelfPlayEngine
+from util.profiler import SamplingProfiler
+from util.stub_model import StubModel
+
+
+def profile(tmp_path, run):
+    """
+    Runs run under the profiler, next to a thread which only waits
+    :return: the hot function report as {line name: line}
+    """
+    profiler = SamplingProfiler(str(tmp_path), interval=0.001)
+    stop_waiting = threading.Event()
+    threading.Thread(target=stop_waiting.wait, name="waiting", daemon=True).start()
+    profiler.start()
+    run()
+    profiler.running = False
+    stop_waiting.set()
+    return {line.split()[0]: line for line in profiler.write()[2:]}
+
+
+def search_share(report, function):
+    # "<function> total <share>%  self <share>%"
+    return float(report[function].split()[2].rstrip("%"))
+
+
+def test_report_of_an_agent(tmp_path):
+    env = Game(0)
+    agent = Agent("profiled", env.state_size, env.action_size, 200, config.CPUCT, StubModel(), None, None)
+    agent.build_mcts(env.gameState)
+    report = profile(tmp_path, lambda: agent.suggest_move(False))
+    assert search_share(report, "select_leaf") > 0
+    assert search_share(report, "get_preds") > 0
+
+
+def test_report_of_the_self_play_engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SELF_PLAY_MAX_TURNS", 4)
+    engine = SelfPlayEngine(Game(0), StubModel(), None, parallel_games=2, mcts_simulations=50)
+    report = profile(tmp_path, lambda: engine.play(2, None))
+    assert search_share(report, "select_leaf") > 0
+    assert search_share(report, "evaluate_agents") > 0
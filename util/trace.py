@@ -0,0 +1,199 @@
+"""
+Structured tracing of the MCTS search.
+
+The tracer is off by default and every call site checks `tracer.enabled` before it collects anything,
+so a disabled tracer costs one attribute lookup per search step. When it is on (MCTS_TRACE in config.py),
+every search writes records to run_folder/traces/:
+  search_start / search_end: one JSON line each, with the root position, the chosen move and the most visited moves
+  leaf: one record per evaluated or terminal leaf: search id, depth, first move from the root, value, terminal flag
+The leaf records are JSON lines as well, or fixed size binary records (LEAF_DTYPE) in a .bin file next to the
+.jsonl file with MCTS_TRACE_FORMAT = "binary", which is about 8 times smaller.
+
+Summarize a trace offline with `python -m util.trace run/traces/mcts-<pid>.jsonl`.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+LEAF_DTYPE = np.dtype([
+    ("search", "<u4"),
+    ("depth", "<u2"),
+    ("first_move", "<i2"),
+    ("value", "<f4"),
+    ("terminal", "u1"),
+])
+LEAF_BUFFER_SIZE = 4096
+
+
+def node_path(leaf, root):
+    """
+    :return: depth of the leaf below the root and the policy index of the first move from the root (-1 for the root)
+    """
+    depth = 0
+    first_move = -1
+    node = leaf
+    while node is not root and node.parent is not None and node.fmove is not None:
+        depth += 1
+        first_move = node.fmove
+        node = node.parent
+    return depth, first_move
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.binary = False
+        self.file = None
+        self.leaf_file = None
+        self.leaves = np.zeros(LEAF_BUFFER_SIZE, dtype=LEAF_DTYPE)
+        self.n_leaves = 0
+        self.n_searches = 0
+        self.lock = threading.Lock()
+
+    def open(self, path, binary=False):
+        """
+        Starts tracing into path (.jsonl), binary leaf records go to the same path with .bin
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.binary = binary
+        self.file = open(path, "w")
+        if binary:
+            self.leaf_file = open(os.path.splitext(path)[0] + ".bin", "wb")
+        self.enabled = True
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def search_start(self, agent_name, root):
+        """
+        :return: id of the search, passed to the other calls
+        """
+        with self.lock:
+            self.n_searches += 1
+            search = self.n_searches
+            self.write({"event": "search_start", "search": search, "agent": agent_name, "time": time.time(),
+                        "fen": root.state.boards.fen(), "board": root.state.board_number,
+                        "white": bool(root.state.board.turn), "N": int(root.N)})
+        return search
+
+    def leaf(self, search, leaf, root, value, terminal=False):
+        depth, first_move = node_path(leaf, root)
+        with self.lock:
+            if self.binary:
+                self.leaves[self.n_leaves] = (search, depth, first_move, float(np.ravel(value)[0]), terminal)
+                self.n_leaves += 1
+                if self.n_leaves == LEAF_BUFFER_SIZE:
+                    self.flush_leaves()
+            else:
+                self.write({"event": "leaf", "search": search, "depth": depth, "first_move": int(first_move),
+                            "value": float(np.ravel(value)[0]), "terminal": bool(terminal)})
+
+    def search_end(self, search, root, move, top_k=5):
+        visits = root.child_N
+        top = np.argsort(visits)[::-1][:top_k]
+        with self.lock:
+            self.write({"event": "search_end", "search": search, "time": time.time(), "move": str(move),
+                        "N": int(root.N), "Q": float(root.Q),
+                        "top": [[int(i), int(visits[i]), float(root.child_Q[i]), float(root.child_prior[i])] for i in top if visits[i] > 0]})
+            self.flush_leaves()
+            self.file.flush()
+
+    def flush_leaves(self):
+        if self.n_leaves:
+            self.leaves[:self.n_leaves].tofile(self.leaf_file)
+            self.n_leaves = 0
+
+    def close(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            if self.binary:
+                self.flush_leaves()
+                self.leaf_file.close()
+            self.file.close()
+
+
+# the tracer of the process, opened by open_from_config
+tracer = Tracer()
+
+
+def open_from_config():
+    import config
+    if config.MCTS_TRACE and not tracer.enabled:
+        tracer.open(os.path.join(config.run_folder, "traces", "mcts-%i.jsonl" % os.getpid()),
+                    binary=config.MCTS_TRACE_FORMAT == "binary")
+    return tracer
+
+
+def read_trace(path):
+    """
+    :return: search_start records, search_end records and the leaves as array with LEAF_DTYPE
+    """
+    starts, ends, leaves = {}, {}, []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["event"] == "search_start":
+                starts[record["search"]] = record
+            elif record["event"] == "search_end":
+                ends[record["search"]] = record
+            else:
+                leaves.append((record["search"], record["depth"], record["first_move"], record["value"], record["terminal"]))
+    leaves = np.array(leaves, dtype=LEAF_DTYPE)
+    bin_path = os.path.splitext(path)[0] + ".bin"
+    if os.path.exists(bin_path):
+        leaves = np.concatenate([leaves, np.fromfile(bin_path, dtype=LEAF_DTYPE)])
+    return starts, ends, leaves
+
+
+def summarize(path, max_searches=20):
+    """
+    Prints the statistics of every search and of the whole trace
+    """
+    from game.output_representation import policy_idx_to_move
+
+    starts, ends, leaves = read_trace(path)
+    order = np.argsort(leaves["search"], kind="stable")
+    leaves = leaves[order]
+    bounds = np.searchsorted(leaves["search"], sorted(starts), side="left")
+    bounds_end = np.searchsorted(leaves["search"], sorted(starts), side="right")
+
+    print("%-7s %-14s %7s %7s %6s %6s %7s %8s %s" % ("search", "agent", "leaves", "term", "depth", "max", "value", "sec", "move (visits of the most visited moves)"))
+    seconds = []
+    for i, search in enumerate(sorted(starts)):
+        start, end = starts[search], ends.get(search)
+        search_leaves = leaves[bounds[i]:bounds_end[i]]
+        duration = end["time"] - start["time"] if end else float("nan")
+        seconds.append(duration)
+        if i >= max_searches:
+            continue
+        top = ""
+        if end:
+            top = end["move"] + " (" + ", ".join("%s:%i" % (policy_idx_to_move(idx, start["white"], start["board"]).uci(), n)
+                                                 for idx, n, _, _ in end["top"]) + ")"
+        print("%-7i %-14s %7i %7i %6.2f %6i %7.3f %8.3f %s" % (
+            search, start["agent"][:14], len(search_leaves), search_leaves["terminal"].sum(),
+            search_leaves["depth"].mean() if len(search_leaves) else 0, search_leaves["depth"].max() if len(search_leaves) else 0,
+            search_leaves["value"].mean() if len(search_leaves) else 0, duration, top))
+    if len(starts) > max_searches:
+        print("... %i more searches" % (len(starts) - max_searches))
+
+    total = np.nansum(seconds)
+    print()
+    print("searches: %i  leaves: %i  terminal leaves: %i" % (len(starts), len(leaves), leaves["terminal"].sum()))
+    if len(leaves):
+        print("depth: mean %.2f  max %i  histogram %s" % (leaves["depth"].mean(), leaves["depth"].max(),
+                                                         np.bincount(leaves["depth"]).tolist()))
+    if total > 0:
+        print("search time: %.2fs  leaves/sec: %.1f" % (total, len(leaves) / total))
+
+
+if __name__ == "__main__":
+    summarize(sys.argv[1])
@@ -1,15 +1,40 @@
 from websocket import create_connection
+import collections
 import sys
 import _thread
+import threading
 import time
 
+##########
+# opponent_move - uci move of the opponent on our board, None if we have the first move
+# partner_moves - uci moves played on the partner board since the last turn
+# done - True if the game is over, the moves are empty then
+##########
+Turn = collections.namedtuple("Turn", ["opponent_move", "partner_moves", "done"])
+
 
 class XBoardInterface():
     def __init__(self, name, interfaceType, server_address):
-        self.interfaceType = interfaceType
+        self._initState(name, interfaceType)
         if interfaceType == "websocket":
             self.ws = create_connection(server_address)
+
+        # wait for messages
+        _thread.start_new_thread(self._readWebsocket, ())
+
+    def _initState(self, name, interfaceType):
+        self.interfaceType = interfaceType
         self.name = name
+        # guards the game state, the reader thread notifies the game loop about every message
+        self.stateChanged = threading.Condition()
+        # number of games started on this connection
+        self.gameNumber = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the state of the last game, the connection stays open for the next one
+        """
         self.gameStarted = False
         self.isMyTurn = False
         self.lastMove = None
@@ -17,10 +42,57 @@ class XBoardInterface():
         self.color = None
         self.time = None
         self.startTime = None
+        # time at which it became our turn, to measure the reaction time
+        self.turnStartTime = None
         self.done = False
 
-        # wait for messages
-        _thread.start_new_thread(self._readWebsocket, ())
+    def _startGame(self):
+        if self.done:
+            # the server started the next game without "new", keep the clock it sent for it
+            time_left = self.time
+            self.reset()
+            self.time = time_left
+        if not self.gameStarted:
+            self.gameNumber += 1
+        self.gameStarted = True
+        self.startTime = time.time()
+
+    def wait_for_game(self, games_played, timeout=None):
+        """
+        Blocks until the server starts a game after the games_played first games of this connection
+        :return: number of the game, None after the timeout
+        """
+        with self.stateChanged:
+            if not self.stateChanged.wait_for(lambda: self.gameNumber > games_played and not self.done, timeout):
+                return None
+            return self.gameNumber
+
+    def wait_for_turn(self, game_number, timeout=None):
+        """
+        Blocks until it is our turn or the game is over. The opponent move and the partner moves are taken
+        from the interface in one step, so no move arriving meanwhile is lost.
+        :param game_number: number of the game being played, a game started by the server meanwhile ends it
+        :return: Turn, None after the timeout
+        """
+        with self.stateChanged:
+            if not self.stateChanged.wait_for(lambda: self.isMyTurn or self.done or self.gameNumber != game_number, timeout):
+                return None
+            if self.done or self.gameNumber != game_number:
+                return Turn(None, [], True)
+            turn = Turn(self.lastMove or None, self.otherMoves, False)
+            self.lastMove = None
+            self.otherMoves = []
+            return turn
+
+    def take_partner_moves(self):
+        """
+        Takes the partner moves which arrived since the last turn, without waiting. Used during the search.
+        :return: list of uci moves
+        """
+        with self.stateChanged:
+            moves = self.otherMoves
+            self.otherMoves = []
+            return moves
 
     def _readWebsocket(self):
         while True:
@@ -31,36 +103,58 @@ class XBoardInterface():
             self._handleServerMessage(result)
 
     def _handleServerMessage(self, message):
+        with self.stateChanged:
+            self._updateState(message)
+            self.stateChanged.notify_all()
+
+    def _updateState(self, message):
         self.logViaInterfaceType("[received]" + str(message))
         if message == "protover 4":
             self.sendViaInterfaceType("feature san=1, variants=\"bughouse\", myname=\"TandemTurtle\", otherboard=1, colors=1, time=1, done=1")
 
-        if "time" in message and self.time == None:
+        if message == "new":
+            self.reset()
+        elif "time" in message and self.time == None:
             self.time = int(message.split()[-1]) / 100
         elif message == "go":
-            self.gameStarted = True
-            self.startTime = time.time()
+            self._startGame()
+            self.turnStartTime = self.startTime
             self.isMyTurn = True
             if self.color is None:
                 self.color = 'white'
         elif message == "playother":
-            self.gameStarted = True
-            self.startTime = time.time()
+            self._startGame()
             self.isMyTurn = False
             if self.color is None:
                 self.color = 'black'
         elif "move" in message and "pmove" not in message and "Illegal" not in message:
             self.lastMove = self.stripMessage(message)
             self.isMyTurn = not self.isMyTurn
+            if self.isMyTurn:
+                self.turnStartTime = time.time()
         elif "pmove" in message:
             self.otherMoves += [self.stripMessage(message)]
         elif "ran out of time" in message or "other board finished" in message or "black mated." in message or "white mated." in message:
             self.done = True
 
-    def sendAction(self, message):
+    def sendAction(self, message, game_number):
+        """
+        Sends our move, unless the game it was searched for is over
+        :param game_number: number of the game the move belongs to
+        :return: False if the move was dropped
+        """
         message = "move " + self.stripMessage(message)
         self.logViaInterfaceType("[action]:" + str(message))
-        self.sendViaInterfaceType(message)
+        # the turn ends before sending, the answer of the opponent can arrive right after it
+        with self.stateChanged:
+            # a search that finishes after the game ended (result, lost connection or "new" from the server)
+            # must not move in the next one
+            if self.done or not self.gameStarted or self.gameNumber != game_number:
+                self.logViaInterfaceType("[action dropped, game is over]:" + str(message))
+                return False
+            self.isMyTurn = False
+            self.sendViaInterfaceType(message)
+            return True
 
     def stripMessage(self, message):
         return str(message).split(' ')[-1]